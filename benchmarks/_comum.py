@@ -0,0 +1,10 @@
+# Funções usadas por mais de um benchmark (os scripts rodam de dentro desta pasta:
+# python benchmarks/<script>.py, então basta "from _comum import ...")
+
+
+# Função para pegar um percentil de uma lista de tempos (em milissegundos)
+def percentil(valores, fracao):
+    if not valores:
+        return 0.0
+    valores = sorted(valores)
+    return valores[min(int(len(valores) * fracao), len(valores) - 1)] * 1000
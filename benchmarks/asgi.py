@@ -0,0 +1,137 @@
+# Benchmark do modo ASGI: latência das páginas baratas enquanto relatórios pesados rodam
+#
+# Uso: python benchmarks/asgi.py [--emprestimos 100000] [--relatorios 8] [--paginas 8] [--segundos 5]
+#
+# Monta um banco com dados gerados e chama a aplicação ASGI direto, no mesmo processo (sem
+# HTTP), com dois grupos de clientes ao mesmo tempo: um pedindo /relatorios sem parar (a
+# página pesada) e outro alternando / e /livros. O cache de páginas fica desligado para todo
+# pedido ir ao banco. Roda duas vezes com o mesmo total de threads:
+# - um_executor: todas as rotas dividem as mesmas threads (como o servidor WSGI)
+# - separados: os relatórios têm o executor deles (o padrão do modo ASGI)
+# Mostra p50/p95/p99/máximo das páginas baratas e quantos relatórios saíram por segundo.
+
+import argparse
+import asyncio
+import os
+import shutil
+import sys
+import tempfile
+import time
+import urllib.parse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bibli
+from _comum import percentil
+
+
+# Função para fazer uma requisição direto na aplicação ASGI; devolve (status, cabeçalhos)
+async def pedir(metodo, caminho, cookie=None, corpo=b""):
+    caminho, _, consulta = caminho.partition("?")
+    cabecalhos = [(b"host", b"localhost")]
+    if cookie:
+        cabecalhos.append((b"cookie", cookie))
+    if corpo:
+        cabecalhos += [(b"content-type", b"application/x-www-form-urlencoded"),
+                       (b"content-length", str(len(corpo)).encode())]
+    scope = {"type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": metodo,
+             "scheme": "http", "path": caminho, "raw_path": caminho.encode(), "root_path": "",
+             "query_string": consulta.encode(), "headers": cabecalhos,
+             "client": ("127.0.0.1", 50000), "server": ("localhost", 80)}
+    mensagens = [{"type": "http.request", "body": corpo, "more_body": False}]
+    resposta = {}
+
+    async def receive():
+        return mensagens.pop() if mensagens else {"type": "http.disconnect"}
+
+    async def send(mensagem):
+        if mensagem["type"] == "http.response.start":
+            resposta["status"] = mensagem["status"]
+            resposta["cabecalhos"] = mensagem["headers"]
+
+    await bibli.aplicacao_asgi(scope, receive, send)
+    return resposta["status"], resposta["cabecalhos"]
+
+
+# Cliente que pede os mesmos caminhos em rodízio até o tempo acabar
+async def cliente(caminhos, cookie, fim, latencias, erros):
+    numero = 0
+    while time.perf_counter() < fim:
+        inicio = time.perf_counter()
+        status, _ = await pedir("GET", caminhos[numero % len(caminhos)], cookie)
+        latencias.append(time.perf_counter() - inicio)
+        if status != 200:
+            erros.append(status)
+        numero += 1
+
+
+# Função para rodar uma rodada com os dois grupos de clientes
+async def rodada(argumentos, cookie):
+    paginas, relatorios, erros = [], [], []
+    fim = time.perf_counter() + argumentos.segundos
+    inicio = time.perf_counter()
+    await asyncio.gather(
+        *(cliente(["/relatorios"], cookie, fim, relatorios, erros) for _ in range(argumentos.relatorios)),
+        *(cliente(["/", "/livros"], cookie, fim, paginas, erros) for _ in range(argumentos.paginas)),
+    )
+    duracao = time.perf_counter() - inicio
+    bibli.fechar_executores_asgi()
+    return paginas, len(relatorios) / duracao, erros
+
+
+# Função para entrar como admin pela própria aplicação e devolver o cookie da sessão
+async def entrar_como_admin():
+    corpo = urllib.parse.urlencode({"tipo_usuario": "admin", "usuario": "admin", "senha": "admin123"}).encode()
+    _, cabecalhos = await pedir("POST", "/login", corpo=corpo)
+    return next(valor for nome, valor in cabecalhos if nome == b"set-cookie").split(b";")[0]
+
+
+async def principal(argumentos):
+    cookie = await entrar_como_admin()
+    total = argumentos.threads + argumentos.threads_pesadas
+    modos = {
+        "um_executor": {"threads_paginas": total, "prefixos_pesados": ()},
+        "separados": {"threads_paginas": argumentos.threads, "threads_pesadas": argumentos.threads_pesadas,
+                      "prefixos_pesados": ("/relatorios",)},
+    }
+    print(f"{argumentos.relatorios} clientes em /relatorios, {argumentos.paginas} em / e /livros, "
+          f"{total} threads  (tempos em ms)")
+    print(f"{'modo':>11} {'páginas/s':>10} {'p50':>8} {'p95':>8} {'p99':>8} {'máximo':>8} "
+          f"{'relatórios/s':>13} {'erros':>6}")
+    for modo, configuracao in modos.items():
+        bibli.CONFIGURACAO_ASGI.update(configuracao)
+        paginas, relatorios_por_segundo, erros = await rodada(argumentos, cookie)
+        print(f"{modo:>11} {len(paginas) / argumentos.segundos:>10.1f} {percentil(paginas, 0.5):>8.1f} "
+              f"{percentil(paginas, 0.95):>8.1f} {percentil(paginas, 0.99):>8.1f} {percentil(paginas, 1):>8.1f} "
+              f"{relatorios_por_segundo:>13.2f} {len(erros):>6}", flush=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Latência das páginas baratas com relatórios pesados rodando (ASGI)")
+    parser.add_argument("--livros", type=int, default=10000)
+    parser.add_argument("--usuarios", type=int, default=2000)
+    parser.add_argument("--emprestimos", type=int, default=100000)
+    parser.add_argument("--relatorios", type=int, default=8, help="clientes pedindo /relatorios ao mesmo tempo")
+    parser.add_argument("--paginas", type=int, default=8, help="clientes pedindo / e /livros ao mesmo tempo")
+    parser.add_argument("--threads", type=int, default=8, help="threads do executor de páginas")
+    parser.add_argument("--threads-pesadas", type=int, default=2, help="threads do executor dos relatórios")
+    parser.add_argument("--segundos", type=float, default=5)
+    argumentos = parser.parse_args()
+
+    pasta = tempfile.mkdtemp()
+    bibli.fechar_pool()
+    bibli.CAMINHO_BANCO = os.path.join(pasta, "asgi.db")
+    bibli.CONFIGURACAO_CACHE["ativo"] = False
+    bibli.CONFIGURACAO_NOTIFICACOES["agendador"] = False
+    bibli.criar_app(dados_exemplo=False)
+
+    print(f"Gerando {argumentos.livros} livros, {argumentos.usuarios} alunos e {argumentos.emprestimos} empréstimos...")
+    banco = bibli.conectar_banco()
+    bibli.gerar_dados(banco, argumentos.livros, argumentos.usuarios, argumentos.emprestimos)
+    banco.close()
+    bibli.executar_varredura(forcar=True)
+
+    asyncio.run(principal(argumentos))
+
+    bibli.parar_asgi()
+    shutil.rmtree(pasta)
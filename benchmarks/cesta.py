@@ -0,0 +1,116 @@
+# Benchmark do atendimento no balcão: um POST por livro x uma cesta por visita
+#
+# Uso: python benchmarks/cesta.py [--mesas 1,4] [--segundos 3] [--synchronous NORMAL,FULL]
+#
+# Em cada visita o aluno devolve os livros que estão com ele e pega outros
+# LIMITE_EMPRESTIMOS. Do jeito antigo isso é um POST em /devolver_livro ou /fazer_emprestimo
+# por livro (uma transação e um commit cada); com a cesta é um POST só em /api/v1/cestas.
+# Várias mesas atendem ao mesmo tempo, cada uma com os seus alunos. Mostra visitas por
+# segundo e a latência da visita inteira, com synchronous NORMAL (o padrão com WAL) e FULL
+# (um fsync por commit).
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bibli
+from _comum import percentil
+
+ALUNOS_POR_MESA = 20
+LIVROS = 500
+
+
+# Função para ver os empréstimos abertos de um aluno (fora da medição)
+def emprestimos_do_aluno(banco, usuario_id):
+    return [linha[0] for linha in banco.execute(
+        "SELECT id FROM emprestimos WHERE usuario_id = ? AND status = 'emprestado'", (usuario_id,))]
+
+
+# Mesa de atendimento: atende os seus alunos em rodízio até o tempo acabar
+def mesa(modo, alunos, fim, latencias, erros):
+    cliente = bibli.app.test_client()
+    with cliente.session_transaction() as sessao:
+        sessao.update({"tipo_usuario": "admin", "nome_usuario": "Mesa", "usuario_id": 1})
+    banco = bibli.pegar_conexao()
+    visita = 0
+    while time.perf_counter() < fim:
+        usuario_id = alunos[visita % len(alunos)]
+        devolver = emprestimos_do_aluno(banco, usuario_id)
+        livros = [1 + (usuario_id * 7 + visita * 3 + numero) % LIVROS for numero in range(bibli.LIMITE_EMPRESTIMOS)]
+        visita += 1
+
+        inicio = time.perf_counter()
+        if modo == "cesta":
+            resposta = cliente.post("/api/v1/cestas", json={"usuario_id": usuario_id, "devolucoes": devolver,
+                                                            "emprestimos": livros})
+            if resposta.status_code != 200 or resposta.get_json()["gravados"] != len(devolver) + len(livros):
+                erros.append(resposta.status_code)
+        else:
+            for emprestimo_id in devolver:
+                cliente.post("/devolver_livro", data={"emprestimo_id": emprestimo_id})
+            for livro_id in livros:
+                cliente.post("/fazer_emprestimo", data={"usuario_id": usuario_id, "livro_id": livro_id})
+        latencias.append(time.perf_counter() - inicio)
+    banco.close()
+
+
+# Função para rodar um modo com um número de mesas e devolver visitas/s e latências
+def rodada(modo, mesas, segundos):
+    latencias, erros = [], []
+    fim = time.perf_counter() + segundos
+    threads = [threading.Thread(target=mesa, args=(modo, list(range(2 + numero * ALUNOS_POR_MESA,
+                                                                      2 + (numero + 1) * ALUNOS_POR_MESA)),
+                                                   fim, latencias, erros))
+               for numero in range(mesas)]
+    inicio = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    duracao = time.perf_counter() - inicio
+    return len(latencias) / duracao, percentil(latencias, 0.5), percentil(latencias, 0.95), len(erros)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Visitas ao balcão por segundo: um POST por livro x cesta")
+    parser.add_argument("--mesas", default="1,4", help="mesas atendendo ao mesmo tempo, separadas por vírgula")
+    parser.add_argument("--segundos", type=float, default=3)
+    parser.add_argument("--synchronous", default="NORMAL,FULL", help="valores do PRAGMA synchronous a testar")
+    argumentos = parser.parse_args()
+    lista_mesas = [int(valor) for valor in argumentos.mesas.split(",")]
+
+    pasta = tempfile.mkdtemp()
+    bibli.fechar_pool()
+    bibli.CAMINHO_BANCO = os.path.join(pasta, "cesta.db")
+    bibli.CONFIGURACAO_CACHE["ativo"] = False
+    bibli.criar_tabelas_banco()
+    bibli.criar_primeiro_admin()
+
+    banco = bibli.conectar_banco()
+    banco.executemany("INSERT INTO livros (titulo, autor, quantidade) VALUES (?, 'Autor', 1000000)",
+                      [(f"Livro {numero:04d}",) for numero in range(LIVROS)])
+    banco.execute("INSERT INTO usuarios (nome, matricula) VALUES ('Ninguém', '0')")
+    banco.executemany("INSERT INTO usuarios (nome, matricula) VALUES (?, ?)",
+                      [(f"Aluno {numero}", f"A{numero}") for numero in range(max(lista_mesas) * ALUNOS_POR_MESA)])
+    banco.commit()
+    banco.close()
+
+    print(f"cada visita: devolve o que o aluno tem e pega {bibli.LIMITE_EMPRESTIMOS} livros  (tempos em ms)")
+    print(f"{'synchronous':>11} {'mesas':>5} {'modo':>10} {'visitas/s':>10} {'p50':>8} {'p95':>8} {'erros':>6}")
+    for synchronous in argumentos.synchronous.split(","):
+        bibli.fechar_pool()
+        bibli.CONFIGURACAO_ARMAZENAMENTO["synchronous"] = synchronous
+        for mesas in lista_mesas:
+            for modo in ("um_por_um", "cesta"):
+                visitas, p50, p95, erros = rodada(modo, mesas, argumentos.segundos)
+                print(f"{synchronous:>11} {mesas:>5} {modo:>10} {visitas:>10.1f} {p50:>8.2f} {p95:>8.2f} {erros:>6}",
+                      flush=True)
+
+    bibli.fechar_pool()
+    shutil.rmtree(pasta)
@@ -0,0 +1,122 @@
+# Benchmark de concorrência: vazão dos leitores enquanto empréstimos são gravados
+#
+# Uso: python benchmarks/concorrencia_escrita.py [--segundos 5] [--leitores 4] [--escritores 2]
+#
+# Roda o mesmo teste com journal_mode DELETE (padrão antigo do SQLite) e WAL,
+# cada um num banco temporário, e mostra quantas páginas por segundo os leitores
+# conseguiram servir e quantos erros "database is locked" apareceram.
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bibli
+
+PAGINAS_LEITURA = ["/", "/livros", "/relatorios"]
+
+
+# Função para criar um cliente já logado como admin
+def cliente_admin():
+    cliente = bibli.app.test_client()
+    cliente.post("/login", data={"tipo_usuario": "admin", "usuario": "admin", "senha": "admin123"})
+    return cliente
+
+
+# Leitor: fica pedindo as páginas de consulta até o tempo acabar
+def leitor(fim, resultados):
+    cliente = cliente_admin()
+    feitas = erros = 0
+    while time.time() < fim:
+        for pagina in PAGINAS_LEITURA:
+            resposta = cliente.get(pagina)
+            if resposta.status_code == 200:
+                feitas += 1
+            else:
+                erros += 1
+    resultados.append(("leitor", feitas, erros))
+
+
+# Escritor: empresta e devolve livros sem parar
+def escritor(fim, usuario_id, resultados):
+    cliente = cliente_admin()
+    feitas = erros = 0
+    while time.time() < fim:
+        resposta = cliente.post("/fazer_emprestimo", data={"usuario_id": usuario_id, "livro_id": 3})
+        with cliente.session_transaction() as sessao:
+            mensagens = [m for _, m in sessao.pop("_flashes", [])]
+        if any(m.startswith("Erro") for m in mensagens):
+            erros += 1
+        else:
+            feitas += 1
+
+        banco = bibli.conectar_banco()
+        linha = banco.execute(
+            "SELECT id FROM emprestimos WHERE usuario_id = ? AND status = 'emprestado' ORDER BY id DESC LIMIT 1",
+            (usuario_id,),
+        ).fetchone()
+        banco.close()
+        if linha:
+            cliente.post("/devolver_livro", data={"emprestimo_id": linha["id"]})
+            with cliente.session_transaction() as sessao:
+                mensagens = [m for _, m in sessao.pop("_flashes", [])]
+            if any(m.startswith("Erro") for m in mensagens):
+                erros += 1
+            else:
+                feitas += 1
+    resultados.append(("escritor", feitas, erros))
+
+
+# Função para rodar uma rodada com um journal_mode
+def rodar(journal_mode, segundos, leitores, escritores):
+    pasta = tempfile.mkdtemp()
+    bibli.fechar_pool()
+    bibli.CAMINHO_BANCO = os.path.join(pasta, "benchmark.db")
+    bibli.CONFIGURACAO_ARMAZENAMENTO["journal_mode"] = journal_mode
+
+    bibli.criar_tabelas_banco()
+    bibli.criar_primeiro_admin()
+    bibli.inserir_dados_exemplo()
+
+    resultados = []
+    fim = time.time() + segundos
+    threads = [threading.Thread(target=leitor, args=(fim, resultados)) for _ in range(leitores)]
+    threads += [threading.Thread(target=escritor, args=(fim, 2 + (i % 3), resultados)) for i in range(escritores)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    bibli.fechar_pool()
+    shutil.rmtree(pasta)
+
+    leituras = sum(r[1] for r in resultados if r[0] == "leitor")
+    erros_leitura = sum(r[2] for r in resultados if r[0] == "leitor")
+    escritas = sum(r[1] for r in resultados if r[0] == "escritor")
+    erros_escrita = sum(r[2] for r in resultados if r[0] == "escritor")
+    return {
+        "journal_mode": journal_mode,
+        "leituras_por_segundo": leituras / segundos,
+        "erros_leitura": erros_leitura,
+        "escritas_por_segundo": escritas / segundos,
+        "erros_escrita": erros_escrita,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Vazão dos leitores enquanto empréstimos são gravados")
+    parser.add_argument("--segundos", type=float, default=5)
+    parser.add_argument("--leitores", type=int, default=4)
+    parser.add_argument("--escritores", type=int, default=2)
+    argumentos = parser.parse_args()
+
+    print(f"{'journal':<8} {'leituras/s':>12} {'erros leit.':>12} {'escritas/s':>12} {'erros escr.':>12}")
+    for modo in ("DELETE", "WAL"):
+        r = rodar(modo, argumentos.segundos, argumentos.leitores, argumentos.escritores)
+        print(f"{r['journal_mode']:<8} {r['leituras_por_segundo']:>12.1f} {r['erros_leitura']:>12} "
+              f"{r['escritas_por_segundo']:>12.1f} {r['erros_escrita']:>12}")
@@ -0,0 +1,135 @@
+# Teste de estresse dos empréstimos: muitas mesas emprestando ao mesmo tempo
+#
+# Uso: python benchmarks/estresse_emprestimos.py [--threads 16] [--operacoes 50]
+#
+# Várias threads (cada uma com sua conexão, como as mesas de atendimento) tentam emprestar
+# livros com poucos exemplares para poucos alunos, e às vezes devolvem. No fim confere:
+# - nenhum livro ficou com quantidade negativa;
+# - quantidade + empréstimos ativos de cada livro = exemplares iniciais;
+# - nenhum aluno passou do limite de empréstimos.
+# Sai com código 1 se alguma regra foi quebrada.
+
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bibli
+
+EXEMPLARES_POR_LIVRO = 2
+
+trava_contagem = threading.Lock()
+
+
+# Função para somar um na contagem de resultados (várias threads escrevem nela)
+def contar(contagem, chave):
+    with trava_contagem:
+        contagem[chave] += 1
+
+
+# Mesa de atendimento: empresta (e às vezes devolve) livros aleatórios
+def mesa(semente, operacoes, total_livros, total_usuarios, largada, contagem):
+    sorteio = random.Random(semente)
+    banco = bibli.pegar_conexao()
+    largada.wait()
+    for _ in range(operacoes):
+        try:
+            if sorteio.random() < 0.25:
+                linha = banco.execute(
+                    "SELECT id FROM emprestimos WHERE status = 'emprestado' ORDER BY RANDOM() LIMIT 1"
+                ).fetchone()
+                if linha:
+                    bibli.executar_escrita(banco, bibli.registrar_devolucao, linha['id'])
+                    contar(contagem, 'devolucoes')
+            else:
+                bibli.executar_escrita(banco, bibli.registrar_emprestimo,
+                                       sorteio.randint(1, total_usuarios), sorteio.randint(1, total_livros))
+                contar(contagem, 'emprestimos')
+        except bibli.ErroEmprestimo:
+            contar(contagem, 'recusados')
+        except Exception as erro:
+            contar(contagem, 'erros')
+            print(f"erro inesperado: {erro}")
+    banco.close()
+
+
+# Função para conferir as regras no fim do teste
+def conferir_invariantes(total_livros):
+    problemas = []
+    banco = bibli.conectar_banco()
+
+    for livro in banco.execute("""
+        SELECT l.id, l.quantidade,
+               (SELECT COUNT(*) FROM emprestimos e WHERE e.livro_id = l.id AND e.status = 'emprestado') AS ativos
+        FROM livros l
+    """):
+        if livro['quantidade'] < 0:
+            problemas.append(f"livro {livro['id']} com quantidade {livro['quantidade']}")
+        if livro['quantidade'] + livro['ativos'] != EXEMPLARES_POR_LIVRO:
+            problemas.append(f"livro {livro['id']}: quantidade {livro['quantidade']} + ativos {livro['ativos']} "
+                             f"!= {EXEMPLARES_POR_LIVRO}")
+
+    for usuario in banco.execute("""
+        SELECT usuario_id, COUNT(*) AS ativos FROM emprestimos
+        WHERE status = 'emprestado' GROUP BY usuario_id HAVING COUNT(*) > ?
+    """, (bibli.LIMITE_EMPRESTIMOS,)):
+        problemas.append(f"usuário {usuario['usuario_id']} com {usuario['ativos']} empréstimos ativos")
+
+    banco.close()
+    return problemas
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Estresse de empréstimos concorrentes")
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--operacoes", type=int, default=50, help="operações por thread")
+    parser.add_argument("--livros", type=int, default=5)
+    parser.add_argument("--usuarios", type=int, default=8)
+    argumentos = parser.parse_args()
+
+    pasta = tempfile.mkdtemp()
+    bibli.fechar_pool()
+    bibli.CAMINHO_BANCO = os.path.join(pasta, "estresse.db")
+    bibli.TAMANHO_MAXIMO_POOL = argumentos.threads
+    bibli.criar_tabelas_banco()
+
+    banco = bibli.conectar_banco()
+    banco.executemany("INSERT INTO livros (titulo, autor, quantidade) VALUES (?, ?, ?)",
+                      [(f"Livro {i}", "Autor", EXEMPLARES_POR_LIVRO) for i in range(argumentos.livros)])
+    banco.executemany("INSERT INTO usuarios (nome, matricula) VALUES (?, ?)",
+                      [(f"Aluno {i}", f"E{i:04d}") for i in range(argumentos.usuarios)])
+    banco.commit()
+    banco.close()
+
+    contagem = {'emprestimos': 0, 'devolucoes': 0, 'recusados': 0, 'erros': 0}
+    largada = threading.Barrier(argumentos.threads)
+    threads = [threading.Thread(target=mesa, args=(semente, argumentos.operacoes, argumentos.livros,
+                                                   argumentos.usuarios, largada, contagem))
+               for semente in range(argumentos.threads)]
+
+    inicio = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    duracao = time.perf_counter() - inicio
+
+    problemas = conferir_invariantes(argumentos.livros)
+    bibli.fechar_pool()
+    shutil.rmtree(pasta)
+
+    total = argumentos.threads * argumentos.operacoes
+    print(f"{total} operações em {duracao:.2f}s por {argumentos.threads} threads")
+    print(f"empréstimos: {contagem['emprestimos']}  devoluções: {contagem['devolucoes']}  "
+          f"recusados: {contagem['recusados']}  erros: {contagem['erros']}")
+    if problemas or contagem['erros']:
+        for problema in problemas:
+            print(f"FALHOU: {problema}")
+        sys.exit(1)
+    print("OK: quantidades e limites conferem")
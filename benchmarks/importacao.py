@@ -0,0 +1,83 @@
+# Benchmark da importação em massa: linhas por segundo de importar_registros
+#
+# Uso: python benchmarks/importacao.py [--linhas 200000] [--lote 10000] [--formato csv]
+#
+# O arquivo é montado na memória e lido pelo mesmo caminho do comando "importar"
+# (ler_linhas_importacao + importar_registros), então a conta inclui ler o CSV/JSONL,
+# validar as linhas e gravar. Cenários:
+#   livros novos          banco vazio, todas as linhas entram
+#   livros repetidos      o mesmo arquivo de novo: todo ISBN já existe e vira atualização
+#   usuarios novos        matrículas novas
+
+import argparse
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bibli
+
+
+# Função para montar o arquivo de uma tabela na memória
+def montar_arquivo(tabela, linhas, formato):
+    if tabela == 'livros':
+        registros = ({'titulo': f"Livro {i:07d}", 'autor': f"Autor {i % 5000}", 'isbn': f"978-{i:09d}",
+                      'ano': 1900 + i % 120, 'quantidade': 1 + i % 4} for i in range(linhas))
+    else:
+        registros = ({'nome': f"Aluno {i:07d}", 'matricula': f"M{i:08d}", 'curso': f"Curso {i % 40}"}
+                     for i in range(linhas))
+    texto = io.StringIO()
+    if formato == 'jsonl':
+        for registro in registros:
+            texto.write(json.dumps(registro) + "\n")
+    else:
+        colunas = bibli.IMPORTACAO[tabela]['colunas']
+        texto.write(",".join(colunas) + "\n")
+        for registro in registros:
+            texto.write(",".join(str(registro[coluna]) for coluna in colunas) + "\n")
+    return texto.getvalue()
+
+
+# Função para importar um arquivo e devolver o relatório
+def importar(tabela, conteudo, formato, tamanho_lote):
+    banco = bibli.conectar_banco()
+    try:
+        return bibli.importar_registros(banco, tabela, bibli.ler_linhas_importacao(io.StringIO(conteudo), formato),
+                                        tamanho_lote=tamanho_lote)
+    finally:
+        banco.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Linhas por segundo na importação em massa")
+    parser.add_argument("--linhas", type=int, default=200000)
+    parser.add_argument("--lote", type=int, default=10000)
+    parser.add_argument("--formato", choices=("csv", "jsonl"), default="csv")
+    argumentos = parser.parse_args()
+
+    pasta = tempfile.mkdtemp()
+    bibli.fechar_pool()
+    bibli.CAMINHO_BANCO = os.path.join(pasta, "benchmark.db")
+    bibli.criar_tabelas_banco()
+
+    livros = montar_arquivo('livros', argumentos.linhas, argumentos.formato)
+    usuarios = montar_arquivo('usuarios', argumentos.linhas, argumentos.formato)
+    cenarios = [
+        ("livros novos", 'livros', livros),
+        ("livros repetidos", 'livros', livros),
+        ("usuarios novos", 'usuarios', usuarios),
+    ]
+
+    print(f"{argumentos.linhas} linhas por cenário, {argumentos.formato}, lotes de {argumentos.lote}")
+    for nome, tabela, conteudo in cenarios:
+        relatorio = importar(tabela, conteudo, argumentos.formato, argumentos.lote)
+        print(f"{nome:18s} {relatorio['linhas_por_segundo']:10.0f} linhas/s "
+              f"({relatorio['segundos']:.2f} s, gravadas {relatorio['gravadas']}, "
+              f"conflitos {relatorio['conflitos']}, inválidas {relatorio['invalidas']})")
+
+    bibli.fechar_pool()
+    shutil.rmtree(pasta)
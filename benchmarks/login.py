@@ -0,0 +1,119 @@
+# Benchmark do login de administrador: quantos logins por segundo cada custo de hash aguenta
+#
+# Uso: python benchmarks/login.py [--custos 12,13,14,15] [--simultaneas 1,2,4] [--clientes 16] [--segundos 3]
+#
+# Para cada custo do scrypt (n = 2^custo) e cada limite de hashes simultâneos, várias threads
+# fazem login ao mesmo tempo (uma "tempestade de logins") enquanto outra thread fica pedindo
+# /livros, para mostrar se as outras páginas continuam respondendo. Mostra logins/s, a
+# latência do login, o tempo de espera na fila de senhas, quantos logins foram recusados
+# (fila cheia) e a latência de /livros durante a tempestade.
+# Com o Python sem scrypt, o custo vira o número de iterações do PBKDF2 (custo x 40000).
+
+import argparse
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bibli
+from _comum import percentil
+
+
+# Cliente que fica fazendo login até o tempo acabar
+def cliente_login(fim, latencias, resultados):
+    cliente = bibli.app.test_client()
+    while time.perf_counter() < fim:
+        inicio = time.perf_counter()
+        resposta = cliente.post("/login", data={"tipo_usuario": "admin", "usuario": "admin", "senha": "admin123"})
+        latencias.append(time.perf_counter() - inicio)
+        resultados.append(resposta.status_code)
+        with cliente.session_transaction() as sessao:
+            sessao.clear()
+
+
+# Leitor que fica pedindo /livros durante a tempestade de logins
+def leitor_livros(fim, latencias):
+    cliente = bibli.app.test_client()
+    with cliente.session_transaction() as sessao:
+        sessao.update({"tipo_usuario": "aluno", "nome_usuario": "Leitor", "matricula_usuario": "0", "usuario_id": 0})
+    while time.perf_counter() < fim:
+        inicio = time.perf_counter()
+        cliente.get("/livros")
+        latencias.append(time.perf_counter() - inicio)
+
+
+# Função para rodar uma rodada com um custo e um limite de hashes simultâneos
+def rodada(custo, simultaneas, clientes, segundos):
+    if bibli.CONFIGURACAO_SENHAS["algoritmo"] == "scrypt":
+        bibli.CONFIGURACAO_SENHAS["scrypt_n"] = 2 ** custo
+    else:
+        bibli.CONFIGURACAO_SENHAS["pbkdf2_iteracoes"] = custo * 40000
+    bibli.fechar_fila_senhas()
+    bibli.CONFIGURACAO_SENHAS["verificacoes_simultaneas"] = simultaneas
+    for chave in bibli.estatisticas_senhas:
+        bibli.estatisticas_senhas[chave] = 0
+    bibli.esperas_recentes_senhas.clear()
+
+    # Gravar a senha do admin com o custo desta rodada
+    banco = bibli.conectar_banco()
+    banco.execute("UPDATE administradores SET senha = ? WHERE usuario = 'admin'", (bibli.gerar_hash_senha("admin123"),))
+    banco.commit()
+    banco.close()
+
+    latencias_login, resultados, latencias_livros = [], [], []
+    fim = time.perf_counter() + segundos
+    threads = [threading.Thread(target=cliente_login, args=(fim, latencias_login, resultados)) for _ in range(clientes)]
+    threads.append(threading.Thread(target=leitor_livros, args=(fim, latencias_livros)))
+    inicio = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    duracao = time.perf_counter() - inicio
+
+    filas = bibli.obter_estatisticas_senhas()
+    aceitos = resultados.count(302)
+    print(f"{custo:5d} {simultaneas:6d} {aceitos / duracao:9.1f} {percentil(latencias_login, 0.5):8.1f} "
+          f"{percentil(latencias_login, 0.95):8.1f} {filas['espera_media_ms']:8.1f} {filas['espera_p95_ms']:8.1f} "
+          f"{filas['calculo_medio_ms']:8.1f} {resultados.count(503):9d} "
+          f"{statistics.median(latencias_livros) * 1000 if latencias_livros else 0:9.2f} "
+          f"{percentil(latencias_livros, 0.95):9.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Logins por segundo para cada custo de hash de senha")
+    parser.add_argument("--custos", default="12,13,14,15", help="expoentes do n do scrypt, separados por vírgula")
+    parser.add_argument("--simultaneas", default="1,2,4", help="limites de hashes ao mesmo tempo, separados por vírgula")
+    parser.add_argument("--clientes", type=int, default=16, help="threads fazendo login ao mesmo tempo")
+    parser.add_argument("--segundos", type=float, default=3)
+    argumentos = parser.parse_args()
+
+    pasta = tempfile.mkdtemp()
+    bibli.fechar_pool()
+    bibli.CAMINHO_BANCO = os.path.join(pasta, "login.db")
+    bibli.CONFIGURACAO_CACHE["ativo"] = False
+    bibli.criar_tabelas_banco()
+    bibli.criar_primeiro_admin()
+
+    banco = bibli.conectar_banco()
+    banco.executemany("INSERT INTO livros (titulo, autor, quantidade) VALUES (?, ?, ?)",
+                      [(f"Livro {i:05d}", "Autor", 1) for i in range(500)])
+    banco.commit()
+    banco.close()
+
+    print(f"algoritmo: {bibli.CONFIGURACAO_SENHAS['algoritmo']}  clientes: {argumentos.clientes}  "
+          f"fila máxima: {bibli.CONFIGURACAO_SENHAS['fila_maxima']}  (tempos em ms)")
+    print(f"{'custo':>5} {'simult':>6} {'logins/s':>9} {'p50':>8} {'p95':>8} {'fila':>8} {'fila95':>8} "
+          f"{'hash':>8} {'recusados':>9} {'livros50':>9} {'livros95':>9}")
+    for custo in (int(valor) for valor in argumentos.custos.split(",")):
+        for simultaneas in (int(valor) for valor in argumentos.simultaneas.split(",")):
+            rodada(custo, simultaneas, argumentos.clientes, argumentos.segundos)
+
+    bibli.fechar_fila_senhas()
+    bibli.fechar_pool()
+    shutil.rmtree(pasta)
@@ -0,0 +1,426 @@
+# Benchmark de todas as rotas: latência (p50/p95/p99) e requisições por segundo de cada uma
+#
+# Uso: python benchmarks/rotas.py [--escala 1k|100k|1m] [--clientes 8] [--segundos 3]
+#                                 [--rotas regex] [--banco arquivo.db] [--url http://host:porta]
+#                                 [--salvar-base] [--base arquivo.json] [--tolerancia 0.25]
+#
+# Monta um banco com livros, alunos e empréstimos na escala pedida (o mesmo banco para a mesma
+# escala e semente, e com --banco ele é guardado e reaproveitado nas próximas rodadas) e passa
+# por cada rota com vários clientes ao mesmo tempo, logados como admin, como aluno ou sem
+# login. Sem --url as requisições vão pelo test client do Flask, no mesmo processo; com --url
+# vão por HTTP para um servidor já rodando (ex: python bibli.py producao com BIBLIOTECA_DB
+# apontando para o arquivo de --banco).
+# Os empréstimos são medidos em pares: cada cliente tem o seu aluno, empresta e devolve.
+#
+# Linha de base: --salvar-base grava os números em benchmarks/bases/rotas-<escala>.json (ou
+# no arquivo de --base). Se o arquivo já existir, cada rodada compara com ele e sai com
+# código 1 quando alguma rota piorou mais que a tolerância (p95 maior ou req/s menor).
+
+import argparse
+import http.cookiejar
+import json
+import os
+import platform
+import re
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from datetime import date
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bibli
+from _comum import percentil
+
+PASTA_BASES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bases")
+
+# Escalas: livros, alunos e empréstimos
+ESCALAS = {
+    "1k": (1000, 200, 1000),
+    "100k": (100000, 10000, 100000),
+    "1m": (1000000, 50000, 1000000),
+}
+
+ALUNOS_DE_BANCADA = 64  # um aluno sem empréstimos para cada cliente que empresta e devolve
+
+# Rotas medidas: (papel, método, caminho); {busca}, {aluno} e {livro} são trocados por valores do banco
+ROTAS = [
+    ("anonimo", "GET", "/login"),
+    ("anonimo", "GET", "/saude"),
+    ("anonimo", "POST", "/login"),
+    ("admin", "GET", "/"),
+    ("admin", "GET", "/livros"),
+    ("admin", "GET", "/livros?tamanho=200"),
+    ("admin", "GET", "/livros?modo=completo"),
+    ("admin", "GET", "/livros/busca?q={busca}"),
+    ("admin", "GET", "/usuarios"),
+    ("admin", "GET", "/emprestimos"),
+    ("admin", "GET", "/autocompletar/usuarios?q={aluno}"),
+    ("admin", "GET", "/autocompletar/livros?q={livro}"),
+    ("admin", "GET", "/relatorios"),
+    ("admin", "GET", "/relatorios/exportar/atrasados.csv"),
+    ("admin", "GET", "/relatorios/exportar/historico.jsonl"),
+    ("admin", "GET", "/relatorios/exportar/historico.xlsx"),
+    ("admin", "GET", "/estatisticas"),
+    ("admin", "GET", "/metrics"),
+    ("admin", "POST", "/atrasados/varrer"),
+    ("admin", "GET", "/importar"),
+    ("admin", "GET", "/cadastro"),
+    ("admin", "POST", "/cadastrar_livro"),
+    ("admin", "POST", "/cadastrar_usuario"),
+    ("admin", "POST", "/fazer_emprestimo"),
+    ("admin", "POST", "/devolver_livro"),
+    ("admin", "GET", "/api/v1/livros?limite=50"),
+    ("admin", "GET", "/api/v1/livros?q={busca}&campos=id,titulo"),
+    ("admin", "GET", "/api/v1/emprestimos?status=emprestado&campos=id,livro_titulo,usuario_nome"),
+    ("admin", "POST", "/api/v1/emprestimos"),
+    ("admin", "POST", "/api/v1/devolucoes"),
+    ("admin", "POST", "/api/v1/cestas"),
+    ("aluno", "GET", "/"),
+    ("aluno", "GET", "/livros"),
+    ("aluno", "GET", "/livros/busca?q={busca}"),
+    ("aluno", "GET", "/meus_emprestimos"),
+    ("aluno", "GET", "/meus_emprestimos?tamanho=100&situacao=com_atraso"),
+    ("aluno", "GET", "/relatorios"),
+    ("aluno", "GET", "/api/v1/emprestimos"),
+]
+
+# Status esperado de cada rota (o resto é 200)
+STATUS_ESPERADO = {
+    ("anonimo", "POST", "/login"): 302,
+    ("admin", "POST", "/cadastrar_livro"): 302,
+    ("admin", "POST", "/cadastrar_usuario"): 302,
+    ("admin", "POST", "/fazer_emprestimo"): 302,
+    ("admin", "POST", "/devolver_livro"): 302,
+}
+
+
+# Função para montar o banco de teste na escala pedida (sempre igual para a mesma semente)
+def popular_banco(livros, alunos, emprestimos, semente, marca):
+    banco = bibli.conectar_banco()
+    bibli.gerar_dados(banco, livros, alunos, emprestimos, semente=semente)
+
+    # Alunos e livro reservados para os empréstimos do benchmark
+    banco.executemany(
+        "INSERT INTO usuarios (nome, matricula, curso) VALUES (?, ?, ?)",
+        ((f"Bancada {i:02d}", f"BANCADA{i:02d}", bibli.CURSOS[0]) for i in range(ALUNOS_DE_BANCADA)))
+    # O autor do livro de bancada marca a escala e a semente, para reaproveitar o banco depois
+    banco.execute("INSERT INTO livros (titulo, autor, quantidade) VALUES ('Livro de bancada', ?, 1000000)",
+                  (f"Benchmark {marca}",))
+    banco.commit()
+    banco.close()
+
+
+# Função para preparar o banco (ou reaproveitar o de --banco se já estiver na escala pedida)
+def preparar_banco(caminho, escala, semente):
+    livros, alunos, emprestimos = ESCALAS[escala]
+    bibli.fechar_pool()
+    bibli.CAMINHO_BANCO = caminho
+    bibli.criar_tabelas_banco()
+    bibli.criar_primeiro_admin()
+
+    marca = f"{escala}/{semente}"
+    banco = bibli.conectar_banco()
+    total = banco.execute("SELECT COUNT(*) FROM livros").fetchone()[0]
+    bancada = banco.execute("SELECT autor FROM livros WHERE titulo = 'Livro de bancada'").fetchone()
+    banco.close()
+    if bancada and bancada[0] == f"Benchmark {marca}":
+        print(f"Usando o banco que já existe em {caminho}")
+        return
+    if total:
+        sys.exit(f"{caminho} já tem livros e não foi montado para a escala {escala} com a semente {semente}")
+
+    print(f"Montando o banco: {livros} livros, {alunos} alunos, {emprestimos} empréstimos...", flush=True)
+    inicio = time.perf_counter()
+    popular_banco(livros, alunos, emprestimos, semente, marca)
+    print(f"  pronto em {time.perf_counter() - inicio:.1f}s", flush=True)
+
+
+# Função para pegar no banco os valores usados nas rotas e nos empréstimos
+def valores_do_banco():
+    banco = bibli.conectar_banco()
+    aluno = banco.execute("""
+        SELECT u.matricula, u.nome FROM usuarios u
+        WHERE u.id = (SELECT usuario_id FROM emprestimos GROUP BY usuario_id ORDER BY COUNT(*) DESC LIMIT 1)
+    """).fetchone()
+    bancada = [linha[0] for linha in banco.execute(
+        "SELECT id FROM usuarios WHERE matricula LIKE 'BANCADA%' ORDER BY id")]
+    livro_bancada = banco.execute("SELECT id FROM livros WHERE titulo = 'Livro de bancada'").fetchone()[0]
+    meio = banco.execute("SELECT titulo, autor FROM livros ORDER BY id LIMIT 1 OFFSET "
+                         "(SELECT COUNT(*) / 2 FROM livros)").fetchone()
+    banco.close()
+    return {
+        "matricula_aluno": aluno[0] if aluno else "2024001",
+        "alunos_bancada": bancada,
+        "livro_bancada": livro_bancada,
+        "busca": meio["titulo"],
+        "livro": meio["titulo"][:9],
+        "aluno": aluno[1][:4] if aluno else "Jo",
+    }
+
+
+# Números únicos para os livros e alunos cadastrados durante a medição (várias threads pedem)
+class Sequencia:
+    def __init__(self, inicio):
+        self.proximo = inicio
+        self.trava = threading.Lock()
+
+    def __next__(self):
+        with self.trava:
+            self.proximo += 1
+            return self.proximo
+
+
+# Cliente pelo test client do Flask (no mesmo processo)
+class ClienteFlask:
+    def __init__(self):
+        self.cliente = bibli.app.test_client()
+
+    def pedir(self, metodo, caminho, dados=None, como_json=False):
+        if como_json:
+            resposta = self.cliente.open(caminho, method=metodo, json=dados, buffered=True)
+        else:
+            resposta = self.cliente.open(caminho, method=metodo, data=dados, buffered=True)
+        resposta.get_data()
+        return resposta.status_code
+
+
+# Não seguir redirecionamentos: o status medido é o da rota
+class SemRedirecionar(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+# Cliente por HTTP, para um servidor rodando em outro processo
+class ClienteHttp:
+    def __init__(self, url):
+        self.url = url.rstrip("/")
+        self.abridor = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()), SemRedirecionar())
+
+    def pedir(self, metodo, caminho, dados=None, como_json=False):
+        cabecalhos = {}
+        if como_json:
+            corpo = json.dumps(dados).encode()
+            cabecalhos["Content-Type"] = "application/json"
+        else:
+            corpo = urllib.parse.urlencode(dados).encode() if dados is not None else None
+        pedido = urllib.request.Request(self.url + urllib.parse.quote(caminho, safe="/?=&%"),
+                                        data=corpo, method=metodo, headers=cabecalhos)
+        try:
+            with self.abridor.open(pedido, timeout=300) as resposta:
+                resposta.read()
+                return resposta.status
+        except urllib.error.HTTPError as erro:
+            erro.read()
+            return erro.code
+
+
+# Função para criar um cliente já logado no papel pedido
+def criar_cliente(argumentos, papel, valores):
+    cliente = ClienteHttp(argumentos.url) if argumentos.url else ClienteFlask()
+    if papel == "admin":
+        cliente.pedir("POST", "/login", {"tipo_usuario": "admin", "usuario": "admin", "senha": "admin123"})
+    elif papel == "aluno":
+        cliente.pedir("POST", "/login", {"tipo_usuario": "aluno", "matricula": valores["matricula_aluno"]})
+    # Ler a mensagem de boas-vindas para ela não atrapalhar a primeira medição
+    if papel != "anonimo":
+        cliente.pedir("GET", "/saude")
+        cliente.pedir("GET", "/login")
+    return cliente
+
+
+# Cliente que fica repetindo uma rota até o tempo acabar (pelo menos uma vez)
+def cliente_rota(argumentos, rota, valores, numero, largada, controle, latencias, erros, sequencia):
+    papel, metodo, modelo = rota
+    cliente = criar_cliente(argumentos, papel, valores)
+    caminho = modelo.format(**valores)
+    esperado = STATUS_ESPERADO.get(rota, 200)
+    usuario_id = valores["alunos_bancada"][numero % len(valores["alunos_bancada"])]
+    emprestimos_abertos = []
+    largada.wait()
+
+    while True:
+        dados = None
+        if modelo == "/login" and metodo == "POST":
+            dados = {"tipo_usuario": "admin", "usuario": "admin", "senha": "admin123"}
+        elif modelo == "/cadastrar_livro":
+            dados = {"titulo": f"Livro novo {next(sequencia)}", "autor": "Benchmark", "quantidade": "1"}
+        elif modelo == "/cadastrar_usuario":
+            item = next(sequencia)
+            dados = {"nome": f"Aluno novo {item}", "matricula": f"NOVO{item}", "curso": bibli.CURSOS[0]}
+        elif modelo == "/fazer_emprestimo":
+            dados = {"usuario_id": usuario_id, "livro_id": valores["livro_bancada"]}
+        elif modelo == "/devolver_livro":
+            # Cada devolução precisa de um empréstimo aberto: emprestar antes, fora da medição
+            cliente.pedir("POST", "/fazer_emprestimo", {"usuario_id": usuario_id, "livro_id": valores["livro_bancada"]})
+            emprestimos_abertos = emprestimos_do_aluno(usuario_id)
+            dados = {"emprestimo_id": emprestimos_abertos[0] if emprestimos_abertos else 0}
+        elif modelo == "/api/v1/emprestimos" and metodo == "POST":
+            # Um lote até o limite do aluno
+            dados = {"itens": [{"usuario_id": usuario_id, "livro_id": valores["livro_bancada"]}] * bibli.LIMITE_EMPRESTIMOS}
+        elif modelo == "/api/v1/devolucoes":
+            for _ in range(bibli.LIMITE_EMPRESTIMOS):
+                cliente.pedir("POST", "/fazer_emprestimo", {"usuario_id": usuario_id, "livro_id": valores["livro_bancada"]})
+            dados = {"itens": [{"emprestimo_id": emprestimo_id} for emprestimo_id in emprestimos_do_aluno(usuario_id)]}
+        elif modelo == "/api/v1/cestas":
+            # Uma visita ao balcão: devolve o livro que está com o aluno e pega até o limite
+            cliente.pedir("POST", "/fazer_emprestimo", {"usuario_id": usuario_id, "livro_id": valores["livro_bancada"]})
+            dados = {"usuario_id": usuario_id, "devolucoes": emprestimos_do_aluno(usuario_id),
+                     "emprestimos": [valores["livro_bancada"]] * bibli.LIMITE_EMPRESTIMOS}
+
+        inicio = time.perf_counter()
+        status = cliente.pedir(metodo, caminho, dados, como_json=caminho.startswith("/api/"))
+        latencias.append(time.perf_counter() - inicio)
+        if status != esperado:
+            erros.append(status)
+
+        if modelo in ("/fazer_emprestimo", "/api/v1/emprestimos", "/api/v1/cestas") and metodo == "POST":
+            # Devolver fora da medição para o aluno não chegar no limite
+            for emprestimo_id in emprestimos_do_aluno(usuario_id):
+                cliente.pedir("POST", "/devolver_livro", {"emprestimo_id": emprestimo_id})
+        if modelo == "/login" and metodo == "POST":
+            cliente = criar_cliente(argumentos, "anonimo", valores)
+        if time.perf_counter() >= controle["fim"]:
+            break
+
+
+# Função para ver os empréstimos abertos de um aluno (direto no banco, fora da medição)
+def emprestimos_do_aluno(usuario_id):
+    banco = sqlite3.connect(bibli.CAMINHO_BANCO, timeout=30)
+    ids = [linha[0] for linha in banco.execute(
+        "SELECT id FROM emprestimos WHERE usuario_id = ? AND status = 'emprestado'", (usuario_id,))]
+    banco.close()
+    return ids
+
+
+# Função para medir uma rota com vários clientes ao mesmo tempo
+# Os clientes fazem login antes da largada; o tempo só começa a contar depois dela
+def medir_rota(argumentos, rota, valores, sequencia):
+    latencias, erros = [], []
+    largada = threading.Barrier(argumentos.clientes + 1)
+    controle = {"fim": float("inf")}
+    threads = [threading.Thread(target=cliente_rota,
+                                args=(argumentos, rota, valores, numero, largada, controle, latencias, erros, sequencia))
+               for numero in range(argumentos.clientes)]
+    for thread in threads:
+        thread.start()
+    largada.wait()
+    inicio = time.perf_counter()
+    controle["fim"] = inicio + argumentos.segundos
+    for thread in threads:
+        thread.join()
+    duracao = time.perf_counter() - inicio
+
+    return {
+        "requisicoes": len(latencias),
+        "req_s": round(len(latencias) / duracao, 2),
+        "p50_ms": round(percentil(latencias, 0.50), 3),
+        "p95_ms": round(percentil(latencias, 0.95), 3),
+        "p99_ms": round(percentil(latencias, 0.99), 3),
+        "erros": len(erros),
+    }
+
+
+# Função para comparar com a linha de base; devolve as rotas que pioraram
+def comparar_com_base(base, resultados, tolerancia):
+    pioraram = []
+    for nome, atual in resultados.items():
+        anterior = base["rotas"].get(nome)
+        if anterior is None:
+            continue
+        # Diferenças abaixo de 1 ms são ruído
+        p95_pior = atual["p95_ms"] > anterior["p95_ms"] * (1 + tolerancia) and atual["p95_ms"] - anterior["p95_ms"] > 1
+        vazao_pior = atual["req_s"] < anterior["req_s"] * (1 - tolerancia)
+        if p95_pior or vazao_pior or atual["erros"] > anterior["erros"]:
+            pioraram.append((nome, anterior, atual))
+    return pioraram
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Latência e vazão de todas as rotas")
+    parser.add_argument("--escala", choices=sorted(ESCALAS), default="1k")
+    parser.add_argument("--semente", type=int, default=42)
+    parser.add_argument("--clientes", type=int, default=8, help="clientes ao mesmo tempo em cada rota")
+    parser.add_argument("--segundos", type=float, default=3, help="tempo de medição de cada rota")
+    parser.add_argument("--rotas", help="só as rotas cujo nome casa com esta expressão regular")
+    parser.add_argument("--banco", help="arquivo do banco de teste (guardado e reaproveitado)")
+    parser.add_argument("--url", help="medir por HTTP um servidor já rodando neste endereço")
+    parser.add_argument("--base", help="arquivo JSON da linha de base (padrão: benchmarks/bases/rotas-<escala>.json)")
+    parser.add_argument("--salvar-base", action="store_true", help="gravar esta rodada como a nova linha de base")
+    parser.add_argument("--tolerancia", type=float, default=0.25, help="quanto uma rota pode piorar (0.25 = 25%%)")
+    argumentos = parser.parse_args()
+
+    pasta = None
+    caminho = argumentos.banco
+    if caminho is None:
+        pasta = tempfile.mkdtemp()
+        caminho = os.path.join(pasta, "rotas.db")
+    preparar_banco(os.path.abspath(caminho), argumentos.escala, argumentos.semente)
+    # Os avisos de atraso enviados pelas rotas ficam na memória em vez de ir para o terminal
+    bibli.CONFIGURACAO_NOTIFICACOES["enviador"] = "memoria"
+    valores = valores_do_banco()
+    if argumentos.clientes > len(valores["alunos_bancada"]):
+        sys.exit(f"no máximo {len(valores['alunos_bancada'])} clientes")
+
+    rotas = [rota for rota in ROTAS
+             if not argumentos.rotas or re.search(argumentos.rotas, " ".join(rota))]
+    sequencia = Sequencia(time.time_ns())
+
+    print(f"escala {argumentos.escala}  clientes {argumentos.clientes}  {argumentos.segundos}s por rota  "
+          f"({'HTTP ' + argumentos.url if argumentos.url else 'test client'})  tempos em ms")
+    print(f"{'rota':<58} {'n':>7} {'req/s':>9} {'p50':>9} {'p95':>9} {'p99':>9} {'erros':>6}")
+    resultados = {}
+    for rota in rotas:
+        nome = " ".join(rota)
+        resultado = medir_rota(argumentos, rota, valores, sequencia)
+        resultados[nome] = resultado
+        print(f"{nome:<58} {resultado['requisicoes']:>7} {resultado['req_s']:>9.1f} {resultado['p50_ms']:>9.2f} "
+              f"{resultado['p95_ms']:>9.2f} {resultado['p99_ms']:>9.2f} {resultado['erros']:>6}", flush=True)
+
+    bibli.fechar_fila_senhas()
+    bibli.fechar_pool()
+    if pasta:
+        shutil.rmtree(pasta)
+
+    caminho_base = argumentos.base or os.path.join(PASTA_BASES, f"rotas-{argumentos.escala}.json")
+    codigo = 0
+    if os.path.exists(caminho_base):
+        with open(caminho_base, encoding="utf-8") as arquivo:
+            base = json.load(arquivo)
+        if base["meta"]["clientes"] != argumentos.clientes or base["meta"]["modo"] != ("http" if argumentos.url else "test client"):
+            print(f"\naviso: a linha de base foi medida com outra configuração ({base['meta']})")
+        pioraram = comparar_com_base(base, resultados, argumentos.tolerancia)
+        print(f"\nComparando com {caminho_base} ({base['meta']['data']}):")
+        for nome, anterior, atual in pioraram:
+            print(f"  PIOROU {nome}: p95 {anterior['p95_ms']:.2f} -> {atual['p95_ms']:.2f} ms, "
+                  f"req/s {anterior['req_s']:.1f} -> {atual['req_s']:.1f}, erros {anterior['erros']} -> {atual['erros']}")
+        if not pioraram:
+            print("  nenhuma rota piorou")
+        codigo = 1 if pioraram else 0
+
+    if argumentos.salvar_base:
+        os.makedirs(os.path.dirname(os.path.abspath(caminho_base)), exist_ok=True)
+        with open(caminho_base, "w", encoding="utf-8") as arquivo:
+            json.dump({
+                "meta": {
+                    "escala": argumentos.escala,
+                    "semente": argumentos.semente,
+                    "clientes": argumentos.clientes,
+                    "segundos": argumentos.segundos,
+                    "modo": "http" if argumentos.url else "test client",
+                    "python": platform.python_version(),
+                    "sqlite": sqlite3.sqlite_version,
+                    "data": date.today().isoformat(),
+                },
+                "rotas": resultados,
+            }, arquivo, indent=2, ensure_ascii=False)
+        print(f"\nLinha de base gravada em {caminho_base}")
+
+    sys.exit(codigo)
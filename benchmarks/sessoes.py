@@ -0,0 +1,134 @@
+# Benchmark das sessões: cookie assinado (padrão do Flask) x sessão no servidor (tabela + LRU)
+#
+# Uso: python benchmarks/sessoes.py [--clientes 4] [--segundos 3] [--sessoes 1000,100000]
+#
+# Vários alunos logados pedem / (que sai do cache de páginas, então o que sobra é quase só o
+# custo da sessão) com cada armazém de sessão, primeiro só lendo e depois com uma mesa
+# emprestando e devolvendo ao mesmo tempo (cada escrita no banco esvazia o LRU das sessões).
+# Mostra req/s, p50/p95 e quantas sessões saíram do LRU e quantas do banco.
+# No fim, mede quanto tempo leva "encerrar todas as sessões" com tabelas de tamanhos diferentes.
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bibli
+from _comum import percentil
+
+
+# Aluno que fica pedindo / até o tempo acabar
+def aluno(matricula, fim, latencias):
+    cliente = bibli.app.test_client()
+    cliente.post("/login", data={"tipo_usuario": "aluno", "matricula": matricula})
+    cliente.get("/")  # mostrar (e consumir) a mensagem de boas-vindas
+    partida.wait()
+    while time.perf_counter() < fim:
+        inicio = time.perf_counter()
+        cliente.get("/")
+        latencias.append(time.perf_counter() - inicio)
+
+
+# Mesa que empresta e devolve sem parar
+def mesa(usuario_id, fim):
+    cliente = bibli.app.test_client()
+    cliente.post("/login", data={"tipo_usuario": "admin", "usuario": "admin", "senha": "admin123"})
+    partida.wait()
+    while time.perf_counter() < fim:
+        cliente.post("/fazer_emprestimo", data={"usuario_id": usuario_id, "livro_id": 1})
+        banco = bibli.conectar_banco()
+        emprestimo = banco.execute("SELECT id FROM emprestimos WHERE usuario_id = ? AND status = 'emprestado'",
+                                   (usuario_id,)).fetchone()
+        banco.close()
+        if emprestimo:
+            cliente.post("/devolver_livro", data={"emprestimo_id": emprestimo["id"]})
+
+
+# Função para rodar uma rodada com um armazém de sessão
+def rodada(armazem, com_escritas, clientes, segundos):
+    global partida
+    bibli.CONFIGURACAO_SESSOES["armazem"] = armazem
+    bibli.app.session_interface = bibli.ARMAZENS_SESSAO[armazem]()
+    for chave in bibli.estatisticas_sessoes:
+        bibli.estatisticas_sessoes[chave] = 0
+
+    partida = threading.Event()
+    latencias = []
+    fim = time.perf_counter() + segundos + 1
+    threads = [threading.Thread(target=aluno, args=(f"S{numero}", fim, latencias)) for numero in range(clientes)]
+    if com_escritas:
+        threads.append(threading.Thread(target=mesa, args=(clientes + 2, fim)))
+    for thread in threads:
+        thread.start()
+    time.sleep(1)  # tempo para todos entrarem
+    inicio = time.perf_counter()
+    partida.set()
+    for thread in threads:
+        thread.join()
+    duracao = time.perf_counter() - inicio
+
+    lidas = (bibli.estatisticas_sessoes["lidas_memoria"], bibli.estatisticas_sessoes["lidas_banco"])
+    lidas = f"{lidas[0]:>8} {lidas[1]:>8}" if armazem == "banco" else f"{'-':>8} {'-':>8}"
+    print(f"{armazem:>7} {'sim' if com_escritas else 'não':>8} {len(latencias) / duracao:>9.1f} "
+          f"{percentil(latencias, 0.5):>8.2f} {percentil(latencias, 0.95):>8.2f} {lidas}", flush=True)
+
+
+# Função para medir "encerrar todas as sessões" com uma tabela de sessões de certo tamanho
+def medir_encerramento(quantidade):
+    banco = bibli.conectar_banco()
+    banco.execute("DELETE FROM sessoes")
+    geracao = bibli.geracao_sessoes()
+    expira = time.time() + 3600
+    banco.executemany("INSERT INTO sessoes (chave, dados, expira, geracao) VALUES (?, ?, ?, ?)",
+                      ((os.urandom(32), b"\xfb0", expira, geracao) for _ in range(quantidade)))
+    banco.commit()
+    banco.close()
+    inicio = time.perf_counter()
+    bibli.encerrar_todas_as_sessoes()
+    encerrar = time.perf_counter() - inicio
+    inicio = time.perf_counter()
+    apagadas = bibli.limpar_sessoes_vencidas(forcar=True)
+    limpar = time.perf_counter() - inicio
+    print(f"{quantidade:>8} sessões: encerrar todas {encerrar * 1000:8.2f} ms   "
+          f"limpeza depois (agendador) {limpar * 1000:8.1f} ms ({apagadas} apagadas)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Cookie assinado x sessão no servidor")
+    parser.add_argument("--clientes", type=int, default=4, help="alunos pedindo páginas ao mesmo tempo")
+    parser.add_argument("--segundos", type=float, default=3)
+    parser.add_argument("--sessoes", default="1000,100000", help="tamanhos da tabela para medir o encerramento")
+    argumentos = parser.parse_args()
+
+    pasta = tempfile.mkdtemp()
+    bibli.fechar_pool()
+    bibli.CAMINHO_BANCO = os.path.join(pasta, "sessoes.db")
+    bibli.CONFIGURACAO_NOTIFICACOES["agendador"] = False
+    bibli.criar_tabelas_banco()
+    bibli.criar_primeiro_admin()
+
+    banco = bibli.conectar_banco()
+    banco.execute("INSERT INTO livros (titulo, autor, quantidade) VALUES ('Livro', 'Autor', 1000000)")
+    banco.executemany("INSERT INTO usuarios (nome, matricula) VALUES (?, ?)",
+                      [(f"Aluno {numero}", f"S{numero}") for numero in range(argumentos.clientes + 2)])
+    banco.commit()
+    banco.close()
+
+    print(f"{argumentos.clientes} alunos pedindo /  (tempos em ms)")
+    print(f"{'armazém':>7} {'escritas':>8} {'req/s':>9} {'p50':>8} {'p95':>8} {'LRU':>8} {'banco':>8}")
+    for com_escritas in (False, True):
+        for armazem in ("cookie", "banco"):
+            rodada(armazem, com_escritas, argumentos.clientes, argumentos.segundos)
+
+    bibli.app.session_interface = bibli.SessoesNoBanco()
+    print()
+    for quantidade in (int(valor) for valor in argumentos.sessoes.split(",")):
+        medir_encerramento(quantidade)
+
+    bibli.fechar_pool()
+    shutil.rmtree(pasta)
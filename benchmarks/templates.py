@@ -0,0 +1,117 @@
+# Benchmark dos templates: requisições por segundo em /livros
+#
+# Uso: python benchmarks/templates.py [--livros 2000] [--segundos 3]
+#
+# "antes" reproduz o jeito antigo de montar a página: a tabela montada com
+# f-strings concatenadas e o layout inteiro passado para render_template_string
+# (que compila o template de novo a cada requisição).
+# "depois" é a rota /livros atual, com os templates compilados uma vez e guardados em cache,
+# tanto a página paginada quanto o catálogo completo transmitido (?modo=completo).
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import render_template_string
+
+import bibli
+
+PASTA_TEMPLATES = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "templates")
+
+
+# Layout no formato antigo: um template só, com o conteúdo já pronto em HTML
+def layout_antigo():
+    with open(os.path.join(PASTA_TEMPLATES, "base.html"), encoding="utf-8") as arquivo:
+        fonte = arquivo.read()
+    fonte = fonte.replace("{% block titulo %}Sistema Biblioteca{% endblock %}", "{{ titulo }}")
+    return fonte.replace("{% block conteudo %}{% endblock %}", "{{ conteudo|safe }}")
+
+
+TEMPLATE_ANTIGO = layout_antigo()
+
+
+# Rota /livros do jeito antigo (só para comparação)
+@bibli.precisa_login
+def pagina_livros_antiga():
+    banco = bibli.conectar_banco()
+    livros = banco.execute("SELECT * FROM livros ORDER BY titulo").fetchall()
+    banco.close()
+
+    tabela_livros = '<table class="tabela"><thead><tr><th>ID</th><th>Título</th><th>Autor</th>' \
+                    '<th>ISBN</th><th>Ano</th><th>Quantidade</th><th>Status</th></tr></thead><tbody>'
+    for livro in livros:
+        if livro['quantidade'] > 0:
+            status, cor_status = "✅ Disponível", "green"
+        else:
+            status, cor_status = "❌ Indisponível", "red"
+        tabela_livros += f'''
+            <tr>
+                <td>{livro['id']}</td>
+                <td>{livro['titulo']}</td>
+                <td>{livro['autor']}</td>
+                <td>{livro['isbn'] or 'N/A'}</td>
+                <td>{livro['ano'] or 'N/A'}</td>
+                <td>{livro['quantidade']}</td>
+                <td style="color: {cor_status}; font-weight: bold;">{status}</td>
+            </tr>
+        '''
+    tabela_livros += "</tbody></table>"
+
+    conteudo = f"<h2>📖 Gerenciar Livros</h2><h3>📚 Lista de Livros</h3>{tabela_livros}"
+    return render_template_string(TEMPLATE_ANTIGO, titulo="Livros", conteudo=conteudo)
+
+
+bibli.app.add_url_rule("/benchmark/livros_antigo", "pagina_livros_antiga", pagina_livros_antiga)
+
+
+# Função para medir quantas requisições por segundo uma página aguenta
+def medir(cliente, pagina, segundos):
+    cliente.get(pagina, buffered=True)  # aquecimento (compila e guarda os templates)
+    feitas = 0
+    inicio = time.perf_counter()
+    while time.perf_counter() - inicio < segundos:
+        resposta = cliente.get(pagina, buffered=True)
+        assert resposta.status_code == 200, resposta.status_code
+        feitas += 1
+    return feitas / (time.perf_counter() - inicio)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Requisições por segundo em /livros, antes e depois dos templates")
+    parser.add_argument("--livros", type=int, default=2000)
+    parser.add_argument("--segundos", type=float, default=3)
+    argumentos = parser.parse_args()
+
+    pasta = tempfile.mkdtemp()
+    bibli.fechar_pool()
+    bibli.CAMINHO_BANCO = os.path.join(pasta, "benchmark.db")
+    bibli.criar_tabelas_banco()
+    bibli.criar_primeiro_admin()
+
+    banco = bibli.conectar_banco()
+    banco.executemany(
+        "INSERT INTO livros (titulo, autor, isbn, ano, quantidade) VALUES (?, ?, ?, ?, ?)",
+        ((f"Livro {i:06d}", f"Autor {i % 300}", f"isbn-{i}", 1900 + i % 120, i % 4) for i in range(argumentos.livros)),
+    )
+    banco.commit()
+    banco.close()
+
+    cliente = bibli.app.test_client()
+    cliente.post("/login", data={"tipo_usuario": "admin", "usuario": "admin", "senha": "admin123"})
+
+    antes = medir(cliente, "/benchmark/livros_antigo", argumentos.segundos)
+    depois = medir(cliente, "/livros", argumentos.segundos)
+    completo = medir(cliente, "/livros?modo=completo", argumentos.segundos)
+
+    bibli.fechar_pool()
+    shutil.rmtree(pasta)
+
+    print(f"/livros com {argumentos.livros} livros")
+    print(f"antes  (render_template_string + f-strings): {antes:8.1f} req/s")
+    print(f"depois (templates compilados em cache):      {depois:8.1f} req/s (primeira página)")
+    print(f"depois (catálogo completo transmitido):      {completo:8.1f} req/s")
@@ -2,27 +2,375 @@
 # Sistema de Biblioteca
 # Criado para gerenciar empréstimos de livros em uma biblioteca
 
-from flask import Flask, request, redirect, render_template_string, flash, url_for, session
+from flask import Flask, Response, request, redirect, render_template, flash, url_for, session, g, jsonify, has_app_context, stream_with_context
+from flask import request_started, request_finished, before_render_template, template_rendered
+from flask.sessions import SessionInterface, SessionMixin, SecureCookieSessionInterface, session_json_serializer
+from itsdangerous import BadSignature
+import argparse
+import asyncio
+import base64
+import contextvars
+import csv
+import hashlib
+import hmac
+import io
+import itertools
+import json
+import os
+import random
+import re
+import secrets
+import signal
+import socket
 import sqlite3
-from datetime import datetime, timedelta
+import sys
+import tempfile
+import threading
+import time
+import traceback
+import zipfile
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler
 
 # Criar aplicação Flask
 app = Flask(__name__)
 app.secret_key = 'minha_chave_secreta_biblioteca'
 
+# Regras de empréstimo
+LIMITE_EMPRESTIMOS = 3
+PRAZO_EMPRESTIMO_DIAS = 7
+
+# Caminho do arquivo do banco (pode ser trocado pela variável de ambiente)
+CAMINHO_BANCO = os.environ.get('BIBLIOTECA_DB', 'biblioteca.db')
+
+# Quantas conexões paradas o pool guarda no máximo
+TAMANHO_MAXIMO_POOL = int(os.environ.get('BIBLIOTECA_POOL', '8'))
+
+# Configurações aplicadas uma única vez em cada conexão nova
+PRAGMAS_CONEXAO = [
+    "PRAGMA cache_size = -16000",      # 16 MB de cache de páginas por conexão
+    "PRAGMA temp_store = MEMORY",      # tabelas temporárias (ORDER BY, etc.) na memória
+    "PRAGMA mmap_size = 268435456",    # ler o arquivo do banco por mmap (até 256 MB)
+]
+
+# Configuração de armazenamento do SQLite
+# - journal_mode WAL: leitores não ficam bloqueados enquanto um empréstimo é gravado
+# - synchronous NORMAL: seguro com WAL, só faz fsync nos checkpoints
+# - busy_timeout: quanto tempo esperar por um lock antes de desistir
+# - wal_autocheckpoint / journal_size_limit: política de checkpoint do arquivo -wal
+CONFIGURACAO_ARMAZENAMENTO = {
+    'journal_mode': os.environ.get('BIBLIOTECA_JOURNAL_MODE', 'WAL'),
+    'synchronous': os.environ.get('BIBLIOTECA_SYNCHRONOUS', 'NORMAL'),
+    'busy_timeout_ms': int(os.environ.get('BIBLIOTECA_BUSY_TIMEOUT_MS', '5000')),
+    'wal_autocheckpoint': int(os.environ.get('BIBLIOTECA_WAL_AUTOCHECKPOINT', '1000')),
+    'journal_size_limit': 64 * 1024 * 1024,
+    'tentativas_escrita': 5,
+    'espera_inicial_escrita': 0.02,
+    'espera_maxima_escrita': 0.5,
+}
+
+# Pool de conexões: lista de conexões livres + contadores de uso
+conexoes_livres = []
+trava_pool = threading.Lock()
+estatisticas_pool = {'acertos': 0, 'faltas': 0, 'abertas': 0, 'descartadas': 0}
+
+# Conexão que volta para o pool quando alguém chama close()
+class ConexaoBiblioteca(sqlite3.Connection):
+    preso_ao_contexto = False
+
+    def close(self):
+        # Desfazer o que ficou sem commit, igual ao close() de verdade faria
+        if self.in_transaction:
+            self.rollback()
+        # Dentro de uma requisição quem devolve é o teardown do Flask
+        if not self.preso_ao_contexto:
+            devolver_conexao(self)
+
+    def fechar_de_verdade(self):
+        sqlite3.Connection.close(self)
+
+# Classe das conexões novas (a instrumentação troca por uma que mede as consultas)
+classe_conexao = ConexaoBiblioteca
+
+# Função para abrir uma conexão nova já configurada
+def abrir_conexao_nova():
+    config = CONFIGURACAO_ARMAZENAMENTO
+    banco = sqlite3.connect(CAMINHO_BANCO, factory=classe_conexao, check_same_thread=False,
+                            timeout=config['busy_timeout_ms'] / 1000)
+    banco.row_factory = sqlite3.Row  # Para acessar colunas por nome
+    for pragma in PRAGMAS_CONEXAO:
+        banco.execute(pragma)
+    banco.execute(f"PRAGMA busy_timeout = {int(config['busy_timeout_ms'])}")
+    banco.execute(f"PRAGMA synchronous = {config['synchronous']}")
+    banco.execute(f"PRAGMA wal_autocheckpoint = {int(config['wal_autocheckpoint'])}")
+    banco.execute(f"PRAGMA journal_size_limit = {int(config['journal_size_limit'])}")
+    return banco
+
+# Função para pegar uma conexão do pool (ou abrir uma se não tiver nenhuma livre)
+def pegar_conexao():
+    with trava_pool:
+        if conexoes_livres:
+            estatisticas_pool['acertos'] += 1
+            return conexoes_livres.pop()
+        estatisticas_pool['faltas'] += 1
+        estatisticas_pool['abertas'] += 1
+    return abrir_conexao_nova()
+
+# Função para devolver uma conexão ao pool
+def devolver_conexao(banco):
+    with trava_pool:
+        if banco not in conexoes_livres and len(conexoes_livres) < TAMANHO_MAXIMO_POOL:
+            conexoes_livres.append(banco)
+            return
+        if banco in conexoes_livres:
+            return
+        estatisticas_pool['abertas'] -= 1
+        estatisticas_pool['descartadas'] += 1
+    banco.fechar_de_verdade()
+
+# Função para fechar todas as conexões paradas (ex: ao trocar de banco)
+def fechar_pool():
+    with trava_pool:
+        conexoes = list(conexoes_livres)
+        conexoes_livres.clear()
+        estatisticas_pool['abertas'] -= len(conexoes)
+    for banco in conexoes:
+        banco.fechar_de_verdade()
+    fechar_vigia_versoes()
+
+# Função para ver como o pool está sendo usado
+def obter_estatisticas_pool():
+    with trava_pool:
+        dados = dict(estatisticas_pool)
+        dados['livres'] = len(conexoes_livres)
+    total = dados['acertos'] + dados['faltas']
+    dados['taxa_acerto'] = round(dados['acertos'] / total, 4) if total else 0.0
+    return dados
+
 # Função para conectar no banco de dados
+# Dentro de uma requisição a mesma conexão é reaproveitada até o fim dela
 def conectar_banco():
-    banco = sqlite3.connect("biblioteca.db")
-    banco.row_factory = sqlite3.Row  # Para acessar colunas por nome
+    if not has_app_context():
+        return pegar_conexao()
+
+    banco = g.get('banco')
+    if banco is None:
+        banco = pegar_conexao()
+        banco.preso_ao_contexto = True
+        g.banco = banco
     return banco
 
-# Função para criar as tabelas do banco
-def criar_tabelas_banco():
+# Devolver a conexão da requisição para o pool quando ela terminar
+@app.teardown_appcontext
+def devolver_conexao_da_requisicao(erro):
+    banco = g.pop('banco', None)
+    if banco is not None:
+        banco.preso_ao_contexto = False
+        banco.close()
+
+# Função para configurar o modo de journal do arquivo do banco
+# O journal_mode fica gravado no arquivo, então basta rodar uma vez na inicialização
+def configurar_armazenamento():
     banco = conectar_banco()
-    cursor = banco.cursor()
+    modo = banco.execute(f"PRAGMA journal_mode = {CONFIGURACAO_ARMAZENAMENTO['journal_mode']}").fetchone()[0]
+    banco.close()
+    return modo
 
-    # Criar tabela de livros
-    cursor.execute('''
+# Função para forçar um checkpoint do WAL (PASSIVE, FULL, RESTART ou TRUNCATE)
+def fazer_checkpoint(modo='PASSIVE'):
+    banco = conectar_banco()
+    resultado = banco.execute(f"PRAGMA wal_checkpoint({modo})").fetchone()
+    banco.close()
+    return {'ocupado': resultado[0], 'paginas_log': resultado[1], 'paginas_copiadas': resultado[2]}
+
+# Função para saber se o erro foi "database is locked" / "database is busy"
+def banco_ocupado(erro):
+    codigo = getattr(erro, 'sqlite_errorcode', None)
+    if codigo is not None:
+        return codigo & 0xFF in (sqlite3.SQLITE_BUSY, sqlite3.SQLITE_LOCKED)
+    mensagem = str(erro).lower()
+    return 'locked' in mensagem or 'busy' in mensagem
+
+# Função para executar uma escrita, tentando de novo se o banco estiver ocupado
+# A função recebe o cursor e roda dentro de uma transação BEGIN IMMEDIATE: o lock de escrita
+# é pego antes da primeira leitura, então o que ela conferir continua valendo até o commit.
+# Se tudo der certo é feito o commit e o resultado é devolvido; se der erro, nada é gravado.
+def executar_escrita(banco, funcao, *args):
+    config = CONFIGURACAO_ARMAZENAMENTO
+    espera = config['espera_inicial_escrita']
+    for tentativa in range(1, config['tentativas_escrita'] + 1):
+        try:
+            banco.execute("BEGIN IMMEDIATE")
+            resultado = funcao(banco.cursor(), *args)
+            banco.commit()
+            return resultado
+        except sqlite3.OperationalError as erro:
+            banco.rollback()
+            if not banco_ocupado(erro) or tentativa == config['tentativas_escrita']:
+                raise
+            # Espera exponencial com um pouco de aleatoriedade para os escritores não colidirem de novo
+            time.sleep(espera + random.uniform(0, espera))
+            espera = min(espera * 2, config['espera_maxima_escrita'])
+        except Exception:
+            banco.rollback()
+            raise
+
+# Senhas dos administradores: guardadas com hash lento e salt (scrypt; PBKDF2 se o
+# Python não tiver scrypt), no formato "algoritmo$parâmetros$salt$hash".
+# O custo pode ser ajustado pelas variáveis de ambiente; quem tem hash com custo antigo
+# ganha um hash novo no próximo login.
+CONFIGURACAO_SENHAS = {
+    'algoritmo': 'scrypt' if hasattr(hashlib, 'scrypt') else 'pbkdf2_sha256',
+    'scrypt_n': int(os.environ.get('BIBLIOTECA_SCRYPT_N', str(2 ** 14))),
+    'scrypt_r': int(os.environ.get('BIBLIOTECA_SCRYPT_R', '8')),
+    'scrypt_p': int(os.environ.get('BIBLIOTECA_SCRYPT_P', '1')),
+    'pbkdf2_iteracoes': int(os.environ.get('BIBLIOTECA_PBKDF2_ITERACOES', '600000')),
+    # Quantos hashes calculando ao mesmo tempo, e quantos pedidos esperando na fila
+    # antes de recusar novos logins
+    'verificacoes_simultaneas': int(os.environ.get('BIBLIOTECA_VERIFICACOES_SIMULTANEAS', str(min(4, os.cpu_count() or 1)))),
+    'fila_maxima': int(os.environ.get('BIBLIOTECA_FILA_SENHAS', '64')),
+}
+
+# Prefixos dos hashes que o sistema sabe verificar
+PREFIXOS_HASH_SENHA = ('scrypt$', 'pbkdf2_sha256$')
+
+# Função para calcular o hash de uma senha com um salt e parâmetros já escolhidos
+def calcular_hash_senha(senha, algoritmo, parametros, salt):
+    if algoritmo == 'scrypt':
+        n, r, p = parametros
+        return hashlib.scrypt(senha.encode('utf-8'), salt=salt, n=n, r=r, p=p,
+                              maxmem=256 * n * r * p + 1024 * 1024, dklen=32)
+    return hashlib.pbkdf2_hmac('sha256', senha.encode('utf-8'), salt, parametros[0], dklen=32)
+
+# Parâmetros de custo atuais do algoritmo configurado
+def parametros_senha_atuais():
+    config = CONFIGURACAO_SENHAS
+    if config['algoritmo'] == 'scrypt':
+        return (config['scrypt_n'], config['scrypt_r'], config['scrypt_p'])
+    return (config['pbkdf2_iteracoes'],)
+
+# Função para gerar o hash que vai para o banco
+def gerar_hash_senha(senha):
+    algoritmo = CONFIGURACAO_SENHAS['algoritmo']
+    parametros = parametros_senha_atuais()
+    salt = os.urandom(16)
+    resultado = calcular_hash_senha(senha, algoritmo, parametros, salt)
+    return '$'.join([algoritmo, ','.join(str(valor) for valor in parametros),
+                     base64.b64encode(salt).decode('ascii'), base64.b64encode(resultado).decode('ascii')])
+
+# Função para conferir uma senha com o hash guardado
+# Devolve (confere, precisa_refazer): precisa_refazer quando o custo do hash é diferente do atual
+def conferir_hash_senha(senha, guardado):
+    try:
+        algoritmo, parametros, salt, esperado = guardado.split('$')
+        parametros = tuple(int(valor) for valor in parametros.split(','))
+        salt = base64.b64decode(salt)
+        esperado = base64.b64decode(esperado)
+    except (AttributeError, ValueError):
+        return False, False
+    if algoritmo not in ('scrypt', 'pbkdf2_sha256'):
+        return False, False
+
+    confere = hmac.compare_digest(calcular_hash_senha(senha, algoritmo, parametros, salt), esperado)
+    precisa_refazer = (algoritmo, parametros) != (CONFIGURACAO_SENHAS['algoritmo'], parametros_senha_atuais())
+    return confere, precisa_refazer
+
+# Hash de mentira, usado quando o usuário não existe: assim o login demora o mesmo tanto
+# e não dá para descobrir quais usuários existem pelo tempo de resposta
+hashes_senha_falsos = {}
+
+def obter_hash_senha_falso():
+    chave = (CONFIGURACAO_SENHAS['algoritmo'], parametros_senha_atuais())
+    if chave not in hashes_senha_falsos:
+        hashes_senha_falsos[chave] = gerar_hash_senha(base64.b64encode(os.urandom(12)).decode('ascii'))
+    return hashes_senha_falsos[chave]
+
+# Fila de cálculo de hashes: no máximo verificacoes_simultaneas hashes ao mesmo tempo,
+# os outros pedidos esperam; passando de fila_maxima esperando, o login é recusado na hora
+# em vez de prender a thread do servidor. O tempo de espera na fila fica nas estatísticas.
+class FilaSenhasCheia(Exception):
+    pass
+
+executor_senhas = None
+trava_senhas = threading.Lock()
+estatisticas_senhas = {'calculos': 0, 'recusados': 0, 'esperando': 0, 'calculando': 0,
+                       'espera_total': 0.0, 'espera_maxima': 0.0, 'calculo_total': 0.0}
+esperas_recentes_senhas = deque(maxlen=1000)
+
+# Função para rodar um cálculo de senha na fila e esperar o resultado
+def calcular_na_fila_de_senhas(funcao, *args):
+    global executor_senhas
+    with trava_senhas:
+        if estatisticas_senhas['esperando'] >= CONFIGURACAO_SENHAS['fila_maxima']:
+            estatisticas_senhas['recusados'] += 1
+            raise FilaSenhasCheia("Muitos logins ao mesmo tempo, tente de novo em instantes.")
+        if executor_senhas is None:
+            executor_senhas = ThreadPoolExecutor(max_workers=CONFIGURACAO_SENHAS['verificacoes_simultaneas'],
+                                                 thread_name_prefix='senhas')
+        estatisticas_senhas['esperando'] += 1
+        entrada = time.perf_counter()
+
+    def calcular():
+        inicio = time.perf_counter()
+        espera = inicio - entrada
+        with trava_senhas:
+            estatisticas_senhas['esperando'] -= 1
+            estatisticas_senhas['calculando'] += 1
+            estatisticas_senhas['espera_total'] += espera
+            estatisticas_senhas['espera_maxima'] = max(estatisticas_senhas['espera_maxima'], espera)
+            esperas_recentes_senhas.append(espera)
+        try:
+            return funcao(*args)
+        finally:
+            with trava_senhas:
+                estatisticas_senhas['calculando'] -= 1
+                estatisticas_senhas['calculos'] += 1
+                estatisticas_senhas['calculo_total'] += time.perf_counter() - inicio
+
+    return executor_senhas.submit(calcular).result()
+
+# Função para parar a fila de senhas (uma nova é criada no próximo uso)
+def fechar_fila_senhas():
+    global executor_senhas
+    with trava_senhas:
+        executor, executor_senhas = executor_senhas, None
+    if executor is not None:
+        executor.shutdown(wait=True)
+
+# Função para ver como a fila de senhas está (tempos em milissegundos)
+def obter_estatisticas_senhas():
+    with trava_senhas:
+        dados = dict(estatisticas_senhas)
+        esperas = sorted(esperas_recentes_senhas)
+    calculos = dados.pop('calculos')
+    dados['calculos'] = calculos
+    dados['espera_media_ms'] = round(dados.pop('espera_total') / calculos * 1000, 2) if calculos else 0.0
+    dados['espera_maxima_ms'] = round(dados.pop('espera_maxima') * 1000, 2)
+    dados['espera_p95_ms'] = round(esperas[int(len(esperas) * 0.95)] * 1000, 2) if esperas else 0.0
+    dados['calculo_medio_ms'] = round(dados.pop('calculo_total') / calculos * 1000, 2) if calculos else 0.0
+    dados['simultaneas'] = CONFIGURACAO_SENHAS['verificacoes_simultaneas']
+    dados['fila_maxima'] = CONFIGURACAO_SENHAS['fila_maxima']
+    return dados
+
+# Função para trocar as senhas em texto puro que ainda estiverem no banco por hashes (migração)
+def migrar_senhas_para_hash(banco):
+    condicao = ' AND '.join("senha NOT LIKE ?" for _ in PREFIXOS_HASH_SENHA)
+    linhas = banco.execute(f"SELECT id, senha FROM administradores WHERE {condicao}",
+                           [prefixo + '%' for prefixo in PREFIXOS_HASH_SENHA]).fetchall()
+    for linha in linhas:
+        banco.execute("UPDATE administradores SET senha = ? WHERE id = ?",
+                      (gerar_hash_senha(linha['senha']), linha['id']))
+
+# Migrações do banco, em ordem. A versão aplicada fica guardada em PRAGMA user_version.
+# Cada migração é (versão, descrição, passos); um passo é um comando SQL ou uma
+# função que recebe a conexão. Nunca altere uma migração já publicada: crie outra.
+MIGRACOES = [
+    (1, "tabelas iniciais", [
+        # Tabela de livros
+        """
         CREATE TABLE IF NOT EXISTS livros (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             titulo TEXT NOT NULL,
@@ -31,20 +379,18 @@ def criar_tabelas_banco():
             ano INTEGER,
             quantidade INTEGER DEFAULT 1
         )
-    ''')
-
-    # Criar tabela de usuários/alunos
-    cursor.execute('''
+        """,
+        # Tabela de usuários/alunos
+        """
         CREATE TABLE IF NOT EXISTS usuarios (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             nome TEXT NOT NULL,
             matricula TEXT UNIQUE NOT NULL,
             curso TEXT
         )
-    ''')
-
-    # Criar tabela de empréstimos
-    cursor.execute('''
+        """,
+        # Tabela de empréstimos
+        """
         CREATE TABLE IF NOT EXISTS emprestimos (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             usuario_id INTEGER NOT NULL,
@@ -56,38 +402,302 @@ def criar_tabelas_banco():
             FOREIGN KEY (usuario_id) REFERENCES usuarios(id),
             FOREIGN KEY (livro_id) REFERENCES livros(id)
         )
-    ''')
-
-    # Criar tabela de administradores
-    cursor.execute('''
+        """,
+        # Tabela de administradores
+        """
         CREATE TABLE IF NOT EXISTS administradores (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             nome TEXT NOT NULL,
             usuario TEXT UNIQUE NOT NULL,
             senha TEXT NOT NULL
         )
-    ''')
+        """,
+    ]),
+    (2, "índices das consultas das páginas", [
+        # Contagem de atrasados e relatório de atrasados
+        "CREATE INDEX IF NOT EXISTS idx_emprestimos_status_prevista ON emprestimos (status, data_prevista)",
+        # Limite de 3 empréstimos e páginas do aluno
+        "CREATE INDEX IF NOT EXISTS idx_emprestimos_usuario_status ON emprestimos (usuario_id, status)",
+        # Listas de empréstimos ativos ordenadas pela data (só as linhas ativas entram no índice)
+        """
+        CREATE INDEX IF NOT EXISTS idx_emprestimos_ativos_data
+        ON emprestimos (data_emprestimo) WHERE status = 'emprestado'
+        """,
+        # Lista de livros ordenada por título
+        "CREATE INDEX IF NOT EXISTS idx_livros_titulo ON livros (titulo)",
+        # Lista de livros disponíveis (só os que têm exemplares)
+        "CREATE INDEX IF NOT EXISTS idx_livros_disponiveis ON livros (titulo) WHERE quantidade > 0",
+        # Lista de usuários ordenada por nome
+        "CREATE INDEX IF NOT EXISTS idx_usuarios_nome ON usuarios (nome)",
+    ]),
+    (3, "contadores do painel mantidos por triggers", [
+        # Uma linha por estatística da página inicial. Em 'atrasados' a coluna
+        # referencia guarda o dia em que a contagem foi feita (NULL = recontar).
+        """
+        CREATE TABLE contadores (
+            chave TEXT PRIMARY KEY,
+            valor INTEGER NOT NULL DEFAULT 0,
+            referencia TEXT
+        ) WITHOUT ROWID
+        """,
+        """
+        INSERT INTO contadores (chave, valor, referencia) VALUES
+            ('livros', (SELECT COUNT(*) FROM livros), NULL),
+            ('usuarios', (SELECT COUNT(*) FROM usuarios), NULL),
+            ('emprestados', (SELECT COUNT(*) FROM emprestimos WHERE status = 'emprestado'), NULL),
+            ('atrasados', 0, NULL)
+        """,
+        # Livros e usuários: somar/subtrair um a cada linha inserida/apagada
+        """
+        CREATE TRIGGER trg_contadores_livros_insert AFTER INSERT ON livros BEGIN
+            UPDATE contadores SET valor = valor + 1 WHERE chave = 'livros';
+        END
+        """,
+        """
+        CREATE TRIGGER trg_contadores_livros_delete AFTER DELETE ON livros BEGIN
+            UPDATE contadores SET valor = valor - 1 WHERE chave = 'livros';
+        END
+        """,
+        """
+        CREATE TRIGGER trg_contadores_usuarios_insert AFTER INSERT ON usuarios BEGIN
+            UPDATE contadores SET valor = valor + 1 WHERE chave = 'usuarios';
+        END
+        """,
+        """
+        CREATE TRIGGER trg_contadores_usuarios_delete AFTER DELETE ON usuarios BEGIN
+            UPDATE contadores SET valor = valor - 1 WHERE chave = 'usuarios';
+        END
+        """,
+        # Empréstimos: emprestados e atrasados (atrasado = data_prevista antes do dia de referência)
+        """
+        CREATE TRIGGER trg_contadores_emprestimos_insert AFTER INSERT ON emprestimos BEGIN
+            UPDATE contadores SET valor = valor + (NEW.status IS 'emprestado')
+            WHERE chave = 'emprestados';
+            UPDATE contadores SET valor = valor + (NEW.status IS 'emprestado' AND NEW.data_prevista < referencia)
+            WHERE chave = 'atrasados' AND referencia IS NOT NULL;
+        END
+        """,
+        """
+        CREATE TRIGGER trg_contadores_emprestimos_update AFTER UPDATE OF status, data_prevista ON emprestimos BEGIN
+            UPDATE contadores SET valor = valor + (NEW.status IS 'emprestado') - (OLD.status IS 'emprestado')
+            WHERE chave = 'emprestados';
+            UPDATE contadores SET valor = valor
+                + (NEW.status IS 'emprestado' AND NEW.data_prevista < referencia)
+                - (OLD.status IS 'emprestado' AND OLD.data_prevista < referencia)
+            WHERE chave = 'atrasados' AND referencia IS NOT NULL;
+        END
+        """,
+        """
+        CREATE TRIGGER trg_contadores_emprestimos_delete AFTER DELETE ON emprestimos BEGIN
+            UPDATE contadores SET valor = valor - (OLD.status IS 'emprestado')
+            WHERE chave = 'emprestados';
+            UPDATE contadores SET valor = valor - (OLD.status IS 'emprestado' AND OLD.data_prevista < referencia)
+            WHERE chave = 'atrasados' AND referencia IS NOT NULL;
+        END
+        """,
+    ]),
+    (4, "índice de busca textual de livros (FTS5)", [
+        # Índice sem conteúdo próprio (content=''): os dados continuam só na tabela livros.
+        # remove_diacritics faz "capitaes" achar "Capitães"; prefix acelera buscas por prefixo.
+        # O ISBN entra como foi digitado e também só com os dígitos.
+        """
+        CREATE VIRTUAL TABLE livros_busca USING fts5(
+            titulo, autor, isbn,
+            content = '',
+            tokenize = 'unicode61 remove_diacritics 2',
+            prefix = '2 3'
+        )
+        """,
+        """
+        INSERT INTO livros_busca (rowid, titulo, autor, isbn)
+        SELECT id, titulo, autor, COALESCE(isbn, '') || ' ' || REPLACE(COALESCE(isbn, ''), '-', '')
+        FROM livros
+        """,
+        """
+        CREATE TRIGGER trg_livros_busca_insert AFTER INSERT ON livros BEGIN
+            INSERT INTO livros_busca (rowid, titulo, autor, isbn)
+            VALUES (NEW.id, NEW.titulo, NEW.autor,
+                    COALESCE(NEW.isbn, '') || ' ' || REPLACE(COALESCE(NEW.isbn, ''), '-', ''));
+        END
+        """,
+        """
+        CREATE TRIGGER trg_livros_busca_delete AFTER DELETE ON livros BEGIN
+            INSERT INTO livros_busca (livros_busca, rowid, titulo, autor, isbn)
+            VALUES ('delete', OLD.id, OLD.titulo, OLD.autor,
+                    COALESCE(OLD.isbn, '') || ' ' || REPLACE(COALESCE(OLD.isbn, ''), '-', ''));
+        END
+        """,
+        # Só quando muda o texto pesquisável (empréstimos mexem em quantidade e não passam aqui)
+        """
+        CREATE TRIGGER trg_livros_busca_update AFTER UPDATE OF titulo, autor, isbn ON livros BEGIN
+            INSERT INTO livros_busca (livros_busca, rowid, titulo, autor, isbn)
+            VALUES ('delete', OLD.id, OLD.titulo, OLD.autor,
+                    COALESCE(OLD.isbn, '') || ' ' || REPLACE(COALESCE(OLD.isbn, ''), '-', ''));
+            INSERT INTO livros_busca (rowid, titulo, autor, isbn)
+            VALUES (NEW.id, NEW.titulo, NEW.autor,
+                    COALESCE(NEW.isbn, '') || ' ' || REPLACE(COALESCE(NEW.isbn, ''), '-', ''));
+        END
+        """,
+    ]),
+    (5, "índice para autocompletar usuários pelo começo do nome", [
+        # Com COLLATE NOCASE o "nome LIKE 'jo%'" vira uma leitura de faixa no índice
+        "CREATE INDEX IF NOT EXISTS idx_usuarios_nome_nocase ON usuarios (nome COLLATE NOCASE)",
+    ]),
+    (6, "índice para o histórico de empréstimos por período", [
+        "CREATE INDEX IF NOT EXISTS idx_emprestimos_data ON emprestimos (data_emprestimo)",
+    ]),
+    (7, "índice do histórico do aluno por data de devolução", [
+        # Serve o histórico paginado por (data_devolucao, id) e também tudo que o
+        # índice (usuario_id, status) servia, que por isso sai
+        """
+        CREATE INDEX IF NOT EXISTS idx_emprestimos_usuario_status_devolucao
+        ON emprestimos (usuario_id, status, data_devolucao)
+        """,
+        "DROP INDEX IF EXISTS idx_emprestimos_usuario_status",
+    ]),
+    (8, "senhas dos administradores com hash (scrypt/PBKDF2)", [
+        migrar_senhas_para_hash,
+    ]),
+    (9, "versões das tabelas para o cache de páginas de vários processos", [
+        # Cada processo tem o próprio cache; é por aqui que um fica sabendo o que o outro gravou
+        """
+        CREATE TABLE IF NOT EXISTS versoes_cache (
+            tabela TEXT PRIMARY KEY,
+            versao INTEGER NOT NULL
+        ) WITHOUT ROWID
+        """,
+    ]),
+    (10, "atrasos marcados pela varredura diária e fila de notificações", [
+        # atrasado: emprestado e com a data prevista antes do dia da última varredura
+        # dias_atraso: dias de atraso até a última varredura (nos devolvidos, o atraso que tiveram)
+        "ALTER TABLE emprestimos ADD COLUMN atrasado INTEGER NOT NULL DEFAULT 0",
+        "ALTER TABLE emprestimos ADD COLUMN dias_atraso INTEGER NOT NULL DEFAULT 0",
+        """
+        UPDATE emprestimos
+        SET dias_atraso = CAST(julianday(data_devolucao) - julianday(data_prevista) AS INTEGER)
+        WHERE status = 'devolvido' AND data_devolucao > data_prevista
+        """,
+        # Relatório de atrasados ordenado pelos dias (só os atrasados entram no índice)
+        "CREATE INDEX IF NOT EXISTS idx_emprestimos_atrasados ON emprestimos (dias_atraso) WHERE atrasado = 1",
+        # Fila de saída das notificações: a varredura só grava aqui, quem envia é outro passo
+        """
+        CREATE TABLE IF NOT EXISTS notificacoes (
+            id INTEGER PRIMARY KEY,
+            emprestimo_id INTEGER NOT NULL,
+            usuario_id INTEGER NOT NULL,
+            tipo TEXT NOT NULL,
+            dias_atraso INTEGER NOT NULL,
+            criada_em TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pendente',
+            tentativas INTEGER NOT NULL DEFAULT 0,
+            proxima_tentativa TEXT NOT NULL,
+            enviada_em TEXT,
+            erro TEXT,
+            FOREIGN KEY (emprestimo_id) REFERENCES emprestimos(id),
+            FOREIGN KEY (usuario_id) REFERENCES usuarios(id)
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_notificacoes_fila ON notificacoes (status, proxima_tentativa)",
+        "CREATE INDEX IF NOT EXISTS idx_notificacoes_emprestimo ON notificacoes (emprestimo_id, dias_atraso)",
+        # A primeira varredura marca os ativos atrasados
+        "UPDATE contadores SET referencia = NULL WHERE chave = 'atrasados'",
+    ]),
+    (11, "sessões guardadas no servidor", [
+        # chave: hash do id que vai no cookie; dados: a sessão serializada em JSON;
+        # geracao: a geração das sessões quando ela foi gravada (ver encerrar_todas_as_sessoes)
+        """
+        CREATE TABLE IF NOT EXISTS sessoes (
+            chave BLOB PRIMARY KEY,
+            dados BLOB NOT NULL,
+            expira REAL NOT NULL,
+            geracao INTEGER NOT NULL
+        ) WITHOUT ROWID
+        """,
+        # A limpeza apaga as de gerações antigas e, na geração atual, as vencidas
+        "CREATE INDEX IF NOT EXISTS idx_sessoes_geracao_expira ON sessoes (geracao, expira)",
+    ]),
+    (12, "registro das sessões alteradas, para o LRU de cada processo", [
+        # Cada gravação ou remoção de sessão deixa aqui a chave dela; os processos leem só o
+        # que entrou desde a última olhada. AUTOINCREMENT para um id nunca ser reaproveitado.
+        """
+        CREATE TABLE IF NOT EXISTS sessoes_alteradas (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chave BLOB NOT NULL
+        )
+        """,
+    ]),
+    (13, "versão do contexto de cada aluno", [
+        # Quem empresta ou devolve grava aqui uma versão nova para o aluno; pelo índice de
+        # versao cada processo acha só os alunos que mudaram desde a última olhada
+        """
+        CREATE TABLE IF NOT EXISTS versoes_alunos (
+            usuario_id INTEGER PRIMARY KEY,
+            versao INTEGER NOT NULL
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_versoes_alunos_versao ON versoes_alunos (versao)",
+    ]),
+    (14, "marca da limpeza de sessoes_alteradas guardada no banco", [
+        # valor: maior id de sessoes_alteradas na última limpeza (de qualquer processo, ou do
+        # cron); referencia: quando ela foi feita. A limpeza seguinte apaga até esse id.
+        "INSERT OR IGNORE INTO contadores (chave, valor, referencia) VALUES ('sessoes_alteradas', 0, NULL)",
+    ]),
+]
+
+# Função para aplicar as migrações que ainda faltam no banco
+def aplicar_migracoes():
+    banco = conectar_banco()
+    aplicadas = []
+
+    for versao, descricao, passos in MIGRACOES:
+        # BEGIN IMMEDIATE trava a escrita: se outro processo estiver migrando, esperamos ele
+        banco.execute("BEGIN IMMEDIATE")
+        try:
+            versao_atual = banco.execute("PRAGMA user_version").fetchone()[0]
+            if versao <= versao_atual:
+                banco.rollback()
+                continue
+
+            for passo in passos:
+                if callable(passo):
+                    passo(banco)
+                else:
+                    banco.execute(passo)
+            banco.execute(f"PRAGMA user_version = {versao}")
+            banco.commit()
+            aplicadas.append((versao, descricao))
+        except Exception:
+            banco.rollback()
+            banco.close()
+            raise
 
-    banco.commit()
     banco.close()
+    return aplicadas
 
-# Função para criar um admin padrão
-def criar_primeiro_admin():
-    banco = conectar_banco()
-    cursor = banco.cursor()
+# Função para criar as tabelas do banco
+def criar_tabelas_banco():
+    configurar_armazenamento()
+    return aplicar_migracoes()
 
+# Função para gravar o admin padrão se ainda não existir nenhum
+def gravar_primeiro_admin(cursor, senha_hash):
     # Verificar se já existe algum admin
     cursor.execute("SELECT COUNT(*) as total FROM administradores")
     resultado = cursor.fetchone()
-    
+
     if resultado['total'] == 0:
         # Inserir admin padrão se não existir nenhum
         cursor.execute("""
             INSERT INTO administradores (nome, usuario, senha)
-            VALUES ('Administrador Padrão', 'admin', 'admin123')
-        """)
-        banco.commit()
+            VALUES ('Administrador Padrão', 'admin', ?)
+        """, (senha_hash,))
 
+# Função para criar um admin padrão
+# A conferência e o INSERT ficam na mesma transação: vários processos subindo juntos
+# não criam o admin duas vezes
+def criar_primeiro_admin():
+    banco = conectar_banco()
+    executar_escrita(banco, gravar_primeiro_admin, gerar_hash_senha('admin123'))
     banco.close()
 
 # Função para verificar se usuário logado é admin
@@ -121,348 +731,1128 @@ def precisa_ser_admin(funcao):
     funcao_protegida.__name__ = funcao.__name__
     return funcao_protegida
 
-# HTML da página (template básico)
-TEMPLATE_HTML = '''
-<!DOCTYPE html>
-<html lang="pt-br">
-<head>
-    <meta charset="UTF-8">
-    <meta name="viewport" content="width=device-width, initial-scale=1.0">
-    <title>{{ titulo }}</title>
-    <style>
-        /* Estilo básico da página */
-        body {
-            font-family: Arial, sans-serif;
-            background: linear-gradient(45deg, #2196F3, #1976D2);
-            margin: 0;
-            padding: 20px;
-            min-height: 100vh;
-        }
-        
-        .container {
-            max-width: 1200px;
-            margin: 0 auto;
-        }
-        
-        .cabecalho {
-            background: white;
-            padding: 20px;
-            border-radius: 10px;
-            margin-bottom: 20px;
-            box-shadow: 0 2px 10px rgba(0,0,0,0.1);
-            text-align: center;
-            position: relative;
-        }
-        
-        .cabecalho h1 {
-            color: #333;
-            margin: 0;
-            font-size: 2em;
-        }
-        
-        .info-usuario {
-            position: absolute;
-            top: 20px;
-            right: 20px;
-            background: #2196F3;
-            color: white;
-            padding: 10px;
-            border-radius: 5px;
-            font-size: 14px;
-        }
-        
-        .menu {
-            background: white;
-            padding: 15px;
-            border-radius: 10px;
-            margin-bottom: 20px;
-            text-align: center;
-        }
-        
-        .menu a {
-            background: #2196F3;
-            color: white;
-            padding: 10px 20px;
-            text-decoration: none;
-            border-radius: 5px;
-            margin: 5px;
-            display: inline-block;
-            font-weight: bold;
-        }
-        
-        .menu a:hover {
-            background: #1976D2;
-        }
-        
-        .conteudo {
-            background: white;
-            padding: 30px;
-            border-radius: 10px;
-            box-shadow: 0 2px 10px rgba(0,0,0,0.1);
-        }
-        
-        .grupo-formulario {
-            margin-bottom: 15px;
-        }
-        
-        .grupo-formulario label {
-            display: block;
-            margin-bottom: 5px;
-            font-weight: bold;
-        }
-        
-        .grupo-formulario input, .grupo-formulario select {
-            width: 100%;
-            padding: 10px;
-            border: 1px solid #ddd;
-            border-radius: 5px;
-            font-size: 16px;
-            box-sizing: border-box;
-        }
-        
-        .botao {
-            background: #2196F3;
-            color: white;
-            padding: 12px 20px;
-            border: none;
-            border-radius: 5px;
-            cursor: pointer;
-            font-size: 16px;
-            font-weight: bold;
-        }
-        
-        .botao:hover {
-            background: #1976D2;
-        }
-        
-        .tabela {
-            width: 100%;
-            border-collapse: collapse;
-            margin-top: 20px;
-        }
-        
-        .tabela th, .tabela td {
-            padding: 12px;
-            text-align: left;
-            border-bottom: 1px solid #ddd;
-        }
-        
-        .tabela th {
-            background: #2196F3;
-            color: white;
-        }
-        
-        .tabela tr:hover {
-            background: #f5f5f5;
-        }
-        
-        .alerta {
-            padding: 15px;
-            margin-bottom: 20px;
-            border-radius: 5px;
-            background: #d4edda;
-            color: #155724;
-            border: 1px solid #c3e6cb;
-        }
-        
-        .cartoes-estatistica {
-            display: grid;
-            grid-template-columns: repeat(auto-fit, minmax(200px, 1fr));
-            gap: 20px;
-            margin-bottom: 30px;
-        }
-        
-        .cartao {
-            background: linear-gradient(45deg, #2196F3, #1976D2);
-            color: white;
-            padding: 20px;
-            border-radius: 10px;
-            text-align: center;
-        }
-        
-        .numero-grande {
-            font-size: 2em;
-            font-weight: bold;
-        }
-        
-        .formulario-login {
-            max-width: 400px;
-            margin: 50px auto;
-            background: white;
-            padding: 30px;
-            border-radius: 10px;
-            box-shadow: 0 2px 10px rgba(0,0,0,0.1);
-        }
-        
-        .selecionar-tipo-usuario {
-            display: flex;
-            gap: 20px;
-            margin-bottom: 30px;
-        }
-        
-        .opcao-tipo-usuario {
-            background: #f8f9fa;
-            border: 2px solid #ddd;
-            padding: 20px;
-            border-radius: 10px;
-            cursor: pointer;
-            text-align: center;
-            flex: 1;
-        }
-        
-        .opcao-tipo-usuario.selecionado {
-            border-color: #21196F3;
-            background: #e3f2fd;
-        }
-        
-        .opcao-tipo-usuario:hover {
-            border-color: #2196F3;
-        }
-    </style>
-</head>
-<body>
-    <div class="container">
-        {% if session.get('tipo_usuario') %}
-        <div class="cabecalho">
-            <div class="info-usuario">
-                {% if session.get('tipo_usuario') == 'admin' %}
-                    👨‍💼 Admin: {{ session.get('nome_usuario') }}
-                {% else %}
-                    👨‍🎓 Aluno: {{ session.get('matricula_usuario') }}
-                {% endif %}
-                | <a href="/sair" style="color: white;">Sair</a>
-            </div>
-            <h1>📚 Sistema da Biblioteca</h1>
-            <p>Gerenciar livros e empréstimos</p>
-        </div>
-
-        <div class="menu">
-            <a href="/">🏠 Início</a>
-            <a href="/livros">📖 Livros</a>
-            {% if session.get('tipo_usuario') == 'admin' %}
-            <a href="/usuarios">👥 Usuários</a>
-            <a href="/emprestimos">📋 Empréstimos</a>
-            {% else %}
-            <a href="/meus_emprestimos">📋 Meus Empréstimos</a>
-            {% endif %}
-            <a href="/relatorios">📊 Relatórios</a>
-        </div>
-        {% endif %}
-
-        <div class="conteudo">
-            {% with messages = get_flashed_messages() %}
-                {% if messages %}
-                    {% for message in messages %}
-                        <div class="alerta">{{ message }}</div>
-                    {% endfor %}
-                {% endif %}
-            {% endwith %}
-
-            {{ conteudo|safe }}
-        </div>
-    </div>
-</body>
-</html>
-'''
+# Datas ficam no banco como texto AAAA-MM-DD, que ordena e compara certo e usa os índices.
+# Objetos date vão para o banco nesse formato pelo adaptador abaixo. Para mostrar, as listas
+# de empréstimos já trazem a data formatada pela consulta (sql_data_br), em vez de passar
+# cada célula por um filtro no template; o filtro data_br fica para valores soltos.
+sqlite3.register_adapter(date, date.isoformat)
+
+# Função para montar a expressão SQL que mostra uma coluna de data no formato DD/MM/AAAA
+def sql_data_br(coluna):
+    return f"strftime('%d/%m/%Y', {coluna})"
+
+# Função de template para mostrar datas do banco (AAAA-MM-DD) no formato DD/MM/AAAA
+@app.template_filter('data_br')
+def formatar_data_br(valor):
+    if not valor:
+        return ''
+    return f"{valor[8:10]}/{valor[5:7]}/{valor[0:4]}"
+
+# Estatísticas do painel guardadas na tabela contadores
+CHAVES_CONTADORES = ('livros', 'usuarios', 'emprestados', 'atrasados')
+
+# Função para ler todas as estatísticas do painel de uma vez
+# Os contadores são mantidos pelos triggers; os atrasados são contados pela varredura do dia,
+# que roda aqui se ainda não rodou hoje (ex: primeira página depois da meia-noite)
+def obter_contadores(banco):
+    hoje = date.today().isoformat()
+    consulta = f"SELECT chave, valor, referencia FROM contadores WHERE chave IN ({', '.join('?' * len(CHAVES_CONTADORES))})"
+    linhas = banco.execute(consulta, CHAVES_CONTADORES).fetchall()
+
+    if any(linha['chave'] == 'atrasados' and linha['referencia'] != hoje for linha in linhas):
+        executar_varredura()
+        linhas = banco.execute(consulta, CHAVES_CONTADORES).fetchall()
+
+    return {linha['chave']: linha['valor'] for linha in linhas}
+
+# Atrasos: uma varredura por dia marca os empréstimos atrasados (colunas atrasado e
+# dias_atraso) com um UPDATE só, pelo índice (status, data_prevista), e põe os avisos na
+# fila de saída (tabela notificacoes). As páginas só leem as marcações.
+# Um aviso sai quando o empréstimo atrasa e depois a cada `intervalo_lembrete_dias` dias.
+# Quem tira os avisos da fila é enviar_notificacoes(), com o enviador configurado (ver
+# ENVIADORES_NOTIFICACAO); quem falha é tentado de novo mais tarde, até `maximo_tentativas`.
+# O agendador (uma thread) roda a varredura na virada do dia e o envio de tempos em tempos.
+CONFIGURACAO_NOTIFICACOES = {
+    'agendador': os.environ.get('BIBLIOTECA_AGENDADOR', '1') != '0',
+    'enviador': os.environ.get('BIBLIOTECA_ENVIADOR', 'log'),
+    'arquivo': os.environ.get('BIBLIOTECA_NOTIFICACOES_ARQUIVO', 'notificacoes.jsonl'),
+    'intervalo_lembrete_dias': 7,
+    'segundos_entre_envios': int(os.environ.get('BIBLIOTECA_SEGUNDOS_ENTRE_ENVIOS', '60')),
+    'lote_envio': 100,
+    'maximo_tentativas': 5,
+    'segundos_reserva': 300,  # aviso reservado há mais tempo que isso volta para a fila
+}
+
+# Função para escrever data e hora como texto (o formato das colunas de notificacoes)
+def texto_data_hora(momento):
+    return momento.strftime('%Y-%m-%d %H:%M:%S')
+
+# Função que faz a varredura do dia (usada dentro de executar_escrita)
+# Devolve None se a varredura de hoje já foi feita (e não foi pedido para forçar)
+def varrer_atrasados(cursor, hoje, forcar=False):
+    referencia = cursor.execute("SELECT referencia FROM contadores WHERE chave = 'atrasados'").fetchone()
+    if referencia and referencia['referencia'] == hoje and not forcar:
+        return None
+
+    # Os que deixaram de estar atrasados (devolvidos por fora, prazo mudado)
+    cursor.execute("""
+        UPDATE emprestimos SET atrasado = 0
+        WHERE atrasado = 1 AND (status != 'emprestado' OR data_prevista >= ?)
+    """, (hoje,))
+    desmarcados = cursor.rowcount
+
+    cursor.execute("""
+        UPDATE emprestimos
+        SET atrasado = 1, dias_atraso = CAST(julianday(?) - julianday(data_prevista) AS INTEGER)
+        WHERE status = 'emprestado' AND data_prevista < ?
+    """, (hoje, hoje))
+    atrasados = cursor.rowcount
+
+    agora = texto_data_hora(datetime.now())
+    cursor.execute("""
+        INSERT INTO notificacoes (emprestimo_id, usuario_id, tipo, dias_atraso, criada_em, proxima_tentativa)
+        SELECT e.id, e.usuario_id, 'atraso', e.dias_atraso, ?, ?
+        FROM emprestimos e
+        WHERE e.atrasado = 1 AND NOT EXISTS (
+            SELECT 1 FROM notificacoes n
+            WHERE n.emprestimo_id = e.id AND n.dias_atraso > e.dias_atraso - ?
+        )
+    """, (agora, agora, CONFIGURACAO_NOTIFICACOES['intervalo_lembrete_dias']))
+    avisos = cursor.rowcount
+
+    cursor.execute("UPDATE contadores SET valor = ?, referencia = ? WHERE chave = 'atrasados'", (atrasados, hoje))
+    return {'dia': hoje, 'atrasados': atrasados, 'desmarcados': desmarcados, 'avisos': avisos}
+
+# Função para rodar a varredura (se ainda não rodou hoje, ou sempre com forcar=True)
+def executar_varredura(forcar=False):
+    banco = conectar_banco()
+    try:
+        resumo = executar_escrita(banco, varrer_atrasados, date.today().isoformat(), forcar)
+    finally:
+        banco.close()
+    if resumo is not None:
+        invalidar_cache('emprestimos', 'contextos_alunos')
+    return resumo
+
+# Enviadores de avisos: recebem o aviso (dicionário com 'mensagem', 'matricula', etc.) e
+# levantam exceção se não conseguirem enviar. Para ligar outro (e-mail, SMS...), basta
+# colocar a função aqui e escolher pelo nome em BIBLIOTECA_ENVIADOR.
+trava_arquivo_notificacoes = threading.Lock()
+avisos_em_memoria = []
+
+# Enviador que só mostra o aviso no terminal
+def enviar_por_log(aviso):
+    print(f"[aviso] {aviso['mensagem']}", flush=True)
+
+# Enviador que grava cada aviso numa linha JSON de um arquivo
+def enviar_para_arquivo(aviso):
+    with trava_arquivo_notificacoes:
+        with open(CONFIGURACAO_NOTIFICACOES['arquivo'], 'a', encoding='utf-8') as arquivo:
+            arquivo.write(json.dumps(aviso, ensure_ascii=False) + '\n')
+
+# Enviador que guarda os avisos numa lista (para conferir em testes)
+def enviar_para_memoria(aviso):
+    avisos_em_memoria.append(aviso)
+
+ENVIADORES_NOTIFICACAO = {
+    'log': enviar_por_log,
+    'arquivo': enviar_para_arquivo,
+    'memoria': enviar_para_memoria,
+}
+
+# Função para reservar um lote de avisos da fila (usada dentro de executar_escrita)
+# O aviso reservado fica 'enviando' até o resultado ser gravado; se o processo morrer no
+# meio, a reserva vence e outro processo pega o aviso de novo
+def reservar_notificacoes(cursor, limite):
+    agora = datetime.now()
+    linhas = cursor.execute("""
+        SELECT n.id, n.tipo, n.dias_atraso, n.tentativas, n.criada_em,
+               e.status AS situacao_emprestimo, e.data_prevista, u.nome, u.matricula, l.titulo
+        FROM notificacoes n
+        JOIN emprestimos e ON e.id = n.emprestimo_id
+        JOIN usuarios u ON u.id = n.usuario_id
+        JOIN livros l ON l.id = e.livro_id
+        WHERE n.status IN ('pendente', 'enviando') AND n.proxima_tentativa <= ?
+        ORDER BY n.id
+        LIMIT ?
+    """, (texto_data_hora(agora), limite)).fetchall()
+    vencimento = texto_data_hora(agora + timedelta(seconds=CONFIGURACAO_NOTIFICACOES['segundos_reserva']))
+    cursor.executemany("UPDATE notificacoes SET status = 'enviando', proxima_tentativa = ? WHERE id = ?",
+                       [(vencimento, linha['id']) for linha in linhas])
+    return linhas
+
+# Função para gravar o resultado dos envios (usada dentro de executar_escrita)
+def registrar_envios(cursor, resultados):
+    agora = datetime.now()
+    for notificacao_id, tentativas, erro in resultados:
+        if erro is None:
+            cursor.execute("""
+                UPDATE notificacoes SET status = 'enviada', enviada_em = ?, tentativas = ?, erro = NULL
+                WHERE id = ?
+            """, (texto_data_hora(agora), tentativas, notificacao_id))
+        elif erro == 'cancelada':
+            cursor.execute("UPDATE notificacoes SET status = 'cancelada' WHERE id = ?", (notificacao_id,))
+        else:
+            # Esperar cada vez mais entre as tentativas (1, 2, 4, 8... minutos)
+            status = 'falhou' if tentativas >= CONFIGURACAO_NOTIFICACOES['maximo_tentativas'] else 'pendente'
+            proxima = texto_data_hora(agora + timedelta(minutes=2 ** (tentativas - 1)))
+            cursor.execute("""
+                UPDATE notificacoes SET status = ?, tentativas = ?, erro = ?, proxima_tentativa = ?
+                WHERE id = ?
+            """, (status, tentativas, erro, proxima, notificacao_id))
+
+# Função para esvaziar a fila de avisos com o enviador configurado
+def enviar_notificacoes():
+    enviador = ENVIADORES_NOTIFICACAO[CONFIGURACAO_NOTIFICACOES['enviador']]
+    resumo = {'enviadas': 0, 'falhas': 0, 'canceladas': 0}
+    banco = conectar_banco()
+    try:
+        while True:
+            avisos = executar_escrita(banco, reservar_notificacoes, CONFIGURACAO_NOTIFICACOES['lote_envio'])
+            if not avisos:
+                break
+            resultados = []
+            for aviso in avisos:
+                # Devolvido depois que o aviso entrou na fila: não precisa mais avisar
+                if aviso['situacao_emprestimo'] != 'emprestado':
+                    resultados.append((aviso['id'], aviso['tentativas'], 'cancelada'))
+                    resumo['canceladas'] += 1
+                    continue
+                dados = dict(aviso)
+                dados['mensagem'] = (f"{aviso['nome']} ({aviso['matricula']}): o livro '{aviso['titulo']}' "
+                                     f"está {aviso['dias_atraso']} dia(s) atrasado "
+                                     f"(devolução prevista em {formatar_data_br(aviso['data_prevista'])})")
+                try:
+                    enviador(dados)
+                    resultados.append((aviso['id'], aviso['tentativas'] + 1, None))
+                    resumo['enviadas'] += 1
+                except Exception as erro:
+                    resultados.append((aviso['id'], aviso['tentativas'] + 1, str(erro) or type(erro).__name__))
+                    resumo['falhas'] += 1
+            executar_escrita(banco, registrar_envios, resultados)
+    finally:
+        banco.close()
+    return resumo
+
+# Função para ver quantos avisos há em cada situação
+def obter_estatisticas_notificacoes():
+    banco = conectar_banco()
+    linhas = banco.execute("SELECT status, COUNT(*) AS total FROM notificacoes GROUP BY status").fetchall()
+    banco.close()
+    return {linha['status']: linha['total'] for linha in linhas}
+
+# Agendador: uma thread que acorda a cada `segundos_entre_envios` (e na virada do dia),
+# faz a varredura se o dia mudou e envia o que estiver na fila. Rodar em vários processos
+# ao mesmo tempo não tem problema: a varredura é uma por dia e cada aviso é reservado
+# por um só processo.
+agendador = None
+acordar_agendador = threading.Event()
+parada_agendador = threading.Event()
+
+# Função para saber quantos segundos faltam para a meia-noite
+def segundos_ate_amanha():
+    agora = datetime.now()
+    amanha = datetime.combine(agora.date() + timedelta(days=1), datetime.min.time())
+    return (amanha - agora).total_seconds()
+
+# Laço da thread do agendador
+def rodar_agendador():
+    while not parada_agendador.is_set():
+        try:
+            executar_varredura()
+            enviar_notificacoes()
+            limpar_sessoes_vencidas()
+        except Exception:
+            traceback.print_exc()
+        espera = min(CONFIGURACAO_NOTIFICACOES['segundos_entre_envios'], segundos_ate_amanha() + 1)
+        acordar_agendador.wait(espera)
+        acordar_agendador.clear()
+
+# Função para iniciar o agendador (se estiver ligado na configuração e ainda não estiver rodando)
+def iniciar_agendador():
+    global agendador
+    if not CONFIGURACAO_NOTIFICACOES['agendador'] or (agendador is not None and agendador.is_alive()):
+        return
+    parada_agendador.clear()
+    agendador = threading.Thread(target=rodar_agendador, name='agendador-atrasos', daemon=True)
+    agendador.start()
+
+# Função para parar o agendador (espera a rodada atual terminar)
+def parar_agendador():
+    global agendador
+    if agendador is None:
+        return
+    parada_agendador.set()
+    acordar_agendador.set()
+    agendador.join()
+    agendador = None
+
+# Cache das páginas mais lidas (lista de livros, busca, relatórios, painel)
+# Guarda o miolo já renderizado (os blocos titulo e conteudo do template) por rota + tipo de
+# usuário; o resto da página (cabeçalho com o nome, mensagens) é montado a cada requisição
+# por cima do miolo guardado, que é barato. Cada entrada lembra de quais tabelas depende e
+# a versão delas quando foi montada: quem grava numa tabela chama invalidar_cache(tabela),
+# que só aumenta a versão, e as entradas antigas deixam de valer na hora.
+CONFIGURACAO_CACHE = {
+    'ativo': os.environ.get('BIBLIOTECA_CACHE', '1') != '0',
+    'maximo_entradas': int(os.environ.get('BIBLIOTECA_CACHE_ENTRADAS', '500')),
+    'segundos': int(os.environ.get('BIBLIOTECA_CACHE_SEGUNDOS', '300')),
+}
+
+cache_paginas = OrderedDict()
+trava_cache = threading.Lock()
+versoes_tabelas = {}
+estatisticas_cache = {'acertos': 0, 'faltas': 0, 'nao_modificadas': 0, 'expiradas': 0,
+                      'invalidadas': 0, 'despejadas': 0}
+estatisticas_cache_rotas = {}
+
+# As versões ficam no banco (tabela versoes_cache), para valer entre processos: com vários
+# processos servindo, quem grava aumenta a versão lá e os outros veem na próxima página.
+# Uma conexão só para vigiar: o PRAGMA data_version dela só muda quando alguma outra conexão
+# grava no banco, então na maioria das páginas a tabela nem precisa ser lida.
+conexao_versoes = None
+data_version_visto = None
+trava_versoes = threading.Lock()
+
+# Função para trazer para a memória as versões gravadas no banco (por este ou outro processo)
+def sincronizar_versoes():
+    global conexao_versoes, data_version_visto
+    with trava_versoes:
+        if conexao_versoes is None:
+            # Conexão comum, fora do pool e da instrumentação
+            conexao_versoes = sqlite3.connect(CAMINHO_BANCO, check_same_thread=False,
+                                              timeout=CONFIGURACAO_ARMAZENAMENTO['busy_timeout_ms'] / 1000)
+            data_version_visto = None
+        versao_banco = conexao_versoes.execute("PRAGMA data_version").fetchone()[0]
+        if versao_banco == data_version_visto:
+            return
+        linhas = conexao_versoes.execute("SELECT tabela, versao FROM versoes_cache").fetchall()
+        data_version_visto = versao_banco
+    with trava_cache:
+        versoes_tabelas.update(linhas)
+
+# Função para fechar a conexão que vigia as versões (ex: ao trocar de banco)
+def fechar_vigia_versoes():
+    global conexao_versoes, data_version_visto
+    with trava_versoes:
+        if conexao_versoes is not None:
+            conexao_versoes.close()
+        conexao_versoes = None
+        data_version_visto = None
+
+# Função para aumentar a versão das tabelas no banco
+def gravar_versoes(cursor, tabelas):
+    cursor.executemany("""
+        INSERT INTO versoes_cache (tabela, versao) VALUES (?, 1)
+        ON CONFLICT (tabela) DO UPDATE SET versao = versao + 1
+    """, [(tabela,) for tabela in tabelas])
+
+# Função para avisar o cache que uma ou mais tabelas mudaram (chamar depois do commit)
+def invalidar_cache(*tabelas):
+    banco = conectar_banco()
+    try:
+        executar_escrita(banco, gravar_versoes, tabelas)
+    except sqlite3.OperationalError:
+        # Sem conseguir avisar os outros processos, pelo menos este não mostra página velha
+        # (nos outros ela dura no máximo CONFIGURACAO_CACHE['segundos'])
+        limpar_cache()
+    finally:
+        banco.close()
+    sincronizar_versoes()
+
+# Função para esvaziar o cache inteiro
+def limpar_cache():
+    with trava_cache:
+        cache_paginas.clear()
+
+# Função para ver como o cache está sendo usado (total e por rota)
+def obter_estatisticas_cache():
+    with trava_cache:
+        dados = dict(estatisticas_cache)
+        dados['entradas'] = len(cache_paginas)
+        por_rota = {rota: dict(numeros) for rota, numeros in estatisticas_cache_rotas.items()}
+    total = dados['acertos'] + dados['faltas']
+    dados['taxa_acerto'] = round(dados['acertos'] / total, 4) if total else 0.0
+    for numeros in por_rota.values():
+        total_rota = numeros['acertos'] + numeros['faltas']
+        numeros['taxa_acerto'] = round(numeros['acertos'] / total_rota, 4) if total_rota else 0.0
+    dados['rotas'] = por_rota
+    return dados
+
+# Função para contar acerto/falta no total e na rota
+def contar_no_cache(rota, tipo):
+    estatisticas_cache[tipo] += 1
+    numeros = estatisticas_cache_rotas.setdefault(rota, {'acertos': 0, 'faltas': 0})
+    numeros[tipo] += 1
+
+# Função para buscar uma entrada ainda válida (vencida ou com tabela alterada sai do cache)
+def buscar_no_cache(chave):
+    sincronizar_versoes()
+    with trava_cache:
+        entrada = cache_paginas.get(chave)
+        if entrada is None:
+            return None
+        if time.monotonic() - entrada['criada'] > CONFIGURACAO_CACHE['segundos']:
+            del cache_paginas[chave]
+            estatisticas_cache['expiradas'] += 1
+            return None
+        if any(versoes_tabelas.get(tabela, 0) != versao for tabela, versao in entrada['versoes'].items()):
+            del cache_paginas[chave]
+            estatisticas_cache['invalidadas'] += 1
+            return None
+        cache_paginas.move_to_end(chave)
+        return entrada
+
+# Função para guardar uma entrada, tirando as usadas há mais tempo se passar do limite
+# Se alguma tabela mudou enquanto a página era montada, ela já nasceu velha e não é guardada
+def guardar_no_cache(chave, entrada):
+    sincronizar_versoes()
+    with trava_cache:
+        if any(versoes_tabelas.get(tabela, 0) != versao for tabela, versao in entrada['versoes'].items()):
+            return
+        cache_paginas[chave] = entrada
+        cache_paginas.move_to_end(chave)
+        while len(cache_paginas) > CONFIGURACAO_CACHE['maximo_entradas']:
+            cache_paginas.popitem(last=False)
+            estatisticas_cache['despejadas'] += 1
+
+# Função para montar a página final: o miolo guardado dentro do layout do usuário atual
+def montar_pagina_do_cache(entrada):
+    return Response(render_template("pagina_em_cache.html",
+                                    titulo_pagina=entrada['titulo'],
+                                    conteudo_pagina=entrada['conteudo']))
+
+# ETag da página: muda quando o miolo muda ou quando muda o que o layout mostra do usuário
+def etag_da_pagina(entrada):
+    partes = (entrada['etag'], session.get('tipo_usuario'), session.get('nome_usuario'),
+              session.get('matricula_usuario'))
+    return hashlib.sha1(repr(partes).encode('utf-8')).hexdigest()[:20]
+
+# Função para renderizar uma página; dentro de uma rota com guardar_em_cache o miolo é
+# renderizado separado e guardado. Os blocos são renderizados sozinhos, então macros usadas
+# no conteudo precisam estar definidas dentro do bloco.
+def renderizar_pagina(nome_template, **contexto):
+    pedido = g.get('pedido_cache')
+    if pedido is None:
+        return render_template(nome_template, **contexto)
+
+    app.update_template_context(contexto)
+    template = app.jinja_env.get_template(nome_template)
+    # Os mesmos sinais que o render_template manda (a instrumentação mede o template por eles)
+    before_render_template.send(app, template=template, context=contexto)
+    blocos = template.new_context(contexto)
+    titulo = ''.join(template.blocks['titulo'](blocos)) if 'titulo' in template.blocks else None
+    conteudo = ''.join(template.blocks['conteudo'](blocos))
+    template_rendered.send(app, template=template, context=contexto)
+    entrada = {
+        'titulo': titulo,
+        'conteudo': conteudo,
+        'etag': hashlib.sha1(conteudo.encode('utf-8')).hexdigest(),
+        'criada': time.monotonic(),
+        'versoes': pedido['versoes'],
+    }
+    guardar_no_cache(pedido['chave'], entrada)
+    g.entrada_cache = entrada
+    return montar_pagina_do_cache(entrada)
+
+# Função decoradora que liga o cache numa rota
+# tabelas: de quais tabelas a página depende; por_usuario: o conteúdo muda de um usuário
+# para outro (senão é o mesmo para todos do mesmo tipo). O dia entra na chave porque
+# as marcações de atraso mudam na virada do dia.
+def guardar_em_cache(*tabelas, por_usuario=False):
+    def decorador(funcao):
+        def funcao_com_cache(*args, **kwargs):
+            if not CONFIGURACAO_CACHE['ativo'] or 'tipo_usuario' not in session:
+                return funcao(*args, **kwargs)
+
+            rota = request.endpoint
+            # As mensagens são mostradas (e consumidas) pelo layout, então precisam ser vistas antes
+            tem_mensagens = '_flashes' in session
+            chave = (request.full_path, session['tipo_usuario'],
+                     session.get('usuario_id') if por_usuario else None, date.today().isoformat())
+
+            entrada = buscar_no_cache(chave)
+            if entrada is None:
+                with trava_cache:
+                    contar_no_cache(rota, 'faltas')
+                    versoes = {tabela: versoes_tabelas.get(tabela, 0) for tabela in tabelas}
+                g.pedido_cache = {'chave': chave, 'versoes': versoes}
+                resposta = funcao(*args, **kwargs)
+                g.pedido_cache = None
+                entrada = g.pop('entrada_cache', None)
+                if entrada is None:
+                    # A rota não renderizou página (redirecionou, transmitiu, JSON...)
+                    return resposta
+            else:
+                with trava_cache:
+                    contar_no_cache(rota, 'acertos')
+                resposta = None
+
+            # Com mensagens esperando para aparecer a página é diferente: sem ETag
+            if tem_mensagens:
+                return resposta or montar_pagina_do_cache(entrada)
+
+            etag = etag_da_pagina(entrada)
+            if request.if_none_match.contains(etag):
+                with trava_cache:
+                    estatisticas_cache['nao_modificadas'] += 1
+                resposta = Response(status=304)
+            elif resposta is None:
+                resposta = montar_pagina_do_cache(entrada)
+            resposta.set_etag(etag)
+            # Cada usuário vê o próprio nome na página: só o navegador pode guardar, e sempre confirmando
+            resposta.headers['Cache-Control'] = 'private, no-cache'
+            return resposta
+        funcao_com_cache.__name__ = funcao.__name__
+        return funcao_com_cache
+    return decorador
+
+# Contexto do aluno: os empréstimos ativos de cada aluno (no máximo LIMITE_EMPRESTIMOS linhas,
+# já com título, autor e datas formatadas), guardados na memória pelo usuario_id da sessão.
+# O painel e /meus_emprestimos leem daqui em vez de perguntar ao banco a cada página; assim
+# /meus_emprestimos só consulta o histórico. Cada aluno tem a sua versão (tabela
+# versoes_alunos): quem empresta ou devolve chama marcar_emprestimos_alterados() na própria
+# transação, que aumenta a versão só dos alunos envolvidos, e depois do commit
+# atualizar_caches_emprestimos(), que monta de novo o contexto deles na hora. Quando o banco
+# muda (PRAGMA data_version), cada processo lê só os alunos com versão nova e descarta o
+# contexto só deles; o empréstimo de um aluno não derruba o contexto dos outros. O que muda
+# muitos alunos de uma vez (varredura de atrasos, importação, gerador de dados) aumenta a
+# versão 'contextos_alunos' de versoes_cache, que vale para todos.
+CONFIGURACAO_CONTEXTO_ALUNO = {
+    'ativo': os.environ.get('BIBLIOTECA_CONTEXTO_ALUNO', '1') != '0',
+    'maximo_entradas': int(os.environ.get('BIBLIOTECA_CONTEXTO_ALUNO_ENTRADAS', '5000')),
+    'segundos': int(os.environ.get('BIBLIOTECA_CONTEXTO_ALUNO_SEGUNDOS', '300')),
+}
+
+contextos_alunos = OrderedDict()
+trava_contextos = threading.Lock()
+data_version_contextos = None
+ultima_versao_aluno_vista = None  # maior versao de versoes_alunos já olhada
+estatisticas_contextos = {'acertos': 0, 'faltas': 0, 'expirados': 0, 'invalidados': 0,
+                          'atualizados': 0, 'despejados': 0}
+
+# Função para tirar da memória os contextos dos alunos com versão nova (gravada por este ou
+# outro processo); devolve o data_version com que os contextos ficaram em dia
+def sincronizar_contextos_alunos():
+    global data_version_contextos, ultima_versao_aluno_vista
+    sincronizar_versoes()
+    with trava_contextos:
+        versao = data_version_visto
+        if versao == data_version_contextos:
+            return versao
+        desde = ultima_versao_aluno_vista
+
+    banco = conectar_banco()
+    if desde is None:
+        alterados = []
+        ultima = banco.execute("SELECT MAX(versao) FROM versoes_alunos").fetchone()[0] or 0
+    else:
+        alterados = banco.execute("SELECT usuario_id, versao FROM versoes_alunos WHERE versao > ?",
+                                  (desde,)).fetchall()
+        ultima = max([desde] + [alterado['versao'] for alterado in alterados])
+    banco.close()
+
+    with trava_contextos:
+        if desde is None:
+            contextos_alunos.clear()
+        for alterado in alterados:
+            if contextos_alunos.pop(alterado['usuario_id'], None) is not None:
+                estatisticas_contextos['invalidados'] += 1
+        if ultima_versao_aluno_vista is None or ultima > ultima_versao_aluno_vista:
+            ultima_versao_aluno_vista = ultima
+        data_version_contextos = versao
+    return versao
+
+# Função para montar o contexto de um aluno com uma consulta só (pelo índice de usuario_id)
+def montar_contexto_aluno(banco, usuario_id):
+    data_version = sincronizar_contextos_alunos()
+    with trava_cache:
+        versao_global = versoes_tabelas.get('contextos_alunos', 0)
+    emprestimos = [dict(linha) for linha in banco.execute(f"""
+        SELECT e.id, e.livro_id, e.data_emprestimo, e.data_prevista, e.atrasado, e.dias_atraso,
+               l.titulo as livro_titulo, l.autor,
+               {sql_data_br('e.data_emprestimo')} AS data_emprestimo_br,
+               {sql_data_br('e.data_prevista')} AS data_prevista_br
+        FROM emprestimos e
+        JOIN livros l ON e.livro_id = l.id
+        WHERE e.usuario_id = ? AND e.status = 'emprestado'
+        ORDER BY e.data_emprestimo DESC
+    """, (usuario_id,))]
+    return {
+        'usuario_id': usuario_id,
+        'emprestimos': emprestimos,
+        'quantidade': len(emprestimos),
+        'vagas': max(LIMITE_EMPRESTIMOS - len(emprestimos), 0),
+        'versao_global': versao_global,
+        'data_version': data_version,
+        'criado': time.monotonic(),
+    }
+
+# Função para conferir se nada que vale para todos os alunos mudou depois que o contexto foi montado
+def contexto_em_dia(contexto):
+    return versoes_tabelas.get('contextos_alunos', 0) == contexto['versao_global']
+
+# Função para guardar um contexto (se outra thread já descartou alterações enquanto ele era
+# montado, ele pode já ter nascido velho e não é guardado; se não, uma versão nova do aluno
+# que chegue depois ainda o tira da memória)
+def guardar_contexto_aluno(contexto):
+    sincronizar_versoes()
+    with trava_contextos:
+        if data_version_contextos != contexto['data_version'] or not contexto_em_dia(contexto):
+            return
+        contextos_alunos[contexto['usuario_id']] = contexto
+        contextos_alunos.move_to_end(contexto['usuario_id'])
+        while len(contextos_alunos) > CONFIGURACAO_CONTEXTO_ALUNO['maximo_entradas']:
+            contextos_alunos.popitem(last=False)
+            estatisticas_contextos['despejados'] += 1
+
+# Função para pegar o contexto do aluno (da memória, ou montando com uma consulta)
+def obter_contexto_aluno(banco, usuario_id):
+    if not CONFIGURACAO_CONTEXTO_ALUNO['ativo']:
+        return montar_contexto_aluno(banco, usuario_id)
+
+    sincronizar_contextos_alunos()
+    with trava_contextos:
+        contexto = contextos_alunos.get(usuario_id)
+        if contexto is not None:
+            if time.monotonic() - contexto['criado'] > CONFIGURACAO_CONTEXTO_ALUNO['segundos']:
+                estatisticas_contextos['expirados'] += 1
+                contexto = None
+            elif not contexto_em_dia(contexto):
+                estatisticas_contextos['invalidados'] += 1
+                contexto = None
+            else:
+                contextos_alunos.move_to_end(usuario_id)
+                estatisticas_contextos['acertos'] += 1
+                return contexto
+        estatisticas_contextos['faltas'] += 1
+
+    contexto = montar_contexto_aluno(banco, usuario_id)
+    guardar_contexto_aluno(contexto)
+    return contexto
+
+# Função para juntar ids vindos de formulário ou JSON (o que não for número fica de fora)
+def ids_inteiros(valores):
+    ids = set()
+    for valor in valores:
+        try:
+            ids.add(int(valor))
+        except (TypeError, ValueError):
+            pass
+    return ids
+
+# Função que aumenta a versão dos alunos (usada dentro de executar_escrita); nas devoluções o
+# aluno é achado pelo id do empréstimo. Todos os alunos da mesma gravação ficam com a mesma
+# versão, uma a mais que a maior que já existe.
+def gravar_versoes_alunos(cursor, usuarios, emprestimos):
+    usuarios = set(usuarios)
+    for emprestimo_id in emprestimos:
+        linha = cursor.execute("SELECT usuario_id FROM emprestimos WHERE id = ?", (emprestimo_id,)).fetchone()
+        if linha is not None:
+            usuarios.add(linha[0])
+    if not usuarios:
+        return usuarios
+    versao = cursor.execute("SELECT COALESCE(MAX(versao), 0) + 1 FROM versoes_alunos").fetchone()[0]
+    cursor.executemany("""
+        INSERT INTO versoes_alunos (usuario_id, versao) VALUES (?, ?)
+        ON CONFLICT (usuario_id) DO UPDATE SET versao = excluded.versao
+    """, [(usuario_id, versao) for usuario_id in usuarios])
+    return usuarios
+
+# Função que marca, na mesma transação que mudou empréstimos (usada dentro da função passada a
+# executar_escrita), a versão nova de livros e emprestimos (cache de páginas) e a dos alunos
+# envolvidos (contexto do aluno). Se a transação for desfeita, as versões voltam junto.
+def marcar_emprestimos_alterados(cursor, usuarios=(), emprestimos=()):
+    gravar_versoes(cursor, ('livros', 'emprestimos'))
+    return gravar_versoes_alunos(cursor, ids_inteiros(usuarios), ids_inteiros(emprestimos))
+
+# Função chamada depois do commit de marcar_emprestimos_alterados: traz as versões novas para
+# este processo e monta de novo o contexto dos alunos que saíram da memória por causa delas
+def atualizar_caches_emprestimos():
+    sincronizar_versoes()
+    if not CONFIGURACAO_CONTEXTO_ALUNO['ativo']:
+        return
+    with trava_contextos:
+        antes = set(contextos_alunos)
+    sincronizar_contextos_alunos()
+    with trava_contextos:
+        afetados = antes.difference(contextos_alunos)
+    if not afetados:
+        return
+    banco = conectar_banco()
+    try:
+        for usuario_id in afetados:
+            guardar_contexto_aluno(montar_contexto_aluno(banco, usuario_id))
+    finally:
+        banco.close()
+    with trava_contextos:
+        estatisticas_contextos['atualizados'] += len(afetados)
+
+# Função para esquecer o contexto de um aluno (ao sair do sistema)
+def esquecer_contexto_aluno(usuario_id):
+    with trava_contextos:
+        contextos_alunos.pop(usuario_id, None)
+
+# Função para ver como os contextos estão sendo usados
+def obter_estatisticas_contextos():
+    with trava_contextos:
+        dados = dict(estatisticas_contextos)
+        dados['entradas'] = len(contextos_alunos)
+    total = dados['acertos'] + dados['faltas']
+    dados['taxa_acerto'] = round(dados['acertos'] / total, 4) if total else 0.0
+    return dados
+
+# Sessões no servidor: o cookie só leva um id aleatório; quem entrou fica na tabela sessoes,
+# em JSON com as marcas de tipo do Flask (o mesmo serializador da sessão no cookie, então
+# datas, tuplas e bytes voltam como eram), e no banco vai o hash do id, não o id.
+# As mensagens do flash() não vão para o banco: ficam num segundo cookie assinado, que só
+# dura até serem mostradas. Assim o POST que só avisa "Livro cadastrado!" e o GET que mostra
+# o aviso não gravam nada na tabela sessoes (e não disputam a escrita com os empréstimos).
+# A sessão só é lida quando a rota usa e só é gravada quando muda, ou quando falta menos da
+# metade do prazo para ela vencer. Na frente da tabela fica um LRU com os bytes das sessões
+# lidas. Toda gravação deixa a chave da sessão em sessoes_alteradas; quando o banco muda (o
+# mesmo PRAGMA data_version que o cache de páginas vigia) o processo lê só as chaves novas
+# dali e tira do LRU só essas sessões: um processo nunca usa uma sessão que outro alterou ou
+# apagou, e as outras continuam na memória.
+# "Sair de todos os lugares": cada sessão guarda a geração em que foi criada e é sempre
+# regravada com essa mesma geração; encerrar_todas_as_sessoes() só aumenta a geração (uma
+# linha de versoes_cache, qualquer que seja o número de sessões) e as de gerações antigas
+# deixam de valer na hora, mesmo as que estavam no meio de uma requisição. As linhas delas e
+# as vencidas são apagadas pelo agendador de tempos em tempos.
+# Com BIBLIOTECA_SESSOES=cookie volta a sessão assinada no cookie, padrão do Flask.
+CONFIGURACAO_SESSOES = {
+    'armazem': os.environ.get('BIBLIOTECA_SESSOES', 'banco'),
+    'segundos': int(os.environ.get('BIBLIOTECA_SESSAO_SEGUNDOS', str(8 * 3600))),
+    'maximo_em_memoria': int(os.environ.get('BIBLIOTECA_SESSOES_EM_MEMORIA', '10000')),
+    'segundos_entre_limpezas': 600,
+}
+
+sessoes_em_memoria = OrderedDict()  # hash do id -> (dados, expira, geracao)
+trava_sessoes = threading.Lock()
+data_version_sessoes = None
+ultima_alteracao_vista = None  # maior id de sessoes_alteradas já tirado do LRU
+ultima_limpeza_sessoes = 0.0
+estatisticas_sessoes = {'lidas_memoria': 0, 'lidas_banco': 0, 'nao_encontradas': 0, 'vencidas': 0,
+                        'gravadas': 0, 'apagadas': 0, 'limpas': 0}
+
+# Função para calcular a chave da sessão no banco a partir do id do cookie
+def chave_sessao(sid):
+    return hashlib.sha256(sid.encode('utf-8', 'replace')).digest()
+
+# Função para saber a geração atual das sessões
+def geracao_sessoes():
+    sincronizar_versoes()
+    with trava_cache:
+        return versoes_tabelas.get('sessoes', 0)
+
+# Função para tirar do LRU as sessões alteradas desde a última olhada (por este ou outro
+# processo); devolve o data_version com que o LRU ficou em dia
+def atualizar_sessoes_em_memoria():
+    global data_version_sessoes, ultima_alteracao_vista
+    with trava_sessoes:
+        versao = data_version_visto
+        if versao == data_version_sessoes:
+            return versao
+        desde = ultima_alteracao_vista
+
+    banco = conectar_banco()
+    if desde is None:
+        alteradas = []
+        ultima = banco.execute("SELECT MAX(id) FROM sessoes_alteradas").fetchone()[0] or 0
+        perdidas = True
+    else:
+        alteradas = banco.execute("SELECT id, chave FROM sessoes_alteradas WHERE id > ? ORDER BY id",
+                                  (desde,)).fetchall()
+        ultima = alteradas[-1]['id'] if alteradas else desde
+        # Lido depois das chaves: se a limpeza apagou alguma que este processo não viu, aparece aqui
+        linha = banco.execute("SELECT versao FROM versoes_cache WHERE tabela = 'sessoes_alteradas'").fetchone()
+        perdidas = linha is not None and linha['versao'] > desde
+    banco.close()
+
+    with trava_sessoes:
+        if perdidas:
+            # Primeira olhada, ou faz tempo demais que este processo não olhava
+            sessoes_em_memoria.clear()
+        for alterada in alteradas:
+            sessoes_em_memoria.pop(alterada['chave'], None)
+        if ultima_alteracao_vista is None or ultima > ultima_alteracao_vista:
+            ultima_alteracao_vista = ultima
+        data_version_sessoes = versao
+    return versao
+
+# Função para ler uma sessão (devolve (dados, expira, geracao), ou None se não existir ou não valer mais)
+def ler_sessao(sid):
+    chave = chave_sessao(sid)
+    geracao = geracao_sessoes()
+    versao_lida = atualizar_sessoes_em_memoria()
+    with trava_sessoes:
+        guardada = sessoes_em_memoria.get(chave)
+        if guardada is not None:
+            sessoes_em_memoria.move_to_end(chave)
+            estatisticas_sessoes['lidas_memoria'] += 1
+
+    if guardada is None:
+        banco = conectar_banco()
+        linha = banco.execute("SELECT dados, expira, geracao FROM sessoes WHERE chave = ?", (chave,)).fetchone()
+        banco.close()
+        with trava_sessoes:
+            if linha is None:
+                estatisticas_sessoes['nao_encontradas'] += 1
+                return None
+            estatisticas_sessoes['lidas_banco'] += 1
+            guardada = (linha['dados'], linha['expira'], linha['geracao'])
+            # Se outra thread já tirou alterações do LRU enquanto a linha era lida, ela pode já
+            # ter nascido velha; se não, uma alteração que venha depois ainda a tira de lá
+            if data_version_sessoes == versao_lida:
+                sessoes_em_memoria[chave] = guardada
+                while len(sessoes_em_memoria) > CONFIGURACAO_SESSOES['maximo_em_memoria']:
+                    sessoes_em_memoria.popitem(last=False)
+
+    dados, expira, geracao_gravada = guardada
+    if expira < time.time() or geracao_gravada != geracao:
+        with trava_sessoes:
+            estatisticas_sessoes['vencidas'] += 1
+        return None
+    try:
+        return session_json_serializer.loads(dados), expira, geracao_gravada
+    except ValueError:
+        # Gravada num formato antigo: vale como sessão que não existe
+        return None
+
+# Função para transformar os dados da sessão nos bytes que vão para o banco
+def serializar_sessao(dados):
+    return session_json_serializer.dumps(dados).encode('utf-8')
+
+# Função que grava uma sessão (usada dentro de executar_escrita)
+def gravar_sessao(cursor, chave, dados, expira, geracao):
+    cursor.execute("""
+        INSERT INTO sessoes (chave, dados, expira, geracao) VALUES (?, ?, ?, ?)
+        ON CONFLICT (chave) DO UPDATE SET dados = excluded.dados, expira = excluded.expira,
+                                          geracao = excluded.geracao
+    """, (chave, dados, expira, geracao))
+    cursor.execute("INSERT INTO sessoes_alteradas (chave) VALUES (?)", (chave,))
+
+# Função que apaga uma sessão (usada dentro de executar_escrita)
+def apagar_sessao(cursor, chave):
+    cursor.execute("DELETE FROM sessoes WHERE chave = ?", (chave,))
+    cursor.execute("INSERT INTO sessoes_alteradas (chave) VALUES (?)", (chave,))
+
+# Função para rodar uma escrita de sessão e tirar a sessão do LRU
+def escrever_sessao(funcao, sid, *args):
+    chave = chave_sessao(sid)
+    banco = conectar_banco()
+    try:
+        executar_escrita(banco, funcao, chave, *args)
+    finally:
+        banco.close()
+    with trava_sessoes:
+        sessoes_em_memoria.pop(chave, None)
+        estatisticas_sessoes['gravadas' if funcao is gravar_sessao else 'apagadas'] += 1
+
+# Sessão que só é lida do banco quando alguém usa (o SessionMixin já é um MutableMapping)
+class SessaoNoServidor(SessionMixin):
+    def __init__(self, sid=None, mensagens=None):
+        self.sid = sid
+        self.sid_recebido = sid
+        self.sid_antigo = None
+        self.dados = None if sid else {}
+        self.expira = None
+        self.geracao = None
+        self.new = sid is None
+        self.modified = False
+        self.accessed = False
+        # Mensagens do flash() (vêm e vão no cookie de mensagens, fora do banco)
+        self.mensagens = mensagens
+        self.mensagens_mudaram = False
+
+    def carregar(self):
+        self.accessed = True
+        if self.dados is None:
+            lida = ler_sessao(self.sid)
+            if lida is None:
+                # Id que não existe (ou venceu, ou é de uma geração antiga): começa uma sessão nova
+                self.sid = None
+                self.new = True
+                self.dados = {}
+            else:
+                self.dados, self.expira, self.geracao = lida
+        if self.geracao is None:
+            # Sessão nova: nasce na geração de agora
+            self.geracao = geracao_sessoes()
+        return self.dados
+
+    def __getitem__(self, chave):
+        if chave == CHAVE_MENSAGENS:
+            self.accessed = True
+            if self.mensagens is None:
+                raise KeyError(chave)
+            return self.mensagens
+        return self.carregar()[chave]
+
+    def __setitem__(self, chave, valor):
+        if chave == CHAVE_MENSAGENS:
+            self.mensagens = valor
+            self.mensagens_mudaram = True
+            return
+        self.carregar()[chave] = valor
+        self.modified = True
+
+    def __delitem__(self, chave):
+        if chave == CHAVE_MENSAGENS:
+            if self.mensagens is None:
+                raise KeyError(chave)
+            self.mensagens = None
+            self.mensagens_mudaram = True
+            return
+        del self.carregar()[chave]
+        self.modified = True
+
+    def __iter__(self):
+        return iter(self.carregar())
+
+    def __len__(self):
+        return len(self.carregar())
+
+    def clear(self):
+        self.carregar().clear()
+        self.modified = True
+        if self.mensagens is not None:
+            self.mensagens = None
+            self.mensagens_mudaram = True
+
+    # Trocar o id (no login): o id de antes do login deixa de valer
+    def trocar_id(self):
+        self.carregar()
+        if self.sid is not None:
+            self.sid_antigo = self.sid
+        self.sid = None
+        self.modified = True
+
+# Chave em que o flash() do Flask guarda as mensagens na sessão
+CHAVE_MENSAGENS = '_flashes'
+
+# Assinatura do cookie de mensagens: a mesma da sessão no cookie do Flask, com outro salt
+class AssinaturaMensagens(SecureCookieSessionInterface):
+    salt = 'mensagens-da-sessao'
+
+# Interface de sessão do Flask que guarda as sessões na tabela sessoes
+class SessoesNoBanco(SessionInterface):
+    assinatura_mensagens = AssinaturaMensagens()
+
+    def open_session(self, app, request):
+        sessao = SessaoNoServidor(request.cookies.get(self.get_cookie_name(app)) or None)
+        valor = request.cookies.get(self.get_cookie_name(app) + '_mensagens')
+        if valor:
+            try:
+                sessao.mensagens = self.assinatura_mensagens.get_signing_serializer(app).loads(
+                    valor, max_age=CONFIGURACAO_SESSOES['segundos'])
+            except BadSignature:
+                # Cookie adulterado ou vencido: é apagado na resposta
+                sessao.mensagens_mudaram = True
+        return sessao
+
+    def save_session(self, app, sessao, response):
+        nome = self.get_cookie_name(app)
+        dominio = self.get_cookie_domain(app)
+        caminho = self.get_cookie_path(app)
+        if sessao.accessed:
+            response.vary.add('Cookie')
+        if sessao.mensagens_mudaram:
+            if sessao.mensagens:
+                response.set_cookie(nome + '_mensagens',
+                                    self.assinatura_mensagens.get_signing_serializer(app).dumps(sessao.mensagens),
+                                    httponly=self.get_cookie_httponly(app), domain=dominio, path=caminho,
+                                    secure=self.get_cookie_secure(app), samesite=self.get_cookie_samesite(app))
+            else:
+                response.delete_cookie(nome + '_mensagens', domain=dominio, path=caminho,
+                                       secure=self.get_cookie_secure(app),
+                                       samesite=self.get_cookie_samesite(app),
+                                       httponly=self.get_cookie_httponly(app))
+            response.vary.add('Cookie')
+        if sessao.sid_antigo is not None:
+            escrever_sessao(apagar_sessao, sessao.sid_antigo)
+            sessao.sid_antigo = None
+
+        agora = time.time()
+        # Regrava sempre com a geração em que a sessão foi lida: se todas foram encerradas no
+        # meio da requisição, esta continua encerrada (só /sessoes/encerrar passa uma geração nova)
+        if sessao.geracao is None:
+            sessao.geracao = geracao_sessoes()
+        if not sessao.modified:
+            # Sem mudança só grava para adiar o vencimento, e só quando ele está perto
+            if sessao.expira is not None and sessao.expira - agora < CONFIGURACAO_SESSOES['segundos'] / 2:
+                escrever_sessao(gravar_sessao, sessao.sid, serializar_sessao(sessao.dados),
+                                agora + CONFIGURACAO_SESSOES['segundos'], sessao.geracao)
+            return
+
+        if not sessao.dados:
+            if sessao.sid is not None:
+                escrever_sessao(apagar_sessao, sessao.sid)
+            if sessao.sid_recebido is not None:
+                response.delete_cookie(nome, domain=dominio, path=caminho,
+                                       secure=self.get_cookie_secure(app),
+                                       samesite=self.get_cookie_samesite(app),
+                                       httponly=self.get_cookie_httponly(app))
+            return
+
+        if sessao.sid is None:
+            sessao.sid = secrets.token_urlsafe(32)
+        escrever_sessao(gravar_sessao, sessao.sid, serializar_sessao(sessao.dados),
+                        agora + CONFIGURACAO_SESSOES['segundos'], sessao.geracao)
+        if sessao.sid != sessao.sid_recebido or sessao.permanent:
+            response.set_cookie(nome, sessao.sid, expires=self.get_expiration_time(app, sessao),
+                                httponly=self.get_cookie_httponly(app), domain=dominio, path=caminho,
+                                secure=self.get_cookie_secure(app), samesite=self.get_cookie_samesite(app))
+            response.vary.add('Cookie')
+
+# Onde as sessões podem ficar (escolhido em BIBLIOTECA_SESSOES)
+ARMAZENS_SESSAO = {
+    'banco': SessoesNoBanco,
+    'cookie': SecureCookieSessionInterface,
+}
+
+app.session_interface = ARMAZENS_SESSAO[CONFIGURACAO_SESSOES['armazem']]()
+
+# Função para encerrar todas as sessões abertas; devolve a geração nova
+# (as que estão no LRU ficam lá, mas com a geração antiga deixam de valer)
+def encerrar_todas_as_sessoes():
+    banco = conectar_banco()
+    try:
+        executar_escrita(banco, gravar_versoes, ('sessoes',))
+    finally:
+        banco.close()
+    return geracao_sessoes()
+
+# Função para apagar do banco as sessões vencidas e as de gerações antigas
+# (o agendador chama a cada volta; só limpa de fato a cada segundos_entre_limpezas)
+# Também apaga de sessoes_alteradas o que já estava lá na limpeza anterior, feita por
+# qualquer processo ou pelo cron (os processos já tiveram tempo de ler), e anota em
+# versoes_cache até onde apagou. A marca da limpeza anterior fica em contadores.
+def limpar_sessoes_vencidas(forcar=False):
+    global ultima_limpeza_sessoes
+    if not isinstance(app.session_interface, SessoesNoBanco):
+        return 0
+    if not forcar and time.monotonic() - ultima_limpeza_sessoes < CONFIGURACAO_SESSOES['segundos_entre_limpezas']:
+        return 0
+    ultima_limpeza_sessoes = time.monotonic()
+    geracao = geracao_sessoes()
+
+    def apagar_vencidas(cursor):
+        cursor.execute("DELETE FROM sessoes WHERE geracao < ?", (geracao,))
+        apagadas = cursor.rowcount
+        cursor.execute("DELETE FROM sessoes WHERE geracao = ? AND expira < ?", (geracao, time.time()))
+        apagadas += cursor.rowcount
+        marca = cursor.execute("SELECT valor FROM contadores WHERE chave = 'sessoes_alteradas'").fetchone()[0]
+        if marca:
+            cursor.execute("DELETE FROM sessoes_alteradas WHERE id <= ?", (marca,))
+            if cursor.rowcount:
+                cursor.execute("""
+                    INSERT INTO versoes_cache (tabela, versao) VALUES ('sessoes_alteradas', ?)
+                    ON CONFLICT (tabela) DO UPDATE SET versao = MAX(versao, excluded.versao)
+                """, (marca,))
+        ultima = cursor.execute("SELECT MAX(id) FROM sessoes_alteradas").fetchone()[0]
+        cursor.execute("UPDATE contadores SET valor = ?, referencia = ? WHERE chave = 'sessoes_alteradas'",
+                       (ultima or marca, texto_data_hora(datetime.now())))
+        return apagadas
+
+    banco = conectar_banco()
+    try:
+        apagadas = executar_escrita(banco, apagar_vencidas)
+    finally:
+        banco.close()
+    with trava_sessoes:
+        estatisticas_sessoes['limpas'] += apagadas
+    return apagadas
+
+# Função para ver como as sessões estão sendo usadas
+def obter_estatisticas_sessoes():
+    dados = {'armazem': CONFIGURACAO_SESSOES['armazem']}
+    if isinstance(app.session_interface, SessoesNoBanco):
+        with trava_sessoes:
+            dados.update(estatisticas_sessoes)
+            dados['em_memoria'] = len(sessoes_em_memoria)
+        dados['geracao'] = geracao_sessoes()
+    return dados
 
 # Página inicial do sistema
 @app.route("/")
+@guardar_em_cache('livros', 'usuarios', 'emprestimos', por_usuario=True)
 def pagina_inicial():
     # Se não estiver logado, redireciona para login
     if 'tipo_usuario' not in session:
         return redirect(url_for('pagina_login'))
 
-    # Conectar no banco e buscar estatísticas
+    # Buscar as estatísticas já contadas (uma leitura só)
     banco = conectar_banco()
-    cursor = banco.cursor()
-
-    # Contar total de livros
-    cursor.execute("SELECT COUNT(*) as total FROM livros")
-    total_livros = cursor.fetchone()['total']
+    contadores = obter_contadores(banco)
+    total_livros = contadores['livros']
+    total_usuarios = contadores['usuarios']
+    total_emprestados = contadores['emprestados']
+    total_atrasados = contadores['atrasados']
 
-    # Contar total de usuários
-    cursor.execute("SELECT COUNT(*) as total FROM usuarios")
-    total_usuarios = cursor.fetchone()['total']
+    # Para alunos, a quantidade de empréstimos dele vem do contexto do aluno
+    meus_emprestimos = 0
+    if not usuario_eh_admin():
+        meus_emprestimos = obter_contexto_aluno(banco, session.get('usuario_id'))['quantidade']
 
-    # Contar livros emprestados
-    cursor.execute("SELECT COUNT(*) as total FROM emprestimos WHERE status = 'emprestado'")
-    total_emprestados = cursor.fetchone()['total']
-
-    # Contar empréstimos atrasados
-    cursor.execute("""
-        SELECT COUNT(*) as total FROM emprestimos 
-        WHERE status = 'emprestado' AND data_prevista < DATE('now')
-    """)
-    total_atrasados = cursor.fetchone()['total']
+    banco.close()
 
+    return renderizar_pagina("inicio.html",
+                           total_livros=total_livros,
+                           total_usuarios=total_usuarios,
+                           total_emprestados=total_emprestados,
+                           total_atrasados=total_atrasados,
+                           meus_emprestimos=meus_emprestimos,
+                           limite_emprestimos=LIMITE_EMPRESTIMOS)
+
+# Função para conferir usuário e senha de um admin (devolve o admin, ou None se não conferir)
+# O hash é conferido na fila de senhas (pode levantar FilaSenhasCheia); usuário que não
+# existe é conferido com um hash falso para o login demorar o mesmo tanto
+def autenticar_admin(usuario, senha):
+    banco = conectar_banco()
+    admin = banco.execute("SELECT * FROM administradores WHERE usuario = ?", (usuario,)).fetchone()
     banco.close()
 
-    # Mostrar conteúdo diferente para admin e aluno
-    if usuario_eh_admin():
-        conteudo_pagina = f'''
-        <h2>📊 Painel do Administrador</h2>
-        <div class="cartoes-estatistica">
-            <div class="cartao">
-                <div class="numero-grande">{total_livros}</div>
-                <div>Total de Livros</div>
-            </div>
-            <div class="cartao">
-                <div class="numero-grande">{total_usuarios}</div>
-                <div>Usuários Cadastrados</div>
-            </div>
-            <div class="cartao">
-                <div class="numero-grande">{total_emprestados}</div>
-                <div>Livros Emprestados</div>
-            </div>
-            <div class="cartao">
-                <div class="numero-grande">{total_atrasados}</div>
-                <div>Empréstimos Atrasados</div>
-            </div>
-        </div>
-        <div style="text-align: center; margin-top: 30px;">
-            <h3>👨‍💼 Bem-vindo, Administrador!</h3>
-            <p>Você pode gerenciar livros, usuários e empréstimos usando o menu acima.</p>
-        </div>
-        '''
-    else:
-        # Para alunos, buscar quantidade de empréstimos dele
+    confere, precisa_refazer = calcular_na_fila_de_senhas(
+        conferir_hash_senha, senha or '', admin['senha'] if admin else obter_hash_senha_falso())
+    if not (admin and confere):
+        return None
+
+    if precisa_refazer:
+        # O custo do hash mudou desde que a senha foi gravada: gravar com o custo atual.
+        # Não é obrigatório: com a fila cheia ou o banco ocupado o login segue e fica para o próximo
         banco = conectar_banco()
-        cursor = banco.cursor()
-        cursor.execute("""
-            SELECT COUNT(*) as total FROM emprestimos e
-            JOIN usuarios u ON e.usuario_id = u.id
-            WHERE u.matricula = ? AND e.status = 'emprestado'
-        """, (session.get('matricula_usuario'),))
-        meus_emprestimos = cursor.fetchone()['total']
-        banco.close()
+        try:
+            executar_escrita(banco, regravar_senha_admin, admin['id'], admin['senha'],
+                             calcular_na_fila_de_senhas(gerar_hash_senha, senha))
+        except (FilaSenhasCheia, sqlite3.OperationalError):
+            pass
+        finally:
+            banco.close()
+    return admin
 
-        conteudo_pagina = f'''
-        <h2>📚 Portal do Estudante</h2>
-        <div class="cartoes-estatistica">
-            <div class="cartao">
-                <div class="numero-grande">{total_livros}</div>
-                <div>Total de Livros</div>
-            </div>
-            <div class="cartao">
-                <div class="numero-grande">{total_livros - total_emprestados}</div>
-                <div>Livros Disponíveis</div>
-            </div>
-            <div class="cartao">
-                <div class="numero-grande">{meus_emprestimos}</div>
-                <div>Meus Empréstimos</div>
-            </div>
-            <div class="cartao">
-                <div class="numero-grande">3</div>
-                <div>Limite de Empréstimos</div>
-            </div>
-        </div>
-        <div style="text-align: center; margin-top: 30px;">
-            <h3>👨‍🎓 Olá, {session.get('nome_usuario')}!</h3>
-            <p>Você pode consultar livros e ver seus empréstimos.</p>
-        </div>
-        '''
-
-    return render_template_string(TEMPLATE_HTML, titulo="Sistema Biblioteca", conteudo=conteudo_pagina)
+# Função que troca o hash da senha de um admin, se ainda for o mesmo (usada dentro de executar_escrita)
+def regravar_senha_admin(cursor, admin_id, hash_antigo, hash_novo):
+    cursor.execute("UPDATE administradores SET senha = ? WHERE id = ? AND senha = ?",
+                   (hash_novo, admin_id, hash_antigo))
+
+# Função para achar o aluno pela matrícula (devolve None se não existir)
+def autenticar_aluno(matricula):
+    banco = conectar_banco()
+    usuario = banco.execute("SELECT * FROM usuarios WHERE matricula = ?", (matricula,)).fetchone()
+    banco.close()
+    return usuario
+
+# Função para salvar na sessão quem entrou
+def abrir_sessao(tipo_usuario, registro):
+    # Com a sessão no servidor o id muda no login: um id de antes do login não serve depois dele
+    if hasattr(session, 'trocar_id'):
+        session.trocar_id()
+    session['tipo_usuario'] = tipo_usuario
+    session['nome_usuario'] = registro['nome']
+    if tipo_usuario == 'aluno':
+        session['matricula_usuario'] = registro['matricula']
+    session['usuario_id'] = registro['id']
 
 # Página de login
 @app.route("/login", methods=["GET", "POST"])
@@ -472,23 +1862,14 @@ def pagina_login():
 
         # Login de administrador
         if tipo_usuario == 'admin':
-            usuario = request.form.get('usuario')
-            senha = request.form.get('senha')
-
-            banco = conectar_banco()
-            cursor = banco.cursor()
-            cursor.execute("""
-                SELECT * FROM administradores 
-                WHERE usuario = ? AND senha = ?
-            """, (usuario, senha))
-            admin = cursor.fetchone()
-            banco.close()
+            try:
+                admin = autenticar_admin(request.form.get('usuario'), request.form.get('senha'))
+            except FilaSenhasCheia as e:
+                flash(str(e))
+                return render_template("login.html"), 503, {'Retry-After': '1'}
 
             if admin:
-                # Salvar dados na sessão
-                session['tipo_usuario'] = 'admin'
-                session['nome_usuario'] = admin['nome']
-                session['usuario_id'] = admin['id']
+                abrir_sessao('admin', admin)
                 flash("Login realizado com sucesso!")
                 return redirect(url_for('pagina_inicial'))
             else:
@@ -496,98 +1877,16 @@ def pagina_login():
 
         # Login de aluno
         elif tipo_usuario == 'aluno':
-            matricula = request.form.get('matricula')
-
-            banco = conectar_banco()
-            cursor = banco.cursor()
-            cursor.execute("SELECT * FROM usuarios WHERE matricula = ?", (matricula,))
-            usuario = cursor.fetchone()
-            banco.close()
+            usuario = autenticar_aluno(request.form.get('matricula'))
 
             if usuario:
-                # Salvar dados na sessão
-                session['tipo_usuario'] = 'aluno'
-                session['nome_usuario'] = usuario['nome']
-                session['matricula_usuario'] = usuario['matricula']
-                session['usuario_id'] = usuario['id']
+                abrir_sessao('aluno', usuario)
                 flash(f"Bem-vindo, {usuario['nome']}!")
                 return redirect(url_for('pagina_inicial'))
             else:
                 flash("Matrícula não encontrada!")
 
-    # HTML da página de login
-    conteudo_login = '''
-    <div class="formulario-login">
-        <h2 style="text-align: center; margin-bottom: 30px;">🔐 Entrar no Sistema</h2>
-
-        <div class="selecionar-tipo-usuario">
-            <div class="opcao-tipo-usuario" onclick="escolherTipoUsuario('admin')" id="opcao-admin">
-                <h3>👨‍💼 Administrador</h3>
-                <p>Gerenciar sistema</p>
-            </div>
-            <div class="opcao-tipo-usuario" onclick="escolherTipoUsuario('aluno')" id="opcao-aluno">
-                <h3>👨‍🎓 Estudante</h3>
-                <p>Consultar livros</p>
-            </div>
-        </div>
-
-        <form method="POST" id="formulario-login">
-            <input type="hidden" name="tipo_usuario" id="tipo_usuario" value="">
-
-            <div id="campos-admin" style="display: none;">
-                <div class="grupo-formulario">
-                    <label for="usuario">Usuário:</label>
-                    <input type="text" id="usuario" name="usuario">
-                </div>
-                <div class="grupo-formulario">
-                    <label for="senha">Senha:</label>
-                    <input type="password" id="senha" name="senha">
-                </div>
-            </div>
-
-            <div id="campos-aluno" style="display: none;">
-                <div class="grupo-formulario">
-                    <label for="matricula">Matrícula:</label>
-                    <input type="text" id="matricula" name="matricula" placeholder="Digite sua matrícula">
-                </div>
-            </div>
-
-            <button type="submit" class="botao" id="botao-entrar" style="width: 100%; display: none;">Entrar</button>
-        </form>
-
-        <div style="text-align: center; margin-top: 30px; padding-top: 20px; border-top: 1px solid #ddd;">
-            <a href="/cadastro" style="color: #2196F3; text-decoration: none; font-weight: bold;">
-                ➕ Cadastrar como administrador
-            </a>
-        </div>
-
-        <div style="text-align: center; margin-top: 15px;">
-            <small>
-                <strong>Para teste:</strong><br>
-                Admin - Usuário: admin / Senha: admin123<br>
-                Aluno - Matrícula: 2024001
-            </small>
-        </div>
-    </div>
-
-    <script>
-        function escolherTipoUsuario(tipo) {
-            // Limpar seleções anteriores
-            document.getElementById('opcao-admin').classList.remove('selecionado');
-            document.getElementById('opcao-aluno').classList.remove('selecionado');
-            document.getElementById('campos-admin').style.display = 'none';
-            document.getElementById('campos-aluno').style.display = 'none';
-
-            // Aplicar nova seleção
-            document.getElementById('opcao-' + tipo).classList.add('selecionado');
-            document.getElementById('campos-' + tipo).style.display = 'block';
-            document.getElementById('tipo_usuario').value = tipo;
-            document.getElementById('botao-entrar').style.display = 'block';
-        }
-    </script>
-    '''
-
-    return render_template_string(TEMPLATE_HTML, titulo="Login", conteudo=conteudo_login)
+    return render_template("login.html")
 
 # Página de cadastro de administradores
 @app.route("/cadastro", methods=["GET", "POST"])
@@ -613,157 +1912,152 @@ def pagina_cadastro():
                 cursor.execute("""
                     INSERT INTO administradores (nome, usuario, senha)
                     VALUES (?, ?, ?)
-                """, (nome, usuario, senha))
+                """, (nome, usuario, calcular_na_fila_de_senhas(gerar_hash_senha, senha)))
                 banco.commit()
                 flash("Administrador cadastrado! Faça login agora.")
                 return redirect(url_for('pagina_login'))
             except sqlite3.IntegrityError:
                 flash("Este nome de usuário já existe!")
+            except FilaSenhasCheia as e:
+                flash(str(e))
             except Exception as e:
                 flash(f"Erro: {str(e)}")
             finally:
                 banco.close()
 
-    conteudo_cadastro = '''
-    <div class="formulario-login">
-        <h2 style="text-align: center; margin-bottom: 30px;">📝 Cadastrar Administrador</h2>
-
-        <form method="POST">
-            <div class="grupo-formulario">
-                <label for="nome">Nome Completo:</label>
-                <input type="text" id="nome" name="nome" required>
-            </div>
-            <div class="grupo-formulario">
-                <label for="usuario">Nome de Usuário:</label>
-                <input type="text" id="usuario" name="usuario" required>
-            </div>
-            <div class="grupo-formulario">
-                <label for="senha">Senha:</label>
-                <input type="password" id="senha" name="senha" required>
-            </div>
-            <div class="grupo-formulario">
-                <label for="confirmar_senha">Confirmar Senha:</label>
-                <input type="password" id="confirmar_senha" name="confirmar_senha" required>
-            </div>
-
-            <button type="submit" class="botao" style="width: 100%;">Cadastrar</button>
-        </form>
-
-        <div style="text-align: center; margin-top: 30px;">
-            <a href="/login" style="color: #2196F3; text-decoration: none; font-weight: bold;">
-                ← Voltar para Login
-            </a>
-        </div>
-    </div>
-    '''
-
-    return render_template_string(TEMPLATE_HTML, titulo="Cadastro", conteudo=conteudo_cadastro)
+    return render_template("cadastro.html")
 
 # Página para sair do sistema
 @app.route("/sair")
 def sair_sistema():
+    if usuario_eh_aluno():
+        esquecer_contexto_aluno(session.get('usuario_id'))
     session.clear()
     flash("Você saiu do sistema!")
     return redirect(url_for('pagina_login'))
 
+# Função para mandar uma página em partes, enquanto o template vai sendo gerado
+# Útil quando o template percorre um cursor: as linhas saem do banco direto para a resposta
+def transmitir_template(nome_template, **contexto):
+    app.update_template_context(contexto)
+    partes = app.jinja_env.get_template(nome_template).stream(contexto)
+    partes.enable_buffering(100)
+    return Response(stream_with_context(partes), mimetype='text/html')
+
+# Função para ler o tamanho de página pedido na URL (só os valores da lista são aceitos)
+def ler_tamanho_pagina(tamanhos_permitidos, padrao):
+    tamanho = request.args.get('tamanho', type=int)
+    if tamanho in tamanhos_permitidos:
+        return tamanho
+    return padrao
+
+# Tamanhos de página da lista de livros
+TAMANHOS_PAGINA_LIVROS = (25, 50, 100, 200)
+
 # Página de livros
+# A lista é paginada pelo par (titulo, id) da última linha mostrada, então cada página
+# custa o mesmo tanto não importa o quão longe no catálogo ela esteja.
+# Com ?modo=completo o catálogo inteiro é transmitido linha a linha, sem carregar tudo na memória.
 @app.route("/livros")
 @precisa_login
+@guardar_em_cache('livros')
 def pagina_livros():
-    # Buscar todos os livros
     banco = conectar_banco()
-    cursor = banco.cursor()
-    cursor.execute("SELECT * FROM livros ORDER BY titulo")
-    livros = cursor.fetchall()
-    banco.close()
 
-    # Criar tabela HTML com os livros
-    tabela_livros = ""
-    if livros:
-        tabela_livros = '''
-        <table class="tabela">
-            <thead>
-                <tr>
-                    <th>ID</th>
-                    <th>Título</th>
-                    <th>Autor</th>
-                    <th>ISBN</th>
-                    <th>Ano</th>
-                    <th>Quantidade</th>
-                    <th>Status</th>
-                </tr>
-            </thead>
-            <tbody>
-        '''
-        for livro in livros:
-            if livro['quantidade'] > 0:
-                status = "✅ Disponível"
-                cor_status = "green"
-            else:
-                status = "❌ Indisponível"
-                cor_status = "red"
-
-            tabela_livros += f'''
-                <tr>
-                    <td>{livro['id']}</td>
-                    <td>{livro['titulo']}</td>
-                    <td>{livro['autor']}</td>
-                    <td>{livro['isbn'] or 'N/A'}</td>
-                    <td>{livro['ano'] or 'N/A'}</td>
-                    <td>{livro['quantidade']}</td>
-                    <td style="color: {cor_status}; font-weight: bold;">{status}</td>
-                </tr>
-            '''
-        tabela_livros += "</tbody></table>"
+    if request.args.get('modo') == 'completo':
+        cursor = banco.execute("SELECT * FROM livros ORDER BY titulo, id")
+        # Olhar só a primeira linha para saber se a tabela vai ter algum livro
+        primeiro = cursor.fetchone()
+        livros = itertools.chain([primeiro], cursor) if primeiro else []
+        return transmitir_template("livros.html", livros=livros, ha_livros=primeiro is not None, pagina=None)
+
+    tamanho = ler_tamanho_pagina(TAMANHOS_PAGINA_LIVROS, 50)
+    apos_id = request.args.get('apos_id', type=int)
+    antes_id = request.args.get('antes_id', type=int)
+
+    if antes_id is not None:
+        # Voltando: buscar de trás para frente e desinverter
+        livros = banco.execute("""
+            SELECT * FROM livros
+            WHERE (titulo, id) < (?, ?)
+            ORDER BY titulo DESC, id DESC
+            LIMIT ?
+        """, (request.args.get('antes_titulo', ''), antes_id, tamanho + 1)).fetchall()
+        tem_anterior = len(livros) > tamanho
+        livros = livros[:tamanho][::-1]
+        tem_proxima = True
+    elif apos_id is not None:
+        livros = banco.execute("""
+            SELECT * FROM livros
+            WHERE (titulo, id) > (?, ?)
+            ORDER BY titulo, id
+            LIMIT ?
+        """, (request.args.get('apos_titulo', ''), apos_id, tamanho + 1)).fetchall()
+        tem_proxima = len(livros) > tamanho
+        livros = livros[:tamanho]
+        tem_anterior = True
     else:
-        tabela_livros = "<p>Nenhum livro cadastrado.</p>"
+        livros = banco.execute("""
+            SELECT * FROM livros
+            ORDER BY titulo, id
+            LIMIT ?
+        """, (tamanho + 1,)).fetchall()
+        tem_proxima = len(livros) > tamanho
+        livros = livros[:tamanho]
+        tem_anterior = False
 
-    # Formulário para cadastrar livro (só para admins)
-    formulario_cadastro = ""
-    if usuario_eh_admin():
-        formulario_cadastro = '''
-        <h3>➕ Cadastrar Novo Livro</h3>
-        <form method="POST" action="/cadastrar_livro">
-            <div class="grupo-formulario">
-                <label for="titulo">Título:</label>
-                <input type="text" id="titulo" name="titulo" required>
-            </div>
-            <div class="grupo-formulario">
-                <label for="autor">Autor:</label>
-                <input type="text" id="autor" name="autor" required>
-            </div>
-            <div class="grupo-formulario">
-                <label for="isbn">ISBN:</label>
-                <input type="text" id="isbn" name="isbn">
-            </div>
-            <div class="grupo-formulario">
-                <label for="ano">Ano:</label>
-                <input type="number" id="ano" name="ano" min="1800" max="2030">
-            </div>
-            <div class="grupo-formulario">
-                <label for="quantidade">Quantidade:</label>
-                <input type="number" id="quantidade" name="quantidade" min="1" value="1" required>
-            </div>
-            <button type="submit" class="botao">Cadastrar Livro</button>
-        </form>
-        '''
-
-    # Título da seção
-    if usuario_eh_aluno():
-        titulo_secao = "📖 Livros da Biblioteca"
-    else:
-        titulo_secao = "📖 Gerenciar Livros"
+    banco.close()
 
-    conteudo_livros = f'''
-    <h2>{titulo_secao}</h2>
+    pagina = {
+        'tamanho': tamanho,
+        'tamanhos': TAMANHOS_PAGINA_LIVROS,
+        'anterior': livros[0] if livros and tem_anterior else None,
+        'proxima': livros[-1] if livros and tem_proxima else None,
+    }
+    return renderizar_pagina("livros.html", livros=livros, ha_livros=bool(livros), pagina=pagina)
+
+# Função para transformar o texto digitado numa consulta do FTS5
+# Cada palavra vira um prefixo entre aspas ("capit"*), então o usuário não consegue
+# quebrar a consulta com caracteres especiais do FTS5 e todas as palavras precisam aparecer.
+def montar_consulta_busca(texto):
+    palavras = re.findall(r'\w+', texto or '')
+    return ' '.join(f'"{palavra}"*' for palavra in palavras)
+
+# Pesos da relevância (bm25) para título, autor e ISBN
+PESOS_BUSCA_LIVROS = (10.0, 5.0, 1.0)
+
+# Função para buscar livros por título, autor ou ISBN, do mais relevante para o menos
+def buscar_livros(banco, texto, limite, somente_disponiveis=False):
+    consulta = montar_consulta_busca(texto)
+    if not consulta:
+        return []
+
+    filtro_disponiveis = "AND l.quantidade > 0" if somente_disponiveis else ""
+    return banco.execute(f"""
+        SELECT l.*
+        FROM livros_busca
+        JOIN livros l ON l.id = livros_busca.rowid
+        WHERE livros_busca MATCH ? {filtro_disponiveis}
+        ORDER BY bm25(livros_busca, {', '.join(str(peso) for peso in PESOS_BUSCA_LIVROS)})
+        LIMIT ?
+    """, (consulta, limite)).fetchall()
+
+# Busca de livros (?q=texto; com ?formato=json responde em JSON)
+@app.route("/livros/busca")
+@precisa_login
+@guardar_em_cache('livros')
+def pagina_busca_livros():
+    texto = request.args.get('q', '').strip()
+    limite = min(max(request.args.get('limite', 50, type=int), 1), 200)
 
-    {formulario_cadastro}
+    banco = conectar_banco()
+    livros = buscar_livros(banco, texto, limite)
+    banco.close()
 
-    <h3>📚 Lista de Livros</h3>
-    {tabela_livros}
-    '''
+    if request.args.get('formato') == 'json':
+        return jsonify([dict(livro) for livro in livros])
 
-    return render_template_string(TEMPLATE_HTML, titulo="Livros", conteudo=conteudo_livros)
+    return renderizar_pagina("livros.html", livros=livros, ha_livros=bool(livros), pagina=None, busca=texto)
 
 # Ação para cadastrar livro
 @app.route("/cadastrar_livro", methods=["POST"])
@@ -784,6 +2078,7 @@ def acao_cadastrar_livro():
             VALUES (?, ?, ?, ?, ?)
         """, (titulo, autor, isbn, ano, quantidade))
         banco.commit()
+        invalidar_cache('livros')
         flash(f"Livro '{titulo}' cadastrado com sucesso!")
     except sqlite3.IntegrityError:
         flash("Este ISBN já existe!")
@@ -805,59 +2100,7 @@ def pagina_usuarios():
     usuarios = cursor.fetchall()
     banco.close()
 
-    # Criar tabela HTML
-    tabela_usuarios = ""
-    if usuarios:
-        tabela_usuarios = '''
-        <table class="tabela">
-            <thead>
-                <tr>
-                    <th>ID</th>
-                    <th>Nome</th>
-                    <th>Matrícula</th>
-                    <th>Curso</th>
-                </tr>
-            </thead>
-            <tbody>
-        '''
-        for usuario in usuarios:
-            tabela_usuarios += f'''
-                <tr>
-                    <td>{usuario['id']}</td>
-                    <td>{usuario['nome']}</td>
-                    <td>{usuario['matricula']}</td>
-                    <td>{usuario['curso'] or 'N/A'}</td>
-                </tr>
-            '''
-        tabela_usuarios += "</tbody></table>"
-    else:
-        tabela_usuarios = "<p>Nenhum usuário cadastrado.</p>"
-
-    conteudo_usuarios = f'''
-    <h2>👥 Gerenciar Usuários</h2>
-
-    <h3>➕ Cadastrar Novo Usuário</h3>
-    <form method="POST" action="/cadastrar_usuario">
-        <div class="grupo-formulario">
-            <label for="nome">Nome Completo:</label>
-            <input type="text" id="nome" name="nome" required>
-        </div>
-        <div class="grupo-formulario">
-            <label for="matricula">Matrícula:</label>
-            <input type="text" id="matricula" name="matricula" required>
-        </div>
-        <div class="grupo-formulario">
-            <label for="curso">Curso:</label>
-            <input type="text" id="curso" name="curso">
-        </div>
-        <button type="submit" class="botao">Cadastrar Usuário</button>
-    </form>
-
-    <h3>👥 Lista de Usuários</h3>
-    {tabela_usuarios}
-    '''
-
-    return render_template_string(TEMPLATE_HTML, titulo="Usuários", conteudo=conteudo_usuarios)
+    return render_template("usuarios.html", usuarios=usuarios)
 
 # Ação para cadastrar usuário
 @app.route("/cadastrar_usuario", methods=["POST"])
@@ -876,6 +2119,7 @@ def acao_cadastrar_usuario():
             VALUES (?, ?, ?)
         """, (nome, matricula, curso))
         banco.commit()
+        invalidar_cache('usuarios')
         flash(f"Usuário '{nome}' cadastrado com sucesso!")
     except sqlite3.IntegrityError:
         flash("Esta matrícula já existe!")
@@ -886,6 +2130,304 @@ def acao_cadastrar_usuario():
 
     return redirect(url_for('pagina_usuarios'))
 
+# Função para refazer os contadores do painel a partir das tabelas
+# Usada depois de cargas em massa, que gravam sem os triggers
+def recalcular_contadores(banco):
+    banco.execute("""
+        UPDATE contadores SET valor = CASE chave
+            WHEN 'livros' THEN (SELECT COUNT(*) FROM livros)
+            WHEN 'usuarios' THEN (SELECT COUNT(*) FROM usuarios)
+            WHEN 'emprestados' THEN (SELECT COUNT(*) FROM emprestimos WHERE status = 'emprestado')
+            ELSE valor
+        END
+    """)
+    # O dia de referência NULL faz os atrasados serem recontados na próxima leitura
+    banco.execute("UPDATE contadores SET valor = 0, referencia = NULL WHERE chave = 'atrasados'")
+
+# Gerenciador para cargas em massa: tira os triggers das tabelas durante a carga
+# (cada trigger roda uma vez por linha) e no fim recria os triggers e refaz de uma vez
+# os contadores e a parte do índice de busca que mudou: os livros novos e os que já
+# existiam e foram atualizados (os valores antigos deles ficam guardados numa tabela
+# temporária, porque o índice precisa deles para apagar as entradas velhas).
+# Deve ser usado dentro de uma transação, assim quem está lendo nunca vê o banco sem os
+# triggers. Se a carga der erro, o próprio gerenciador faz o rollback e depois refaz o que
+# ainda faltar (se alguém tiver feito commit no meio), sem depender de quem chamou.
+@contextmanager
+def modo_carga_em_massa(banco, tabelas, sem_indices=False):
+    marcadores = ', '.join('?' * len(tabelas))
+    triggers = banco.execute(f"""
+        SELECT name, sql FROM sqlite_master
+        WHERE type = 'trigger' AND tbl_name IN ({marcadores})
+    """, tabelas).fetchall()
+    for trigger in triggers:
+        banco.execute(f'DROP TRIGGER "{trigger["name"]}"')
+
+    # Com sem_indices os índices criados por nós também saem e são refeitos no fim (mais rápido
+    # que atualizar a cada linha); os de UNIQUE ficam, porque garantem que não há repetidos
+    indices = []
+    if sem_indices:
+        indices = banco.execute(f"""
+            SELECT name, sql FROM sqlite_master
+            WHERE type = 'index' AND sql IS NOT NULL AND tbl_name IN ({marcadores})
+        """, tabelas).fetchall()
+        for indice in indices:
+            banco.execute(f'DROP INDEX "{indice["name"]}"')
+
+    if 'livros' in tabelas:
+        maior_id_livros = banco.execute("SELECT COALESCE(MAX(id), 0) FROM livros").fetchone()[0]
+        banco.execute("""
+            CREATE TEMP TABLE livros_antes_da_carga (
+                id INTEGER PRIMARY KEY, titulo TEXT, autor TEXT, isbn TEXT
+            )
+        """)
+        # Se o livro for atualizado duas vezes, vale o valor de antes da carga
+        banco.execute(f"""
+            CREATE TEMP TRIGGER trg_livros_antes_da_carga AFTER UPDATE ON main.livros
+            WHEN old.id <= {int(maior_id_livros)}
+                AND NOT EXISTS (SELECT 1 FROM livros_antes_da_carga WHERE id = old.id) BEGIN
+                INSERT INTO livros_antes_da_carga (id, titulo, autor, isbn)
+                VALUES (old.id, old.titulo, old.autor, old.isbn);
+            END
+        """)
+
+    # O que a carga tirou e ainda não voltou (depois de um rollback, normalmente nada)
+    def pendencias_da_carga():
+        existentes = {linha[0] for linha in banco.execute(
+            "SELECT name FROM sqlite_master WHERE type IN ('index', 'trigger')")}
+        faltando = [objeto for objeto in indices + triggers if objeto['name'] not in existentes]
+        tabela_temporaria = 'livros' in tabelas and banco.execute(
+            "SELECT 1 FROM sqlite_temp_master WHERE name = 'livros_antes_da_carga'").fetchone()
+        return faltando, bool(tabela_temporaria)
+
+    def terminar_carga():
+        faltando, tabela_temporaria = pendencias_da_carga()
+        for objeto in faltando:
+            banco.execute(objeto['sql'])
+        if tabela_temporaria:
+            banco.execute("DROP TRIGGER temp.trg_livros_antes_da_carga")
+            banco.execute("""
+                INSERT INTO livros_busca (livros_busca, rowid, titulo, autor, isbn)
+                SELECT 'delete', id, titulo, autor, COALESCE(isbn, '') || ' ' || REPLACE(COALESCE(isbn, ''), '-', '')
+                FROM livros_antes_da_carga
+            """)
+            banco.execute("""
+                INSERT INTO livros_busca (rowid, titulo, autor, isbn)
+                SELECT id, titulo, autor, COALESCE(isbn, '') || ' ' || REPLACE(COALESCE(isbn, ''), '-', '')
+                FROM livros
+                WHERE id > ? OR id IN (SELECT id FROM livros_antes_da_carga)
+            """, (maior_id_livros,))
+            banco.execute("DROP TABLE temp.livros_antes_da_carga")
+        recalcular_contadores(banco)
+
+    try:
+        yield
+    except BaseException:
+        banco.rollback()
+        # Só sobra algo a refazer se alguém fez commit no meio da carga
+        if any(pendencias_da_carga()):
+            terminar_carga()
+            banco.commit()
+        raise
+    terminar_carga()
+
+# Colunas aceitas na importação de cada tabela e a chave que identifica conflitos
+IMPORTACAO = {
+    'livros': {
+        'colunas': ('titulo', 'autor', 'isbn', 'ano', 'quantidade'),
+        'chave': 'isbn',
+        # Num ISBN repetido os dados do livro são atualizados, mas a quantidade não:
+        # ela é o estoque disponível e muda com os empréstimos
+        'atualizar': ('titulo', 'autor', 'ano'),
+    },
+    'usuarios': {
+        'colunas': ('nome', 'matricula', 'curso'),
+        'chave': 'matricula',
+        'atualizar': ('nome', 'curso'),
+    },
+}
+
+# Quantas linhas inválidas/conflitos guardar para mostrar no relatório
+MAXIMO_EXEMPLOS_IMPORTACAO = 50
+
+# Função para ler as linhas de um arquivo CSV ou JSON Lines, uma por vez
+# Devolve (número da linha, dicionário com os campos)
+def ler_linhas_importacao(arquivo_texto, formato):
+    if formato == 'jsonl':
+        for numero, linha in enumerate(arquivo_texto, start=1):
+            if not linha.strip():
+                continue
+            try:
+                dados = json.loads(linha)
+            except ValueError:
+                dados = None
+            yield numero, dados if isinstance(dados, dict) else None
+    else:
+        leitor = csv.DictReader(arquivo_texto)
+        for numero, dados in enumerate(leitor, start=2):  # linha 1 é o cabeçalho
+            yield numero, dados
+
+# Função para converter um campo numérico opcional (vazio vira None)
+def ler_inteiro(valor, campo):
+    if valor is None or str(valor).strip() == '':
+        return None
+    # int() aceitaria True como 1 e cortaria 2.7 para 2: esses são recusados
+    if isinstance(valor, bool) or (isinstance(valor, float) and not valor.is_integer()):
+        raise ValueError(f"{campo} inválido: {valor!r}")
+    try:
+        return int(valor)
+    except (TypeError, ValueError):
+        raise ValueError(f"{campo} inválido: {valor!r}")
+
+# Função para validar uma linha importada e devolver a tupla que vai para o INSERT
+def validar_linha_importacao(tabela, dados):
+    if dados is None:
+        raise ValueError("linha mal formada")
+
+    def texto(campo):
+        valor = dados.get(campo)
+        if valor is None:
+            return None
+        valor = str(valor).strip()
+        return valor or None
+
+    if tabela == 'livros':
+        titulo, autor = texto('titulo'), texto('autor')
+        if not titulo or not autor:
+            raise ValueError("título e autor são obrigatórios")
+        quantidade = ler_inteiro(dados.get('quantidade'), 'quantidade')
+        if quantidade is None:
+            quantidade = 1
+        if quantidade < 0:
+            raise ValueError("quantidade não pode ser negativa")
+        return (titulo, autor, texto('isbn'), ler_inteiro(dados.get('ano'), 'ano'), quantidade)
+
+    nome, matricula = texto('nome'), texto('matricula')
+    if not nome or not matricula:
+        raise ValueError("nome e matrícula são obrigatórios")
+    return (nome, matricula, texto('curso'))
+
+# Função para importar muitas linhas de uma vez, em lotes, numa transação só
+# conflito='atualizar' atualiza o registro que já existe (mesmo ISBN/matrícula);
+# conflito='ignorar' mantém o que já existe e só conta o conflito no relatório.
+# progresso(relatorio) é chamado depois de cada lote.
+def importar_registros(banco, tabela, linhas, conflito='atualizar', tamanho_lote=10000, progresso=None):
+    config = IMPORTACAO[tabela]
+    colunas = config['colunas']
+    chave = config['chave']
+    posicao_chave = colunas.index(chave)
+
+    if conflito == 'atualizar':
+        acao = "DO UPDATE SET " + ", ".join(f"{coluna} = excluded.{coluna}" for coluna in config['atualizar'])
+    else:
+        acao = "DO NOTHING"
+    comando = f"""
+        INSERT INTO {tabela} ({', '.join(colunas)})
+        VALUES ({', '.join('?' * len(colunas))})
+        ON CONFLICT ({chave}) {acao}
+    """
+
+    relatorio = {
+        'tabela': tabela, 'lidas': 0, 'gravadas': 0, 'invalidas': 0, 'conflitos': 0,
+        'exemplos_invalidas': [], 'exemplos_conflitos': [], 'segundos': 0.0, 'linhas_por_segundo': 0.0,
+    }
+    inicio = time.perf_counter()
+
+    def gravar_lote(lote):
+        # Os ids são AUTOINCREMENT: tudo que entrou neste lote tem id maior que o maior de antes,
+        # então os conflitos saem da conta sem precisar consultar chave por chave
+        maior_id = banco.execute(f"SELECT COALESCE(MAX(id), 0) FROM {tabela}").fetchone()[0]
+        cursor = banco.executemany(comando, lote)
+        relatorio['gravadas'] += cursor.rowcount
+        novos = banco.execute(f"SELECT COUNT(*) FROM {tabela} WHERE id > ?", (maior_id,)).fetchone()[0]
+        conflitos = len(lote) - novos
+        relatorio['conflitos'] += conflitos
+
+        # Exemplos de chaves em conflito só enquanto ainda cabem no relatório
+        espaco = MAXIMO_EXEMPLOS_IMPORTACAO - len(relatorio['exemplos_conflitos'])
+        if conflitos and espaco > 0:
+            chaves = [registro[posicao_chave] for registro in lote if registro[posicao_chave] is not None]
+            for parte in range(0, len(chaves), 500):
+                pedaco = chaves[parte:parte + 500]
+                existentes = banco.execute(f"""
+                    SELECT {chave} FROM {tabela}
+                    WHERE {chave} IN ({', '.join('?' * len(pedaco))}) AND id <= ?
+                    LIMIT ?
+                """, pedaco + [maior_id, espaco]).fetchall()
+                relatorio['exemplos_conflitos'].extend(linha[0] for linha in existentes)
+                espaco -= len(existentes)
+                if espaco <= 0:
+                    break
+
+        relatorio['segundos'] = time.perf_counter() - inicio
+        relatorio['linhas_por_segundo'] = relatorio['lidas'] / relatorio['segundos'] if relatorio['segundos'] else 0.0
+        if progresso:
+            progresso(relatorio)
+
+    banco.execute("BEGIN IMMEDIATE")
+    try:
+        with modo_carga_em_massa(banco, (tabela,)):
+            lote = []
+            for numero, dados in linhas:
+                relatorio['lidas'] += 1
+                try:
+                    lote.append(validar_linha_importacao(tabela, dados))
+                except ValueError as erro:
+                    relatorio['invalidas'] += 1
+                    if len(relatorio['exemplos_invalidas']) < MAXIMO_EXEMPLOS_IMPORTACAO:
+                        relatorio['exemplos_invalidas'].append((numero, str(erro)))
+                    continue
+                if len(lote) >= tamanho_lote:
+                    gravar_lote(lote)
+                    lote = []
+            if lote:
+                gravar_lote(lote)
+        banco.commit()
+        invalidar_cache(tabela, 'contextos_alunos')
+    except Exception:
+        banco.rollback()
+        raise
+
+    relatorio['segundos'] = time.perf_counter() - inicio
+    relatorio['linhas_por_segundo'] = relatorio['lidas'] / relatorio['segundos'] if relatorio['segundos'] else 0.0
+    return relatorio
+
+# Função para descobrir o formato pelo nome do arquivo
+def formato_do_arquivo(nome_arquivo):
+    if nome_arquivo.lower().endswith(('.jsonl', '.ndjson', '.json')):
+        return 'jsonl'
+    return 'csv'
+
+# Página de importação em massa de livros e usuários (CSV ou JSON Lines)
+@app.route("/importar", methods=["GET", "POST"])
+@precisa_ser_admin
+def pagina_importar():
+    relatorio = None
+
+    if request.method == "POST":
+        tabela = request.form.get('tabela')
+        conflito = request.form.get('conflito', 'atualizar')
+        arquivo = request.files.get('arquivo')
+
+        if tabela not in IMPORTACAO or conflito not in ('atualizar', 'ignorar'):
+            flash("Escolha o que importar!")
+        elif not arquivo or not arquivo.filename:
+            flash("Escolha um arquivo!")
+        else:
+            # O arquivo é lido aos poucos, direto do upload
+            texto = io.TextIOWrapper(arquivo.stream, encoding='utf-8-sig', newline='')
+            banco = conectar_banco()
+            try:
+                relatorio = importar_registros(banco, tabela,
+                                               ler_linhas_importacao(texto, formato_do_arquivo(arquivo.filename)),
+                                               conflito=conflito)
+                flash(f"Importação concluída: {relatorio['gravadas']} registros gravados.")
+            except Exception as e:
+                flash(f"Erro: {str(e)}")
+            finally:
+                banco.close()
+
+    return render_template("importar.html", relatorio=relatorio)
+
 # Página de empréstimos (só admins)
 @app.route("/emprestimos")
 @precisa_ser_admin
@@ -893,17 +2435,13 @@ def pagina_emprestimos():
     banco = conectar_banco()
     cursor = banco.cursor()
 
-    # Buscar usuários
-    cursor.execute("SELECT * FROM usuarios ORDER BY nome")
-    usuarios = cursor.fetchall()
-
-    # Buscar livros disponíveis
-    cursor.execute("SELECT * FROM livros WHERE quantidade > 0 ORDER BY titulo")
-    livros = cursor.fetchall()
+    # Usuários e livros do formulário são buscados pelo autocompletar, não vêm mais na página
 
     # Buscar empréstimos ativos
-    cursor.execute("""
-        SELECT e.*, u.nome as usuario_nome, u.matricula, l.titulo as livro_titulo
+    cursor.execute(f"""
+        SELECT e.*, u.nome as usuario_nome, u.matricula, l.titulo as livro_titulo,
+               {sql_data_br('e.data_emprestimo')} AS data_emprestimo_br,
+               {sql_data_br('e.data_prevista')} AS data_prevista_br
         FROM emprestimos e
         JOIN usuarios u ON e.usuario_id = u.id
         JOIN livros l ON e.livro_id = l.id
@@ -914,93 +2452,95 @@ def pagina_emprestimos():
 
     banco.close()
 
-    # Criar opções para formulário
-    opcoes_usuarios = ""
-    for usuario in usuarios:
-        opcoes_usuarios += f'<option value="{usuario["id"]}">{usuario["nome"]} ({usuario["matricula"]})</option>'
-
-    opcoes_livros = ""
-    for livro in livros:
-        opcoes_livros += f'<option value="{livro["id"]}">{livro["titulo"]} - {livro["autor"]} (Qtd: {livro["quantidade"]})</option>'
-
-    # Criar tabela de empréstimos
-    tabela_emprestimos = ""
-    if emprestimos:
-        tabela_emprestimos = '''
-        <table class="tabela">
-            <thead>
-                <tr>
-                    <th>ID</th>
-                    <th>Usuário</th>
-                    <th>Livro</th>
-                    <th>Data Empréstimo</th>
-                    <th>Data Prevista</th>
-                    <th>Status</th>
-                    <th>Ação</th>
-                </tr>
-            </thead>
-            <tbody>
-        '''
-        for emp in emprestimos:
-            data_prevista = datetime.strptime(emp['data_prevista'], '%Y-%m-%d')
-            hoje = datetime.now()
-            
-            if data_prevista < hoje:
-                status_texto = "ATRASADO"
-                cor_status = "red"
-            else:
-                status_texto = "No prazo"
-                cor_status = "green"
-
-            tabela_emprestimos += f'''
-                <tr>
-                    <td>{emp['id']}</td>
-                    <td>{emp['usuario_nome']} ({emp['matricula']})</td>
-                    <td>{emp['livro_titulo']}</td>
-                    <td>{datetime.strptime(emp['data_emprestimo'], '%Y-%m-%d').strftime('%d/%m/%Y')}</td>
-                    <td>{data_prevista.strftime('%d/%m/%Y')}</td>
-                    <td style="color: {cor_status}; font-weight: bold;">{status_texto}</td>
-                    <td>
-                        <form method="POST" action="/devolver_livro" style="display: inline;">
-                            <input type="hidden" name="emprestimo_id" value="{emp['id']}">
-                            <button type="submit" class="botao" style="padding: 5px 10px; font-size: 12px;">Devolver</button>
-                        </form>
-                    </td>
-                </tr>
-            '''
-        tabela_emprestimos += "</tbody></table>"
-    else:
-        tabela_emprestimos = "<p>Nenhum empréstimo ativo.</p>"
-
-    conteudo_emprestimos = f'''
-    <h2>📋 Gerenciar Empréstimos</h2>
-
-    <h3>➕ Fazer Novo Empréstimo</h3>
-    <form method="POST" action="/fazer_emprestimo">
-        <div class="grupo-formulario">
-            <label for="usuario_id">Usuário:</label>
-            <select id="usuario_id" name="usuario_id" required>
-                <option value="">Escolha um usuário</option>
-                {opcoes_usuarios}
-            </select>
-        </div>
-        <div class="grupo-formulario">
-            <label for="livro_id">Livro:</label>
-            <select id="livro_id" name="livro_id" required>
-                <option value="">Escolha um livro</option>
-                {opcoes_livros}
-            </select>
-        </div>
-        <button type="submit" class="botao">Fazer Empréstimo</button>
-    </form>
-
-    <h3>📚 Empréstimos Ativos</h3>
-    {tabela_emprestimos}
-    '''
-
-    return render_template_string(TEMPLATE_HTML, titulo="Empréstimos", conteudo=conteudo_emprestimos)
+    return render_template("emprestimos.html",
+                           emprestimos=emprestimos)
+
+# Quantos resultados o autocompletar devolve (padrão e máximo)
+LIMITE_AUTOCOMPLETAR = 10
+LIMITE_MAXIMO_AUTOCOMPLETAR = 50
+
+# Função para ler o texto e o limite pedidos ao autocompletar
+def ler_pedido_autocompletar():
+    texto = request.args.get('q', '').strip()
+    limite = request.args.get('limite', LIMITE_AUTOCOMPLETAR, type=int)
+    return texto, min(max(limite, 1), LIMITE_MAXIMO_AUTOCOMPLETAR)
+
+# Função para montar o padrão do LIKE que acha os nomes começados pelo texto
+# (% e _ digitados pelo usuário não são curingas)
+def padrao_prefixo(texto):
+    return texto.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+
+# Autocompletar de usuários pelo começo do nome ou da matrícula (JSON)
+@app.route("/autocompletar/usuarios")
+@precisa_ser_admin
+def autocompletar_usuarios():
+    texto, limite = ler_pedido_autocompletar()
+    if not texto:
+        return jsonify([])
+
+    banco = conectar_banco()
+    usuarios = banco.execute("""
+        SELECT id, nome, matricula FROM (
+            SELECT id, nome, matricula FROM usuarios
+            WHERE matricula >= ? AND matricula < ?
+            ORDER BY matricula
+            LIMIT ?
+        )
+        UNION
+        SELECT id, nome, matricula FROM (
+            SELECT id, nome, matricula FROM usuarios
+            WHERE nome LIKE ? ESCAPE '\\'
+            ORDER BY nome COLLATE NOCASE
+            LIMIT ?
+        )
+        ORDER BY nome COLLATE NOCASE
+        LIMIT ?
+    """, (texto, texto + '\U0010ffff', limite, padrao_prefixo(texto), limite, limite)).fetchall()
+    banco.close()
+
+    return jsonify([
+        {'id': usuario['id'], 'nome': usuario['nome'], 'matricula': usuario['matricula'],
+         'texto': f"{usuario['nome']} ({usuario['matricula']})"}
+        for usuario in usuarios
+    ])
+
+# Autocompletar de livros disponíveis por título ou autor (JSON)
+@app.route("/autocompletar/livros")
+@precisa_ser_admin
+def autocompletar_livros():
+    texto, limite = ler_pedido_autocompletar()
+
+    banco = conectar_banco()
+    livros = buscar_livros(banco, texto, limite, somente_disponiveis=True)
+    banco.close()
+
+    return jsonify([
+        {'id': livro['id'], 'titulo': livro['titulo'], 'autor': livro['autor'], 'quantidade': livro['quantidade'],
+         'texto': f"{livro['titulo']} - {livro['autor']} (Qtd: {livro['quantidade']})"}
+        for livro in livros
+    ])
+
+# Tamanhos de página do histórico do aluno
+TAMANHOS_PAGINA_HISTORICO = (10, 25, 50, 100)
+
+# Filtros do histórico pela situação da devolução
+SITUACOES_HISTORICO = {
+    'no_prazo': "e.dias_atraso = 0",
+    'com_atraso': "e.dias_atraso > 0",
+}
+
+# Função para ler uma data AAAA-MM-DD da URL (data inválida é ignorada)
+def ler_data_url(nome):
+    valor = request.args.get(nome, '').strip()
+    try:
+        return date.fromisoformat(valor).isoformat()
+    except ValueError:
+        return None
 
 # Página de empréstimos do aluno
+# O histórico é paginado pelo par (data_devolucao, id) da última linha mostrada, como a
+# lista de livros, e tudo é buscado pelo usuario_id da sessão no índice
+# (usuario_id, status, data_devolucao): qualquer página custa o mesmo tanto.
 @app.route("/meus_emprestimos")
 @precisa_login
 def pagina_meus_emprestimos():
@@ -1008,124 +2548,136 @@ def pagina_meus_emprestimos():
     if not usuario_eh_aluno():
         return redirect(url_for('pagina_emprestimos'))
 
+    usuario_id = session['usuario_id']
     banco = conectar_banco()
-    cursor = banco.cursor()
 
-    # Buscar empréstimos ativos do aluno
-    cursor.execute("""
-        SELECT e.*, l.titulo as livro_titulo, l.autor
-        FROM emprestimos e
-        JOIN livros l ON e.livro_id = l.id
-        JOIN usuarios u ON e.usuario_id = u.id
-        WHERE u.matricula = ? AND e.status = 'emprestado'
-        ORDER BY e.data_emprestimo DESC
-    """, (session.get('matricula_usuario'),))
-    emprestimos = cursor.fetchall()
+    # Empréstimos ativos do aluno (do contexto do aluno)
+    emprestimos = obter_contexto_aluno(banco, usuario_id)['emprestimos']
+
+    # Filtros do histórico: período da devolução e situação (no prazo / com atraso)
+    filtros = {
+        'de': ler_data_url('de'),
+        'ate': ler_data_url('ate'),
+        'situacao': request.args.get('situacao') if request.args.get('situacao') in SITUACOES_HISTORICO else None,
+    }
+    filtros = {nome: valor for nome, valor in filtros.items() if valor}
+
+    condicoes = ["e.usuario_id = ?", "e.status = 'devolvido'"]
+    parametros = [usuario_id]
+    if 'de' in filtros:
+        condicoes.append("e.data_devolucao >= ?")
+        parametros.append(filtros['de'])
+    if 'ate' in filtros:
+        condicoes.append("e.data_devolucao <= ?")
+        parametros.append(filtros['ate'])
+    if 'situacao' in filtros:
+        condicoes.append(SITUACOES_HISTORICO[filtros['situacao']])
+
+    tamanho = ler_tamanho_pagina(TAMANHOS_PAGINA_HISTORICO, 10)
+    apos_id = request.args.get('apos_id', type=int)
+    antes_id = request.args.get('antes_id', type=int)
+
+    if antes_id is not None:
+        # Voltando: buscar de trás para frente e desinverter
+        condicoes.append("(e.data_devolucao, e.id) > (?, ?)")
+        parametros += [request.args.get('antes_data', ''), antes_id]
+        ordem = "e.data_devolucao, e.id"
+    elif apos_id is not None:
+        condicoes.append("(e.data_devolucao, e.id) < (?, ?)")
+        parametros += [request.args.get('apos_data', ''), apos_id]
+        ordem = "e.data_devolucao DESC, e.id DESC"
+    else:
+        ordem = "e.data_devolucao DESC, e.id DESC"
 
-    # Buscar histórico
-    cursor.execute("""
-        SELECT e.*, l.titulo as livro_titulo, l.autor
+    historico = banco.execute(f"""
+        SELECT e.*, l.titulo as livro_titulo, l.autor,
+               {sql_data_br('e.data_emprestimo')} AS data_emprestimo_br,
+               {sql_data_br('e.data_prevista')} AS data_prevista_br,
+               {sql_data_br('e.data_devolucao')} AS data_devolucao_br
         FROM emprestimos e
         JOIN livros l ON e.livro_id = l.id
-        JOIN usuarios u ON e.usuario_id = u.id
-        WHERE u.matricula = ? AND e.status = 'devolvido'
-        ORDER BY e.data_devolucao DESC
-        LIMIT 10
-    """, (session.get('matricula_usuario'),))
-    historico = cursor.fetchall()
+        WHERE {' AND '.join(condicoes)}
+        ORDER BY {ordem}
+        LIMIT ?
+    """, parametros + [tamanho + 1]).fetchall()
 
     banco.close()
 
-    # Criar tabela de empréstimos ativos
-    tabela_emprestimos = ""
-    if emprestimos:
-        tabela_emprestimos = '''
-        <table class="tabela">
-            <thead>
-                <tr>
-                    <th>Livro</th>
-                    <th>Autor</th>
-                    <th>Data Empréstimo</th>
-                    <th>Data Prevista</th>
-                    <th>Status</th>
-                </tr>
-            </thead>
-            <tbody>
-        '''
-        for emp in emprestimos:
-            data_prevista = datetime.strptime(emp['data_prevista'], '%Y-%m-%d')
-            hoje = datetime.now()
-            
-            if data_prevista < hoje:
-                status_texto = "ATRASADO"
-                cor_status = "red"
-            else:
-                status_texto = "No prazo"
-                cor_status = "green"
-
-            tabela_emprestimos += f'''
-                <tr>
-                    <td>{emp['livro_titulo']}</td>
-                    <td>{emp['autor']}</td>
-                    <td>{datetime.strptime(emp['data_emprestimo'], '%Y-%m-%d').strftime('%d/%m/%Y')}</td>
-                    <td>{data_prevista.strftime('%d/%m/%Y')}</td>
-                    <td style="color: {cor_status}; font-weight: bold;">{status_texto}</td>
-                </tr>
-            '''
-        tabela_emprestimos += "</tbody></table>"
+    if antes_id is not None:
+        tem_anterior = len(historico) > tamanho
+        historico = historico[:tamanho][::-1]
+        tem_proxima = True
     else:
-        tabela_emprestimos = "<p>Você não tem empréstimos ativos.</p>"
-
-    # Criar tabela de histórico
-    tabela_historico = ""
-    if historico:
-        tabela_historico = '''
-        <table class="tabela">
-            <thead>
-                <tr>
-                    <th>Livro</th>
-                    <th>Autor</th>
-                    <th>Data Empréstimo</th>
-                    <th>Data Devolução</th>
-                </tr>
-            </thead>
-            <tbody>
-        '''
-        for emp in historico:
-            tabela_historico += f'''
-                <tr>
-                    <td>{emp['livro_titulo']}</td>
-                    <td>{emp['autor']}</td>
-                    <td>{datetime.strptime(emp['data_emprestimo'], '%Y-%m-%d').strftime('%d/%m/%Y')}</td>
-                    <td>{datetime.strptime(emp['data_devolucao'], '%Y-%m-%d').strftime('%d/%m/%Y')}</td>
-                </tr>
-            '''
-        tabela_historico += "</tbody></table>"
-    else:
-        tabela_historico = "<p>Nenhum histórico encontrado.</p>"
-
-    conteudo_meus_emprestimos = f'''
-    <h2>📋 Meus Empréstimos</h2>
-
-    <h3>📚 Empréstimos Ativos</h3>
-    {tabela_emprestimos}
+        tem_proxima = len(historico) > tamanho
+        historico = historico[:tamanho]
+        tem_anterior = apos_id is not None
+
+    pagina = {
+        'tamanho': tamanho,
+        'tamanhos': TAMANHOS_PAGINA_HISTORICO,
+        'anterior': historico[0] if historico and tem_anterior else None,
+        'proxima': historico[-1] if historico and tem_proxima else None,
+    }
+    return render_template("meus_emprestimos.html",
+                           emprestimos=emprestimos,
+                           historico=historico,
+                           pagina=pagina,
+                           filtros=filtros,
+                           limite_emprestimos=LIMITE_EMPRESTIMOS,
+                           prazo_dias=PRAZO_EMPRESTIMO_DIAS)
+
+# Erro de regra de negócio do empréstimo/devolução (a mensagem vai direto para o usuário)
+class ErroEmprestimo(Exception):
+    pass
+
+# Função que confere se o aluno existe e devolve quantos livros ele ainda pode pegar
+def vagas_do_aluno(cursor, usuario_id):
+    cursor.execute("SELECT id FROM usuarios WHERE id = ?", (usuario_id,))
+    if not cursor.fetchone():
+        raise ErroEmprestimo("Usuário não encontrado!")
 
-    <div style="margin-top: 40px;">
-        <h3>📜 Histórico</h3>
-        {tabela_historico}
-    </div>
+    cursor.execute("""
+        SELECT COUNT(*) as total FROM emprestimos 
+        WHERE usuario_id = ? AND status = 'emprestado'
+    """, (usuario_id,))
+    return LIMITE_EMPRESTIMOS - cursor.fetchone()['total']
+
+# Função que tira um exemplar do livro e grava o empréstimo (o limite do aluno já foi conferido)
+# Devolve o id do empréstimo
+def gravar_emprestimo(cursor, usuario_id, livro_id):
+    # Diminuir quantidade do livro, só se ainda houver exemplar
+    cursor.execute("""
+        UPDATE livros SET quantidade = quantidade - 1 WHERE id = ? AND quantidade > 0
+    """, (livro_id,))
+    if cursor.rowcount == 0:
+        raise ErroEmprestimo("Este livro não está disponível!")
 
-    <div style="background: #f8f9fa; padding: 20px; border-radius: 10px; margin-top: 30px;">
-        <h4>ℹ️ Informações:</h4>
-        <ul>
-            <li>Você pode ter até 3 livros emprestados</li>
-            <li>Prazo de devolução: 7 dias</li>
-            <li>Para renovar, procure um administrador</li>
-        </ul>
-    </div>
-    '''
+    # Fazer empréstimo
+    data_emprestimo = date.today()
+    data_prevista = data_emprestimo + timedelta(days=PRAZO_EMPRESTIMO_DIAS)
 
-    return render_template_string(TEMPLATE_HTML, titulo="Meus Empréstimos", conteudo=conteudo_meus_emprestimos)
+    cursor.execute("""
+        INSERT INTO emprestimos (usuario_id, livro_id, data_emprestimo, data_prevista)
+        VALUES (?, ?, ?, ?)
+    """, (usuario_id, livro_id, data_emprestimo, data_prevista))
+    return cursor.lastrowid
+
+# Função que grava um empréstimo (usada dentro de executar_escrita)
+# Tudo acontece na mesma transação IMMEDIATE: duas mesas emprestando o último exemplar
+# ao mesmo tempo não deixam a quantidade negativa nem passam do limite do aluno.
+def registrar_emprestimo(cursor, usuario_id, livro_id):
+    # Verificar limite de empréstimos
+    if vagas_do_aluno(cursor, usuario_id) <= 0:
+        raise ErroEmprestimo(f"Este usuário já tem {LIMITE_EMPRESTIMOS} livros emprestados!")
+
+    gravar_emprestimo(cursor, usuario_id, livro_id)
+    return "Empréstimo realizado com sucesso!"
+
+# Função do empréstimo pela página: grava e marca as versões dos caches no mesmo commit
+def emprestar_pela_pagina(cursor, usuario_id, livro_id):
+    mensagem = registrar_emprestimo(cursor, usuario_id, livro_id)
+    marcar_emprestimos_alterados(cursor, usuarios=[usuario_id])
+    return mensagem
 
 # Ação para fazer empréstimo
 @app.route("/fazer_emprestimo", methods=["POST"])
@@ -1135,47 +2687,13 @@ def acao_fazer_emprestimo():
     livro_id = request.form.get('livro_id')
 
     banco = conectar_banco()
-    cursor = banco.cursor()
 
     try:
-        # Verificar limite de empréstimos
-        cursor.execute("""
-            SELECT COUNT(*) as total FROM emprestimos 
-            WHERE usuario_id = ? AND status = 'emprestado'
-        """, (usuario_id,))
-        total_emprestimos = cursor.fetchone()['total']
-
-        if total_emprestimos >= 3:
-            flash("Este usuário já tem 3 livros emprestados!")
-            banco.close()
-            return redirect(url_for('pagina_emprestimos'))
-
-        # Verificar se livro está disponível
-        cursor.execute("SELECT quantidade FROM livros WHERE id = ?", (livro_id,))
-        livro = cursor.fetchone()
-
-        if not livro or livro['quantidade'] <= 0:
-            flash("Este livro não está disponível!")
-            banco.close()
-            return redirect(url_for('pagina_emprestimos'))
-
-        # Fazer empréstimo
-        data_emprestimo = datetime.now().strftime('%Y-%m-%d')
-        data_prevista = (datetime.now() + timedelta(days=7)).strftime('%Y-%m-%d')
-
-        cursor.execute("""
-            INSERT INTO emprestimos (usuario_id, livro_id, data_emprestimo, data_prevista)
-            VALUES (?, ?, ?, ?)
-        """, (usuario_id, livro_id, data_emprestimo, data_prevista))
-
-        # Diminuir quantidade do livro
-        cursor.execute("""
-            UPDATE livros SET quantidade = quantidade - 1 WHERE id = ?
-        """, (livro_id,))
-
-        banco.commit()
-        flash("Empréstimo realizado com sucesso!")
-
+        mensagem = executar_escrita(banco, emprestar_pela_pagina, usuario_id, livro_id)
+        atualizar_caches_emprestimos()
+        flash(mensagem)
+    except ErroEmprestimo as e:
+        flash(str(e))
     except Exception as e:
         flash(f"Erro: {str(e)}")
     finally:
@@ -1183,6 +2701,44 @@ def acao_fazer_emprestimo():
 
     return redirect(url_for('pagina_emprestimos'))
 
+# Função que grava uma devolução (usada dentro de executar_escrita)
+def registrar_devolucao(cursor, emprestimo_id):
+    # Buscar dados do empréstimo
+    cursor.execute("""
+        SELECT e.*, l.titulo FROM emprestimos e
+        JOIN livros l ON e.livro_id = l.id
+        WHERE e.id = ?
+    """, (emprestimo_id,))
+    emprestimo = cursor.fetchone()
+
+    if not emprestimo:
+        raise ErroEmprestimo("Empréstimo não encontrado!")
+
+    # Marcar como devolvido (só se ainda estiver emprestado, para não devolver duas vezes)
+    # e guardar com quantos dias de atraso voltou
+    data_devolucao = date.today()
+    cursor.execute("""
+        UPDATE emprestimos 
+        SET data_devolucao = ?, status = 'devolvido', atrasado = 0,
+            dias_atraso = MAX(CAST(julianday(?) - julianday(data_prevista) AS INTEGER), 0)
+        WHERE id = ? AND status = 'emprestado'
+    """, (data_devolucao, data_devolucao, emprestimo_id))
+    if cursor.rowcount == 0:
+        raise ErroEmprestimo(f"O livro '{emprestimo['titulo']}' já foi devolvido!")
+
+    # Aumentar quantidade do livro
+    cursor.execute("""
+        UPDATE livros SET quantidade = quantidade + 1 WHERE id = ?
+    """, (emprestimo['livro_id'],))
+
+    return f"Livro '{emprestimo['titulo']}' devolvido!"
+
+# Função da devolução pela página: grava e marca as versões dos caches no mesmo commit
+def devolver_pela_pagina(cursor, emprestimo_id):
+    mensagem = registrar_devolucao(cursor, emprestimo_id)
+    marcar_emprestimos_alterados(cursor, emprestimos=[emprestimo_id])
+    return mensagem
+
 # Ação para devolver livro
 @app.route("/devolver_livro", methods=["POST"])
 @precisa_ser_admin
@@ -1190,38 +2746,13 @@ def acao_devolver_livro():
     emprestimo_id = request.form.get('emprestimo_id')
 
     banco = conectar_banco()
-    cursor = banco.cursor()
 
     try:
-        # Buscar dados do empréstimo
-        cursor.execute("""
-            SELECT e.*, l.titulo FROM emprestimos e
-            JOIN livros l ON e.livro_id = l.id
-            WHERE e.id = ?
-        """, (emprestimo_id,))
-        emprestimo = cursor.fetchone()
-
-        if not emprestimo:
-            flash("Empréstimo não encontrado!")
-            banco.close()
-            return redirect(url_for('pagina_emprestimos'))
-
-        # Marcar como devolvido
-        data_devolucao = datetime.now().strftime('%Y-%m-%d')
-        cursor.execute("""
-            UPDATE emprestimos 
-            SET data_devolucao = ?, status = 'devolvido'
-            WHERE id = ?
-        """, (data_devolucao, emprestimo_id))
-
-        # Aumentar quantidade do livro
-        cursor.execute("""
-            UPDATE livros SET quantidade = quantidade + 1 WHERE id = ?
-        """, (emprestimo['livro_id'],))
-
-        banco.commit()
-        flash(f"Livro '{emprestimo['titulo']}' devolvido!")
-
+        mensagem = executar_escrita(banco, devolver_pela_pagina, emprestimo_id)
+        atualizar_caches_emprestimos()
+        flash(mensagem)
+    except ErroEmprestimo as e:
+        flash(str(e))
     except Exception as e:
         flash(f"Erro: {str(e)}")
     finally:
@@ -1229,275 +2760,1928 @@ def acao_devolver_livro():
 
     return redirect(url_for('pagina_emprestimos'))
 
-# Página de relatórios
-@app.route("/relatorios")
-@precisa_login
-def pagina_relatorios():
-    banco = conectar_banco()
-    cursor = banco.cursor()
-
-    if usuario_eh_admin():
-        # Relatórios para admin
-
-        # Livros emprestados
-        cursor.execute("""
+# Relatórios da biblioteca: a consulta de cada um, as colunas (campo, cabeçalho) que vão
+# para a exportação e se só admins podem ver. Os parâmetros :de e :ate são o período
+# pedido na URL (usado pelo histórico).
+RELATORIOS = {
+    'emprestados': {
+        'titulo': 'Livros emprestados',
+        'so_admin': True,
+        'sql': f"""
             SELECT l.titulo, l.autor, u.nome as usuario_nome, u.matricula,
-                   e.data_emprestimo, e.data_prevista
+                   e.data_emprestimo, e.data_prevista,
+                   {sql_data_br('e.data_emprestimo')} AS data_emprestimo_br,
+                   {sql_data_br('e.data_prevista')} AS data_prevista_br
             FROM emprestimos e
             JOIN livros l ON e.livro_id = l.id
             JOIN usuarios u ON e.usuario_id = u.id
             WHERE e.status = 'emprestado'
             ORDER BY e.data_emprestimo DESC
-        """)
-        livros_emprestados = cursor.fetchall()
-
-        # Empréstimos atrasados
-        cursor.execute("""
-            SELECT u.nome, u.matricula, u.curso, l.titulo, 
-                   e.data_emprestimo, e.data_prevista,
-                   julianday('now') - julianday(e.data_prevista) as dias_atraso
+        """,
+        'colunas': (('titulo', 'Livro'), ('autor', 'Autor'), ('usuario_nome', 'Usuário'),
+                    ('matricula', 'Matrícula'), ('data_emprestimo', 'Data Empréstimo'),
+                    ('data_prevista', 'Data Prevista')),
+    },
+    'atrasados': {
+        'titulo': 'Empréstimos atrasados',
+        'so_admin': True,
+        'sql': f"""
+            SELECT u.nome, u.matricula, u.curso, l.titulo,
+                   e.data_emprestimo, e.data_prevista, e.dias_atraso,
+                   {sql_data_br('e.data_prevista')} AS data_prevista_br
             FROM emprestimos e
             JOIN usuarios u ON e.usuario_id = u.id
             JOIN livros l ON e.livro_id = l.id
-            WHERE e.status = 'emprestado' AND e.data_prevista < DATE('now')
-            ORDER BY dias_atraso DESC
-        """)
-        emprestimos_atrasados = cursor.fetchall()
-
-        # Livros disponíveis
-        cursor.execute("""
+            WHERE e.atrasado = 1
+            ORDER BY e.dias_atraso DESC
+        """,
+        'colunas': (('nome', 'Usuário'), ('matricula', 'Matrícula'), ('curso', 'Curso'),
+                    ('titulo', 'Livro'), ('data_emprestimo', 'Data Empréstimo'),
+                    ('data_prevista', 'Data Prevista'), ('dias_atraso', 'Dias de Atraso')),
+    },
+    'disponiveis': {
+        'titulo': 'Livros disponíveis',
+        'so_admin': False,
+        'sql': """
             SELECT titulo, autor, isbn, ano, quantidade
             FROM livros
             WHERE quantidade > 0
             ORDER BY titulo
-        """)
-        livros_disponiveis = cursor.fetchall()
+        """,
+        'colunas': (('titulo', 'Título'), ('autor', 'Autor'), ('isbn', 'ISBN'),
+                    ('ano', 'Ano'), ('quantidade', 'Quantidade')),
+    },
+    'historico': {
+        'titulo': 'Histórico de empréstimos',
+        'so_admin': True,
+        'sql': """
+            SELECT e.data_emprestimo, e.data_prevista, e.data_devolucao, e.status,
+                   u.nome as usuario_nome, u.matricula, l.titulo, l.autor
+            FROM emprestimos e
+            JOIN usuarios u ON e.usuario_id = u.id
+            JOIN livros l ON e.livro_id = l.id
+            WHERE e.data_emprestimo BETWEEN :de AND :ate
+            ORDER BY e.data_emprestimo, e.id
+        """,
+        'colunas': (('data_emprestimo', 'Data Empréstimo'), ('data_prevista', 'Data Prevista'),
+                    ('data_devolucao', 'Data Devolução'), ('status', 'Situação'),
+                    ('usuario_nome', 'Usuário'), ('matricula', 'Matrícula'),
+                    ('titulo', 'Livro'), ('autor', 'Autor')),
+    },
+}
+
+# Período padrão do histórico quando a URL não diz (um ano até hoje)
+DIAS_HISTORICO_PADRAO = 365
+
+# Função para ler o período pedido na URL (de, ate) no formato AAAA-MM-DD
+def ler_periodo_relatorio():
+    hoje = date.today()
+    # Data que não for AAAA-MM-DD válida fica com o padrão (texto solto comparado com as datas daria lixo)
+    de = ler_data_url('de') or (hoje - timedelta(days=DIAS_HISTORICO_PADRAO)).isoformat()
+    ate = ler_data_url('ate') or hoje.isoformat()
+    return de, ate
+
+# Função para rodar a consulta de um relatório e devolver o cursor (as linhas não são lidas aqui)
+def consultar_relatorio(banco, nome):
+    de, ate = ler_periodo_relatorio()
+    return banco.execute(RELATORIOS[nome]['sql'], {'de': de, 'ate': ate})
 
+# Página de relatórios
+@app.route("/relatorios")
+@precisa_login
+@guardar_em_cache('livros', 'usuarios', 'emprestimos')
+def pagina_relatorios():
+    banco = conectar_banco()
+
+    if usuario_eh_admin():
+        # Relatórios para admin
+        livros_emprestados = consultar_relatorio(banco, 'emprestados').fetchall()
+        emprestimos_atrasados = consultar_relatorio(banco, 'atrasados').fetchall()
     else:
         # Para alunos só mostrar livros disponíveis
         livros_emprestados = []
         emprestimos_atrasados = []
 
-        cursor.execute("""
-            SELECT titulo, autor, isbn, ano, quantidade
-            FROM livros
-            WHERE quantidade > 0
-            ORDER BY titulo
-        """)
-        livros_disponiveis = cursor.fetchall()
+    livros_disponiveis = consultar_relatorio(banco, 'disponiveis').fetchall()
 
     banco.close()
 
-    # Função para criar tabela de emprestados
-    def criar_tabela_emprestados():
-        if not livros_emprestados:
-            return "<p>Nenhum livro emprestado no momento.</p>"
-
-        html = '''
-        <table class="tabela">
-            <thead>
-                <tr>
-                    <th>Livro</th>
-                    <th>Autor</th>
-                    <th>Usuário</th>
-                    <th>Matrícula</th>
-                    <th>Data Empréstimo</th>
-                    <th>Data Prevista</th>
-                </tr>
-            </thead>
-            <tbody>
-        '''
-        for item in livros_emprestados:
-            html += f'''
-                <tr>
-                    <td>{item['titulo']}</td>
-                    <td>{item['autor']}</td>
-                    <td>{item['usuario_nome']}</td>
-                    <td>{item['matricula']}</td>
-                    <td>{datetime.strptime(item['data_emprestimo'], '%Y-%m-%d').strftime('%d/%m/%Y')}</td>
-                    <td>{datetime.strptime(item['data_prevista'], '%Y-%m-%d').strftime('%d/%m/%Y')}</td>
-                </tr>
-            '''
-        html += "</tbody></table>"
-        return html
-
-    # Função para criar tabela de atrasados
-    def criar_tabela_atrasados():
-        if not emprestimos_atrasados:
-            return "<p>Nenhum empréstimo em atraso! 🎉</p>"
-
-        html = '''
-        <table class="tabela">
-            <thead>
-                <tr>
-                    <th>Usuário</th>
-                    <th>Matrícula</th>
-                    <th>Curso</th>
-                    <th>Livro</th>
-                    <th>Data Prevista</th>
-                    <th>Dias de Atraso</th>
-                </tr>
-            </thead>
-            <tbody>
-        '''
-        for item in emprestimos_atrasados:
-            dias_atraso = int(item['dias_atraso'])
-            html += f'''
-                <tr style="background-color: #ffebee;">
-                    <td>{item['nome']}</td>
-                    <td>{item['matricula']}</td>
-                    <td>{item['curso'] or 'N/A'}</td>
-                    <td>{item['titulo']}</td>
-                    <td>{datetime.strptime(item['data_prevista'], '%Y-%m-%d').strftime('%d/%m/%Y')}</td>
-                    <td style="color: red; font-weight: bold;">{dias_atraso} dias</td>
-                </tr>
-            '''
-        html += "</tbody></table>"
-        return html
-
-    # Função para criar tabela de disponíveis
-    def criar_tabela_disponiveis():
-        if not livros_disponiveis:
-            return "<p>Nenhum livro disponível.</p>"
-
-        html = '''
-        <table class="tabela">
-            <thead>
-                <tr>
-                    <th>Título</th>
-                    <th>Autor</th>
-                    <th>ISBN</th>
-                    <th>Ano</th>
-                    <th>Quantidade</th>
-                </tr>
-            </thead>
-            <tbody>
-        '''
-        for livro in livros_disponiveis:
-            html += f'''
-                <tr>
-                    <td>{livro['titulo']}</td>
-                    <td>{livro['autor']}</td>
-                    <td>{livro['isbn'] or 'N/A'}</td>
-                    <td>{livro['ano'] or 'N/A'}</td>
-                    <td style="color: green; font-weight: bold;">{livro['quantidade']}</td>
-                </tr>
-            '''
-        html += "</tbody></table>"
-        return html
-
-    # Conteúdo diferente para admin e aluno
-    if usuario_eh_admin():
-        conteudo_relatorios = f'''
-        <h2>📊 Relatórios da Biblioteca</h2>
-
-        <div style="margin-bottom: 40px;">
-            <h3>📚 Livros Emprestados</h3>
-            {criar_tabela_emprestados()}
-        </div>
-
-        <div style="margin-bottom: 40px;">
-            <h3>⚠️ Empréstimos Atrasados</h3>
-            {criar_tabela_atrasados()}
-        </div>
-
-        <div style="margin-bottom: 40px;">
-            <h3>✅ Livros Disponíveis</h3>
-            {criar_tabela_disponiveis()}
-        </div>
-
-        <div style="text-align: center; margin-top: 30px;">
-            <button onclick="window.print()" class="botao">🖨️ Imprimir</button>
-        </div>
-        '''
+    historico_de, historico_ate = ler_periodo_relatorio()
+    return renderizar_pagina("relatorios.html",
+                           livros_emprestados=livros_emprestados,
+                           emprestimos_atrasados=emprestimos_atrasados,
+                           livros_disponiveis=livros_disponiveis,
+                           historico_de=historico_de,
+                           historico_ate=historico_ate)
+
+# Quantas linhas juntar antes de mandar um pedaço da exportação para o navegador
+LINHAS_POR_PEDACO_EXPORTACAO = 500
+
+# Função para ler as linhas do cursor em blocos, sem carregar o resultado inteiro
+def linhas_do_cursor(cursor):
+    while True:
+        linhas = cursor.fetchmany(LINHAS_POR_PEDACO_EXPORTACAO)
+        if not linhas:
+            return
+        yield linhas
+
+# Exportação em CSV (com BOM, para o Excel abrir os acentos direito)
+def exportar_csv(cursor, colunas):
+    buffer = io.StringIO()
+    escritor = csv.writer(buffer)
+    buffer.write('\ufeff')
+    escritor.writerow(cabecalho for _, cabecalho in colunas)
+    for linhas in linhas_do_cursor(cursor):
+        escritor.writerows([linha[campo] for campo, _ in colunas] for linha in linhas)
+        yield buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue().encode('utf-8')
+
+# Exportação em JSON Lines: um objeto por linha, com os nomes dos campos do banco
+def exportar_jsonl(cursor, colunas):
+    for linhas in linhas_do_cursor(cursor):
+        yield ''.join(
+            json.dumps({campo: linha[campo] for campo, _ in colunas}, ensure_ascii=False) + '\n'
+            for linha in linhas
+        ).encode('utf-8')
+
+# Arquivo que só guarda o que foi escrito até alguém buscar; o zipfile escreve nele
+# e a exportação XLSX manda os pedaços para o navegador conforme vão saindo.
+# Como não dá para voltar atrás (seek), o zipfile grava os tamanhos depois de cada arquivo.
+class SaidaEmPedacos(io.RawIOBase):
+    def __init__(self):
+        self.pedacos = []
+
+    def writable(self):
+        return True
+
+    def write(self, dados):
+        self.pedacos.append(bytes(dados))
+        return len(dados)
+
+    def retirar(self):
+        dados = b''.join(self.pedacos)
+        self.pedacos = []
+        return dados
+
+# Partes fixas de uma planilha XLSX com uma aba só
+PARTES_XLSX = {
+    '[Content_Types].xml': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/xl/workbook.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+        '<Override PartName="/xl/worksheets/sheet1.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+        '</Types>'
+    ),
+    '_rels/.rels': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" '
+        'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" '
+        'Target="xl/workbook.xml"/>'
+        '</Relationships>'
+    ),
+    'xl/_rels/workbook.xml.rels': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" '
+        'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" '
+        'Target="worksheets/sheet1.xml"/>'
+        '</Relationships>'
+    ),
+}
+
+# Caracteres que não podem aparecer em XML
+CARACTERES_INVALIDOS_XML = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+# Função para montar uma linha da planilha (texto vai como inlineStr, números como número)
+def linha_xlsx(valores):
+    celulas = []
+    for valor in valores:
+        if valor is None:
+            celulas.append('<c/>')
+        elif isinstance(valor, (int, float)) and not isinstance(valor, bool):
+            celulas.append(f'<c><v>{valor}</v></c>')
+        else:
+            texto = CARACTERES_INVALIDOS_XML.sub('', str(valor))
+            texto = texto.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+            celulas.append(f'<c t="inlineStr"><is><t xml:space="preserve">{texto}</t></is></c>')
+    return '<row>' + ''.join(celulas) + '</row>'
+
+# Exportação em XLSX, escrita com o zipfile direto na resposta
+def exportar_xlsx(cursor, colunas, nome_aba):
+    saida = SaidaEmPedacos()
+    with zipfile.ZipFile(saida, 'w', zipfile.ZIP_DEFLATED) as arquivo_zip:
+        for nome, conteudo in PARTES_XLSX.items():
+            arquivo_zip.writestr(nome, conteudo)
+        arquivo_zip.writestr('xl/workbook.xml', (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+            '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+            'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+            f'<sheets><sheet name="{nome_aba[:31]}" sheetId="1" r:id="rId1"/></sheets>'
+            '</workbook>'
+        ))
+        yield saida.retirar()
+
+        with arquivo_zip.open('xl/worksheets/sheet1.xml', 'w') as planilha:
+            planilha.write((
+                '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+                '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>'
+                + linha_xlsx(cabecalho for _, cabecalho in colunas)
+            ).encode('utf-8'))
+            for linhas in linhas_do_cursor(cursor):
+                planilha.write(''.join(
+                    linha_xlsx(linha[campo] for campo, _ in colunas) for linha in linhas
+                ).encode('utf-8'))
+                yield saida.retirar()
+            planilha.write(b'</sheetData></worksheet>')
+    yield saida.retirar()
+
+# Tipo de conteúdo de cada formato de exportação
+FORMATOS_EXPORTACAO = {
+    'csv': 'text/csv; charset=utf-8',
+    'jsonl': 'application/x-ndjson; charset=utf-8',
+    'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+}
+
+# Exportação de um relatório (CSV, JSON Lines ou XLSX)
+# As linhas saem do cursor direto para a resposta, então relatórios grandes
+# (como um ano inteiro de histórico) não ficam inteiros na memória.
+@app.route("/relatorios/exportar/<nome>.<formato>")
+@precisa_login
+def exportar_relatorio(nome, formato):
+    relatorio = RELATORIOS.get(nome)
+    if relatorio is None or formato not in FORMATOS_EXPORTACAO:
+        flash("Relatório não encontrado!")
+        return redirect(url_for('pagina_relatorios'))
+    if relatorio['so_admin'] and not usuario_eh_admin():
+        flash("Você precisa ser administrador para acessar esta página!")
+        return redirect(url_for('pagina_inicial'))
+
+    banco = conectar_banco()
+    cursor = consultar_relatorio(banco, nome)
+    colunas = relatorio['colunas']
+
+    if formato == 'csv':
+        partes = exportar_csv(cursor, colunas)
+    elif formato == 'jsonl':
+        partes = exportar_jsonl(cursor, colunas)
     else:
-        conteudo_relatorios = f'''
-        <h2>📊 Livros Disponíveis</h2>
+        partes = exportar_xlsx(cursor, colunas, relatorio['titulo'])
+
+    # A conexão fica com a requisição até a última linha ser enviada
+    nome_arquivo = f"{nome}-{date.today().isoformat()}.{formato}"
+    return Response(stream_with_context(partes), mimetype=FORMATOS_EXPORTACAO[formato],
+                    headers={'Content-Disposition': f'attachment; filename="{nome_arquivo}"'})
+
+# API JSON (versão 1) para os quiosques e o aplicativo: as mesmas regras das páginas, sem HTML
+# e sem redirecionamentos. O login é pela própria API (POST /api/v1/sessao) e usa o mesmo
+# cookie de sessão das páginas.
+# Listas: ?campos=id,titulo escolhe os campos; ?limite= (até LIMITE_MAXIMO_API) e ?cursor=
+# paginam pela última linha devolvida (o "proximo_cursor" da resposta anterior), então cada
+# página custa o mesmo tanto, como na lista de livros.
+# Lotes: POST /api/v1/emprestimos e /api/v1/devolucoes recebem {"itens": [...]} e gravam tudo
+# numa transação só, passando cada item por registrar_emprestimo/registrar_devolucao, e
+# respondem o resultado de cada item. Com "tudo_ou_nada": true, um item com erro desfaz o lote.
+# Erros respondem {"erro": "mensagem"} com o código HTTP certo.
+LIMITE_PADRAO_API = 50
+LIMITE_MAXIMO_API = 200
+MAXIMO_ITENS_LOTE_API = 100
+
+# Campos que cada lista da API pode devolver (nome na resposta: expressão SQL) e a ordem
+# da paginação (colunas da tabela, a última é o id para desempatar)
+RECURSOS_API = {
+    'livros': {
+        'campos': {'id': 'id', 'titulo': 'titulo', 'autor': 'autor', 'isbn': 'isbn', 'ano': 'ano',
+                   'quantidade': 'quantidade'},
+        'ordem': ('titulo', 'id'),
+        'decrescente': False,
+    },
+    'usuarios': {
+        'campos': {'id': 'id', 'nome': 'nome', 'matricula': 'matricula', 'curso': 'curso'},
+        'ordem': ('nome', 'id'),
+        # Nomes sem diferenciar maiúsculas, como no autocompletar (índice idx_usuarios_nome_nocase)
+        'colacao': {'nome': 'NOCASE'},
+        'decrescente': False,
+    },
+    'emprestimos': {
+        'campos': {'id': 'id', 'usuario_id': 'usuario_id', 'livro_id': 'livro_id',
+                   'data_emprestimo': 'data_emprestimo', 'data_prevista': 'data_prevista',
+                   'data_devolucao': 'data_devolucao', 'status': 'status', 'atrasado': 'atrasado',
+                   'dias_atraso': 'dias_atraso',
+                   # Só são buscados quando pedidos em ?campos=
+                   'livro_titulo': '(SELECT titulo FROM livros WHERE livros.id = emprestimos.livro_id)',
+                   'usuario_nome': '(SELECT nome FROM usuarios WHERE usuarios.id = emprestimos.usuario_id)'},
+        'campos_padrao': ('id', 'usuario_id', 'livro_id', 'data_emprestimo', 'data_prevista', 'data_devolucao',
+                          'status', 'atrasado', 'dias_atraso'),
+        'ordem': ('data_emprestimo', 'id'),
+        'decrescente': True,  # os mais recentes primeiro
+    },
+}
+
+# Erro devolvido pela API como {"erro": mensagem}
+class ErroApi(Exception):
+    def __init__(self, mensagem, status=400):
+        super().__init__(mensagem)
+        self.status = status
+
+# Lote com tudo_ou_nada que teve algum item com erro (nada foi gravado)
+class LoteRecusado(Exception):
+    def __init__(self, resultados):
+        super().__init__("lote recusado")
+        self.resultados = resultados
+
+@app.errorhandler(ErroApi)
+def responder_erro_api(erro):
+    return jsonify({'erro': str(erro)}), erro.status
+
+# Função decoradora para exigir login nas rotas da API (responde 401 em vez de redirecionar)
+def precisa_login_api(funcao):
+    def funcao_protegida(*args, **kwargs):
+        if 'tipo_usuario' not in session:
+            raise ErroApi("Faça login em /api/v1/sessao", 401)
+        return funcao(*args, **kwargs)
+    funcao_protegida.__name__ = funcao.__name__
+    return funcao_protegida
 
-        <div style="margin-bottom: 40px;">
-            <h3>✅ Livros para Empréstimo</h3>
-            {criar_tabela_disponiveis()}
-        </div>
+# Função decoradora para exigir admin nas rotas da API
+def precisa_ser_admin_api(funcao):
+    def funcao_protegida(*args, **kwargs):
+        if 'tipo_usuario' not in session:
+            raise ErroApi("Faça login em /api/v1/sessao", 401)
+        if not usuario_eh_admin():
+            raise ErroApi("Só administradores podem fazer isso", 403)
+        return funcao(*args, **kwargs)
+    funcao_protegida.__name__ = funcao.__name__
+    return funcao_protegida
 
-        <div style="background: #f8f9fa; padding: 20px; border-radius: 10px; margin-top: 30px;">
-            <h4>ℹ️ Como emprestar:</h4>
-            <p>Para emprestar um livro, procure um administrador com sua matrícula e o nome do livro.</p>
-        </div>
-        '''
+# Função para ler o corpo JSON do pedido (tem que ser um objeto)
+def ler_json_api():
+    dados = request.get_json(silent=True)
+    if not isinstance(dados, dict):
+        raise ErroApi("Envie um objeto JSON (Content-Type: application/json)")
+    return dados
+
+# Função para ler ?campos= (vazio: os campos padrão do recurso)
+def ler_campos_api(recurso):
+    config = RECURSOS_API[recurso]
+    pedidos = [campo.strip() for campo in request.args.get('campos', '').split(',') if campo.strip()]
+    if not pedidos:
+        return list(config.get('campos_padrao', config['campos']))
+    desconhecidos = [campo for campo in pedidos if campo not in config['campos']]
+    if desconhecidos:
+        raise ErroApi(f"Campos desconhecidos: {', '.join(desconhecidos)} "
+                      f"(disponíveis: {', '.join(config['campos'])})")
+    return list(dict.fromkeys(pedidos))
+
+# Funções para o cursor da paginação: os valores da ordem da última linha, em base64
+def codificar_cursor_api(valores):
+    return base64.urlsafe_b64encode(json.dumps(valores).encode()).decode().rstrip('=')
+
+def decodificar_cursor_api(texto, tamanho):
+    try:
+        valores = json.loads(base64.urlsafe_b64decode(texto + '=' * (-len(texto) % 4)))
+    except ValueError:
+        raise ErroApi("Cursor inválido")
+    if not isinstance(valores, list) or len(valores) != tamanho:
+        raise ErroApi("Cursor inválido")
+    return valores
+
+# Função para montar uma página de uma lista da API
+# condicoes/parametros: filtros do recurso (ex: só os empréstimos do aluno); indice: força
+# o índice da consulta (INDEXED BY)
+def listar_api(banco, recurso, condicoes=(), parametros=(), indice=None):
+    config = RECURSOS_API[recurso]
+    campos = ler_campos_api(recurso)
+    limite = min(max(request.args.get('limite', LIMITE_PADRAO_API, type=int), 1), LIMITE_MAXIMO_API)
+    ordem = config['ordem']
+    # Colunas com COLLATE são comparadas e ordenadas com ele (igual ao índice que as lê)
+    colacao = config.get('colacao', {})
+    expressoes = [f"{coluna} COLLATE {colacao[coluna]}" if coluna in colacao else coluna for coluna in ordem]
+    condicoes, parametros = list(condicoes), list(parametros)
+
+    if request.args.get('cursor'):
+        comparacao = '<' if config['decrescente'] else '>'
+        valores = decodificar_cursor_api(request.args['cursor'], len(ordem))
+        # A primeira coluna sozinha também: com COLLATE o SQLite só lê a faixa do índice por ela
+        condicoes.append(f"{expressoes[0]} {comparacao}= ?")
+        condicoes.append(f"({', '.join(expressoes)}) {comparacao} ({', '.join('?' * len(ordem))})")
+        parametros += [valores[0], *valores]
+
+    direcao = ' DESC' if config['decrescente'] else ''
+    selecionados = [f"{config['campos'][campo]} AS {campo}" for campo in campos]
+    selecionados += [f"{coluna} AS _ordem_{coluna}" for coluna in ordem]
+    linhas = banco.execute(f"""
+        SELECT {', '.join(selecionados)}
+        FROM {recurso} {'INDEXED BY ' + indice if indice else ''}
+        {'WHERE ' + ' AND '.join(condicoes) if condicoes else ''}
+        ORDER BY {', '.join(expressao + direcao for expressao in expressoes)}
+        LIMIT ?
+    """, parametros + [limite + 1]).fetchall()
+
+    proximo = None
+    if len(linhas) > limite:
+        linhas = linhas[:limite]
+        proximo = codificar_cursor_api([linhas[-1][f"_ordem_{coluna}"] for coluna in ordem])
+    return {'itens': [{campo: linha[campo] for campo in campos} for linha in linhas], 'proximo_cursor': proximo}
+
+# Função para buscar um registro só pelo id, com os campos pedidos (404 se não existir)
+def buscar_registro_api(banco, recurso, registro_id, condicoes=(), parametros=()):
+    config = RECURSOS_API[recurso]
+    campos = ler_campos_api(recurso)
+    linha = banco.execute(f"""
+        SELECT {', '.join(f"{config['campos'][campo]} AS {campo}" for campo in campos)}
+        FROM {recurso}
+        WHERE {' AND '.join(['id = ?', *condicoes])}
+    """, [registro_id, *parametros]).fetchone()
+    if linha is None:
+        raise ErroApi("Não encontrado", 404)
+    return {campo: linha[campo] for campo in campos}
+
+# Função que insere uma linha e devolve o id dela (usada dentro de executar_escrita)
+def inserir_registro(cursor, sql, valores):
+    return cursor.execute(sql, valores).lastrowid
+
+# Login pela API: {"tipo_usuario": "admin", "usuario": ..., "senha": ...}
+# ou {"tipo_usuario": "aluno", "matricula": ...}
+@app.route("/api/v1/sessao", methods=["POST"])
+def api_entrar():
+    dados = ler_json_api()
+    tipo_usuario = dados.get('tipo_usuario')
+
+    if tipo_usuario == 'admin':
+        try:
+            registro = autenticar_admin(str(dados.get('usuario', '')), str(dados.get('senha', '')))
+        except FilaSenhasCheia as e:
+            return jsonify({'erro': str(e)}), 503, {'Retry-After': '1'}
+        if registro is None:
+            raise ErroApi("Usuário ou senha incorretos!", 401)
+    elif tipo_usuario == 'aluno':
+        registro = autenticar_aluno(str(dados.get('matricula', '')))
+        if registro is None:
+            raise ErroApi("Matrícula não encontrada!", 401)
+    else:
+        raise ErroApi("tipo_usuario deve ser 'admin' ou 'aluno'")
 
-    return render_template_string(TEMPLATE_HTML, titulo="Relatórios", conteudo=conteudo_relatorios)
+    session.clear()
+    abrir_sessao(tipo_usuario, registro)
+    return api_ver_sessao()
+
+# Quem está logado
+@app.route("/api/v1/sessao")
+@precisa_login_api
+def api_ver_sessao():
+    return jsonify({'tipo_usuario': session['tipo_usuario'], 'nome': session['nome_usuario'],
+                    'usuario_id': session['usuario_id'], 'matricula': session.get('matricula_usuario')})
+
+# Sair
+@app.route("/api/v1/sessao", methods=["DELETE"])
+def api_sair():
+    if usuario_eh_aluno():
+        esquecer_contexto_aluno(session.get('usuario_id'))
+    session.clear()
+    return '', 204
 
-# Função para inserir dados de exemplo
-def inserir_dados_exemplo():
+# Livros (?q= busca por título, autor ou ISBN, do mais relevante para o menos, sem cursor)
+@app.route("/api/v1/livros")
+@precisa_login_api
+def api_listar_livros():
     banco = conectar_banco()
-    cursor = banco.cursor()
+    if request.args.get('q'):
+        campos = ler_campos_api('livros')
+        limite = min(max(request.args.get('limite', LIMITE_PADRAO_API, type=int), 1), LIMITE_MAXIMO_API)
+        livros = buscar_livros(banco, request.args['q'], limite)
+        resposta = {'itens': [{campo: livro[campo] for campo in campos} for livro in livros], 'proximo_cursor': None}
+    else:
+        condicoes = ['quantidade > 0'] if request.args.get('disponiveis') == '1' else []
+        resposta = listar_api(banco, 'livros', condicoes)
+    banco.close()
+    return jsonify(resposta)
 
-    # Verificar se já tem dados
-    cursor.execute("SELECT COUNT(*) as total FROM livros")
-    if cursor.fetchone()['total'] > 0:
+@app.route("/api/v1/livros/<int:livro_id>")
+@precisa_login_api
+def api_ver_livro(livro_id):
+    banco = conectar_banco()
+    livro = buscar_registro_api(banco, 'livros', livro_id)
+    banco.close()
+    return jsonify(livro)
+
+# Cadastro de livro, com a mesma validação da importação
+@app.route("/api/v1/livros", methods=["POST"])
+@precisa_ser_admin_api
+def api_cadastrar_livro():
+    try:
+        valores = validar_linha_importacao('livros', ler_json_api())
+    except ValueError as e:
+        raise ErroApi(str(e))
+
+    banco = conectar_banco()
+    try:
+        livro_id = executar_escrita(banco, inserir_registro, """
+            INSERT INTO livros (titulo, autor, isbn, ano, quantidade) VALUES (?, ?, ?, ?, ?)
+        """, valores)
+    except sqlite3.IntegrityError:
+        raise ErroApi("Este ISBN já existe!", 409)
+    invalidar_cache('livros')
+    livro = buscar_registro_api(banco, 'livros', livro_id)
+    banco.close()
+    return jsonify(livro), 201
+
+# Usuários (só admins; ?q= filtra pelo começo do nome)
+@app.route("/api/v1/usuarios")
+@precisa_ser_admin_api
+def api_listar_usuarios():
+    condicoes, parametros = [], []
+    if request.args.get('q'):
+        # Mesmo prefixo do autocompletar: sem diferenciar maiúsculas, pela faixa do índice NOCASE
+        condicoes.append("nome LIKE ? ESCAPE '\\'")
+        parametros.append(padrao_prefixo(request.args['q']))
+    banco = conectar_banco()
+    resposta = listar_api(banco, 'usuarios', condicoes, parametros)
+    banco.close()
+    return jsonify(resposta)
+
+# Um usuário (admins veem qualquer um; alunos, só a si mesmos)
+@app.route("/api/v1/usuarios/<int:usuario_id>")
+@precisa_login_api
+def api_ver_usuario(usuario_id):
+    if not usuario_eh_admin() and usuario_id != session['usuario_id']:
+        raise ErroApi("Não encontrado", 404)
+    banco = conectar_banco()
+    usuario = buscar_registro_api(banco, 'usuarios', usuario_id)
+    banco.close()
+    return jsonify(usuario)
+
+# Cadastro de usuário, com a mesma validação da importação
+@app.route("/api/v1/usuarios", methods=["POST"])
+@precisa_ser_admin_api
+def api_cadastrar_usuario():
+    try:
+        valores = validar_linha_importacao('usuarios', ler_json_api())
+    except ValueError as e:
+        raise ErroApi(str(e))
+
+    banco = conectar_banco()
+    try:
+        usuario_id = executar_escrita(banco, inserir_registro, """
+            INSERT INTO usuarios (nome, matricula, curso) VALUES (?, ?, ?)
+        """, valores)
+    except sqlite3.IntegrityError:
+        raise ErroApi("Esta matrícula já existe!", 409)
+    invalidar_cache('usuarios')
+    usuario = buscar_registro_api(banco, 'usuarios', usuario_id)
+    banco.close()
+    return jsonify(usuario), 201
+
+# Função para os filtros da lista de empréstimos (alunos só veem os seus)
+# ?status=emprestado|devolvido, ?atrasados=1 e, para admins, ?usuario_id=
+# Devolve também o índice a usar: sem estatísticas (ANALYZE) o SQLite prefere o índice de
+# status e ordena tudo depois, o que com centenas de milhares de devolvidos leva segundos
+def filtros_emprestimos_api():
+    condicoes, parametros = [], []
+    indice = None
+    usuario_id = session['usuario_id'] if usuario_eh_aluno() else request.args.get('usuario_id', type=int)
+    if usuario_id is not None:
+        condicoes.append("usuario_id = ?")
+        parametros.append(usuario_id)
+    atrasados = request.args.get('atrasados') == '1'
+    if atrasados:
+        condicoes.append("atrasado = 1")
+
+    status = request.args.get('status')
+    if status == 'emprestado':
+        # Os atrasados já são todos emprestados; o filtro de status só atrapalharia o índice
+        if not atrasados:
+            condicoes.append("status = 'emprestado'")
+            if usuario_id is None:
+                indice = 'idx_emprestimos_ativos_data'
+    elif status == 'devolvido':
+        # Quase todos estão devolvidos: melhor seguir o índice de datas, na ordem da lista
+        condicoes.append("+status = 'devolvido'")
+    elif status:
+        raise ErroApi("status deve ser 'emprestado' ou 'devolvido'")
+    return condicoes, parametros, indice
+
+@app.route("/api/v1/emprestimos")
+@precisa_login_api
+def api_listar_emprestimos():
+    condicoes, parametros, indice = filtros_emprestimos_api()
+    banco = conectar_banco()
+    resposta = listar_api(banco, 'emprestimos', condicoes, parametros, indice)
+    banco.close()
+    return jsonify(resposta)
+
+@app.route("/api/v1/emprestimos/<int:emprestimo_id>")
+@precisa_login_api
+def api_ver_emprestimo(emprestimo_id):
+    condicoes, parametros = (["usuario_id = ?"], [session['usuario_id']]) if usuario_eh_aluno() else ([], [])
+    banco = conectar_banco()
+    emprestimo = buscar_registro_api(banco, 'emprestimos', emprestimo_id, condicoes, parametros)
+    banco.close()
+    return jsonify(emprestimo)
+
+# Função que roda um item de lote num SAVEPOINT: se der ErroEmprestimo só ele é desfeito,
+# e o resultado dele diz o porquê. registrar devolve (id do empréstimo, mensagem).
+def registrar_item_lote(cursor, registrar, *argumentos):
+    cursor.execute("SAVEPOINT item_lote")
+    try:
+        emprestimo_id, mensagem = registrar(cursor, *argumentos)
+        cursor.execute("RELEASE item_lote")
+        return {'ok': True, 'emprestimo_id': emprestimo_id, 'mensagem': mensagem}
+    except ErroEmprestimo as e:
+        cursor.execute("ROLLBACK TO item_lote")
+        cursor.execute("RELEASE item_lote")
+        return {'ok': False, 'erro': str(e)}
+
+# Função para recusar o lote inteiro (com tudo_ou_nada) se algum item deu erro
+def conferir_tudo_ou_nada(tudo_ou_nada, *listas_de_resultados):
+    resultados = [resultado for lista in listas_de_resultados for resultado in lista]
+    if tudo_ou_nada and not all(resultado['ok'] for resultado in resultados):
+        raise LoteRecusado([[resultado if not resultado['ok'] else
+                             {'ok': False, 'erro': "Desfeito: outro item do lote teve erro"}
+                             for resultado in lista] for lista in listas_de_resultados])
+
+# Função que grava um lote de empréstimos ou devoluções (usada dentro de executar_escrita)
+# Cada item roda num SAVEPOINT: o item com erro é desfeito e os outros continuam.
+# afetados: 'usuarios' ou 'emprestimos', o que o primeiro valor de cada item identifica; as
+# versões dos caches sobem no mesmo commit, só para os itens gravados.
+def registrar_lote(cursor, registrar, itens, tudo_ou_nada, afetados):
+    resultados = []
+    for argumentos in itens:
+        if isinstance(argumentos, ErroEmprestimo):
+            resultados.append({'ok': False, 'erro': str(argumentos)})
+        else:
+            resultados.append(registrar_item_lote(cursor, registrar, *argumentos))
+    conferir_tudo_ou_nada(tudo_ou_nada, resultados)
+    gravados = [argumentos[0] for argumentos, resultado in zip(itens, resultados) if resultado['ok']]
+    if gravados:
+        marcar_emprestimos_alterados(cursor, **{afetados: gravados})
+    return resultados
+
+# Funções que adaptam as regras das páginas para o lote (devolvem também o id do empréstimo)
+def registrar_emprestimo_do_lote(cursor, usuario_id, livro_id):
+    mensagem = registrar_emprestimo(cursor, usuario_id, livro_id)
+    return cursor.lastrowid, mensagem
+
+def registrar_devolucao_do_lote(cursor, emprestimo_id):
+    return emprestimo_id, registrar_devolucao(cursor, emprestimo_id)
+
+# Função para ler os itens de um lote; item mal formado vira ErroEmprestimo e só ele falha
+def ler_itens_lote(campos):
+    dados = ler_json_api()
+    itens = dados.get('itens')
+    if not isinstance(itens, list) or not itens:
+        raise ErroApi('Envie {"itens": [...]} com pelo menos um item')
+    if len(itens) > MAXIMO_ITENS_LOTE_API:
+        raise ErroApi(f"No máximo {MAXIMO_ITENS_LOTE_API} itens por lote", 413)
+
+    lidos = []
+    for item in itens:
+        try:
+            if not isinstance(item, dict):
+                raise ValueError("item deve ser um objeto")
+            valores = tuple(ler_inteiro(item.get(campo), campo) for campo in campos)
+            if None in valores:
+                raise ValueError(f"informe {' e '.join(campos)}")
+            lidos.append(valores)
+        except ValueError as e:
+            lidos.append(ErroEmprestimo(str(e)))
+    return lidos, bool(dados.get('tudo_ou_nada'))
+
+# Função para gravar um lote e montar a resposta
+def responder_lote(registrar, itens, tudo_ou_nada, afetados):
+    banco = conectar_banco()
+    try:
+        resultados = executar_escrita(banco, registrar_lote, registrar, itens, tudo_ou_nada, afetados)
+    except LoteRecusado as e:
+        return jsonify({'gravados': 0, 'resultados': e.resultados[0]}), 409
+    finally:
         banco.close()
-        return
 
-    # Inserir livros de exemplo
-    livros_exemplo = [
-        ("Dom Casmurro", "Machado de Assis", "978-85-359-0277-5", 1899, 2),
-        ("O Cortiço", "Aluísio Azevedo", "978-85-260-1631-8", 1890, 1),
-        ("Capitães da Areia", "Jorge Amado", "978-85-254-0024-7", 1937, 3),
-        ("Python para Iniciantes", "Eric Matthes", "978-85-7522-718-3", 2019, 2),
-        ("Algoritmos e Estruturas de Dados", "Thomas Cormen", "978-85-352-8913-9", 2012, 1),
-        ("História do Brasil", "Boris Fausto", "978-85-314-0556-2", 2013, 2)
-    ]
-
-    for livro in livros_exemplo:
-        cursor.execute("""
-            INSERT INTO livros (titulo, autor, isbn, ano, quantidade)
-            VALUES (?, ?, ?, ?, ?)
-        """, livro)
-
-    # Inserir usuários de exemplo
-    usuarios_exemplo = [
-        ("João Silva Santos", "2024001", "Análise e Desenvolvimento de Sistemas"),
-        ("Maria Oliveira Lima", "2024002", "Engenharia de Software"),
-        ("Pedro Costa Ferreira", "2024003", "Sistemas de Informação"),
-        ("Leticia Rodrigues", "2024004", "Química"),
-        ("Carlos Eduardo Souza", "2024005", "Zootecnia")
-    ]
-
-    for usuario in usuarios_exemplo:
-        cursor.execute("""
-            INSERT INTO usuarios (nome, matricula, curso)
-            VALUES (?, ?, ?)
-        """, usuario)
+    gravados = sum(resultado['ok'] for resultado in resultados)
+    if gravados:
+        atualizar_caches_emprestimos()
+    return jsonify({'gravados': gravados, 'resultados': resultados})
+
+# Empréstimos em lote: {"itens": [{"usuario_id": 1, "livro_id": 2}, ...], "tudo_ou_nada": false}
+@app.route("/api/v1/emprestimos", methods=["POST"])
+@precisa_ser_admin_api
+def api_fazer_emprestimos():
+    itens, tudo_ou_nada = ler_itens_lote(('usuario_id', 'livro_id'))
+    return responder_lote(registrar_emprestimo_do_lote, itens, tudo_ou_nada, 'usuarios')
+
+# Devoluções em lote: {"itens": [{"emprestimo_id": 10}, ...], "tudo_ou_nada": false}
+@app.route("/api/v1/devolucoes", methods=["POST"])
+@precisa_ser_admin_api
+def api_devolver_livros():
+    itens, tudo_ou_nada = ler_itens_lote(('emprestimo_id',))
+    return responder_lote(registrar_devolucao_do_lote, itens, tudo_ou_nada, 'emprestimos')
+
+# Atendimento no balcão (cesta): tudo o que um aluno devolve e pega numa visita, gravado numa
+# transação só, em vez de um POST (e um commit) por livro. As devoluções vêm primeiro, então
+# quem devolve 2 e pega 3 não esbarra no limite; o limite é conferido uma vez, depois delas.
+# Cada item tem o seu resultado; com tudo_ou_nada, um erro desfaz a cesta inteira.
+
+# Função que devolve um livro da cesta (o empréstimo tem que ser do aluno atendido)
+def devolver_da_cesta(cursor, usuario_id, emprestimo_id):
+    dono = cursor.execute("SELECT usuario_id FROM emprestimos WHERE id = ?", (emprestimo_id,)).fetchone()
+    if dono and dono['usuario_id'] != usuario_id:
+        raise ErroEmprestimo("Este empréstimo é de outro aluno!")
+    return emprestimo_id, registrar_devolucao(cursor, emprestimo_id)
+
+# Função que empresta um livro da cesta (o limite já foi conferido para a cesta toda)
+def emprestar_da_cesta(cursor, usuario_id, livro_id):
+    return gravar_emprestimo(cursor, usuario_id, livro_id), "Empréstimo realizado com sucesso!"
+
+# Função que grava a cesta de um aluno (usada dentro de executar_escrita); as versões dos
+# caches sobem no mesmo commit, então a cesta inteira custa uma transação de escrita só
+def registrar_cesta(cursor, usuario_id, devolucoes, emprestimos, tudo_ou_nada):
+    resultados_devolucoes = [registrar_item_lote(cursor, devolver_da_cesta, usuario_id, emprestimo_id)
+                             for emprestimo_id in devolucoes]
+
+    # Aluno que não existe desfaz a cesta toda (ErroEmprestimo sai da transação)
+    vagas = vagas_do_aluno(cursor, usuario_id)
+    resultados_emprestimos = []
+    for livro_id in emprestimos:
+        if vagas <= 0:
+            resultados_emprestimos.append(
+                {'ok': False, 'erro': f"Este usuário já tem {LIMITE_EMPRESTIMOS} livros emprestados!"})
+            continue
+        resultado = registrar_item_lote(cursor, emprestar_da_cesta, usuario_id, livro_id)
+        vagas -= resultado['ok']
+        resultados_emprestimos.append(resultado)
+
+    conferir_tudo_ou_nada(tudo_ou_nada, resultados_devolucoes, resultados_emprestimos)
+    if any(item['ok'] for item in resultados_devolucoes + resultados_emprestimos):
+        marcar_emprestimos_alterados(cursor, usuarios=[usuario_id])
+    return {'devolucoes': resultados_devolucoes, 'emprestimos': resultados_emprestimos}
+
+# Cesta: {"usuario_id": 5, "devolucoes": [10, 11], "emprestimos": [3, 4, 7], "tudo_ou_nada": false}
+# devolucoes são ids de empréstimos; emprestimos são ids de livros
+@app.route("/api/v1/cestas", methods=["POST"])
+@precisa_ser_admin_api
+def api_atender_cesta():
+    dados = ler_json_api()
+    for campo in ('devolucoes', 'emprestimos'):
+        if not isinstance(dados.get(campo) or [], list):
+            raise ErroApi(f"{campo} deve ser uma lista de ids")
+    try:
+        usuario_id = ler_inteiro(dados.get('usuario_id'), 'usuario_id')
+        devolucoes = [ler_inteiro(valor, 'devolucoes') for valor in dados.get('devolucoes') or []]
+        emprestimos = [ler_inteiro(valor, 'emprestimos') for valor in dados.get('emprestimos') or []]
+    except ValueError as e:
+        raise ErroApi(str(e))
+    if usuario_id is None or None in devolucoes + emprestimos:
+        raise ErroApi("Informe usuario_id e listas de ids em devolucoes e emprestimos")
+    if not (devolucoes or emprestimos):
+        raise ErroApi("A cesta está vazia")
+    if len(devolucoes) + len(emprestimos) > MAXIMO_ITENS_LOTE_API:
+        raise ErroApi(f"No máximo {MAXIMO_ITENS_LOTE_API} itens por cesta", 413)
 
-    # Inserir alguns empréstimos de exemplo
-    emprestimos_exemplo = [
-        (1, 1, "2025-05-20", "2025-05-27"),
-        (2, 4, "2025-05-22", "2025-05-29"),
-        (3, 5, "2025-05-15", "2025-05-22"),
-    ]
+    banco = conectar_banco()
+    try:
+        resultado = executar_escrita(banco, registrar_cesta, usuario_id, devolucoes, emprestimos,
+                                     bool(dados.get('tudo_ou_nada')))
+    except LoteRecusado as e:
+        return jsonify({'gravados': 0, 'devolucoes': e.resultados[0], 'emprestimos': e.resultados[1]}), 409
+    except ErroEmprestimo as e:
+        raise ErroApi(str(e), 404)
+    finally:
+        banco.close()
 
-    for emp in emprestimos_exemplo:
-        cursor.execute("""
-            INSERT INTO emprestimos (usuario_id, livro_id, data_emprestimo, data_prevista)
-            VALUES (?, ?, ?, ?)
-        """, emp)
+    gravados = sum(item['ok'] for item in resultado['devolucoes'] + resultado['emprestimos'])
+    if gravados:
+        atualizar_caches_emprestimos()
+    return jsonify({'gravados': gravados, **resultado})
 
-        # Diminuir quantidade do livro
-        cursor.execute("""
-            UPDATE livros SET quantidade = quantidade - 1 WHERE id = ?
-        """, (emp[1],))
+# Estatísticas internas do sistema (só admins)
+@app.route("/estatisticas")
+@precisa_ser_admin
+def pagina_estatisticas():
+    return jsonify({
+        'pool_conexoes': obter_estatisticas_pool(),
+        'cache_paginas': obter_estatisticas_cache(),
+        'fila_senhas': obter_estatisticas_senhas(),
+        'notificacoes': obter_estatisticas_notificacoes(),
+        'contextos_alunos': obter_estatisticas_contextos(),
+        'sessoes': obter_estatisticas_sessoes(),
+        'asgi': obter_estatisticas_asgi(),
+    })
+
+# Rodar agora a varredura de atrasos e o envio dos avisos (sem esperar o agendador)
+@app.route("/atrasados/varrer", methods=["POST"])
+@precisa_ser_admin
+def pagina_varrer_atrasados():
+    varredura = executar_varredura(forcar=True)
+    envio = enviar_notificacoes()
+    return jsonify({'varredura': varredura, 'envio': envio})
+
+# Encerrar as sessões de todo mundo (ex: depois de trocar a senha do admin)
+# Quem pediu continua logado: a sessão dele é gravada de novo, já na geração nova
+@app.route("/sessoes/encerrar", methods=["POST"])
+@precisa_ser_admin
+def pagina_encerrar_sessoes():
+    if not isinstance(app.session_interface, SessoesNoBanco):
+        return jsonify({'erro': "Com as sessões no cookie (BIBLIOTECA_SESSOES=cookie) não dá para encerrá-las"}), 409
+    geracao = encerrar_todas_as_sessoes()
+    # O admin que encerrou continua entrado, já na geração nova
+    session.carregar()
+    session.geracao = geracao
+    session.modified = True
+    return jsonify({'geracao': geracao})
+
+# Instrumentação: tempo de cada consulta (com linhas lidas e plano), e quanto de cada rota
+# foi banco, template e Python. Fica desligada por padrão e, desligada, não custa nada:
+# as conexões são as normais e os sinais do Flask não têm ninguém ouvindo.
+# Liga com BIBLIOTECA_INSTRUMENTACAO=1 (ou ligar_instrumentacao()); com
+# BIBLIOTECA_RODAPE_DEBUG=1 as páginas dos admins ganham um rodapé com as medições.
+# O tempo de banco de respostas transmitidas aos poucos não entra (a rota já terminou).
+CONFIGURACAO_INSTRUMENTACAO = {
+    'ativa': os.environ.get('BIBLIOTECA_INSTRUMENTACAO') == '1',
+    'rodape': os.environ.get('BIBLIOTECA_RODAPE_DEBUG') == '1',
+    'maximo_consultas': 500,
+    'token_metricas': os.environ.get('BIBLIOTECA_TOKEN_METRICAS'),
+}
+
+# Limites (em segundos) do histograma de duração das requisições
+BALDES_DURACAO = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+metricas_rotas = {}
+metricas_consultas = {}
+trava_metricas = threading.Lock()
+
+# Cursor que mede a execução e as leituras da consulta da requisição atual
+class CursorInstrumentado(sqlite3.Cursor):
+    medicao = None
+
+    def medir(self, sql, parametros, funcao, *args):
+        self.medicao = None
+        inicio = time.perf_counter()
+        try:
+            return funcao(*args)
+        finally:
+            if has_app_context() and 'instrumentacao' in g:
+                self.medicao = {'sql': ' '.join(sql.split()), 'parametros': parametros,
+                                'segundos': time.perf_counter() - inicio, 'linhas': 0}
+                g.instrumentacao['consultas'].append(self.medicao)
+
+    def execute(self, sql, parametros=()):
+        return self.medir(sql, parametros, super().execute, sql, parametros)
+
+    def executemany(self, sql, sequencia):
+        return self.medir(sql, None, super().executemany, sql, sequencia)
+
+    def ler(self, funcao, *args):
+        inicio = time.perf_counter()
+        resultado = funcao(*args)
+        if self.medicao is not None:
+            self.medicao['segundos'] += time.perf_counter() - inicio
+            if isinstance(resultado, list):
+                self.medicao['linhas'] += len(resultado)
+            elif resultado is not None:
+                self.medicao['linhas'] += 1
+        return resultado
+
+    def fetchone(self):
+        return self.ler(super().fetchone)
+
+    def fetchmany(self, *args):
+        return self.ler(super().fetchmany, *args)
+
+    def fetchall(self):
+        return self.ler(super().fetchall)
+
+    def __next__(self):
+        linha = self.fetchone()
+        if linha is None:
+            raise StopIteration
+        return linha
+
+# Conexão do pool cujos cursores são medidos
+class ConexaoInstrumentada(ConexaoBiblioteca):
+    def cursor(self, factory=CursorInstrumentado):
+        return super().cursor(factory)
+
+    def execute(self, sql, parametros=()):
+        return self.cursor().execute(sql, parametros)
+
+    def executemany(self, sql, sequencia):
+        return self.cursor().executemany(sql, sequencia)
+
+# Funções ligadas aos sinais do Flask enquanto a instrumentação está ativa
+def instrumentacao_inicio_requisicao(remetente, **extra):
+    g.instrumentacao = {'inicio': time.perf_counter(), 'consultas': [], 'template': 0.0, 'templates': []}
+
+def instrumentacao_antes_template(remetente, template, context, **extra):
+    if 'instrumentacao' in g:
+        g.instrumentacao['templates'].append(time.perf_counter())
+
+def instrumentacao_depois_template(remetente, template, context, **extra):
+    if 'instrumentacao' in g and g.instrumentacao['templates']:
+        inicio = g.instrumentacao['templates'].pop()
+        # Só o template de fora conta, para não somar duas vezes
+        if not g.instrumentacao['templates']:
+            g.instrumentacao['template'] += time.perf_counter() - inicio
+
+def instrumentacao_fim_requisicao(remetente, response, **extra):
+    medidas = g.pop('instrumentacao', None)
+    if medidas is None:
+        return
+    total = time.perf_counter() - medidas['inicio']
+    consultas = medidas['consultas']
+    tempo_banco = sum(consulta['segundos'] for consulta in consultas)
+    tempo_template = medidas['template']
+    tempo_python = max(total - tempo_banco - tempo_template, 0.0)
+    rota = request.endpoint or 'desconhecida'
+
+    # Plano de cada consulta nova (com os mesmos parâmetros, num cursor comum, sem medir)
+    banco = g.get('banco')
+    with trava_metricas:
+        novas = [consulta for consulta in consultas if consulta['sql'] not in metricas_consultas]
+    planos = {}
+    for consulta in novas:
+        if banco is not None and consulta['parametros'] is not None \
+                and consulta['sql'].split(' ', 1)[0].upper() in ('SELECT', 'WITH', 'INSERT', 'UPDATE', 'DELETE'):
+            try:
+                planos[consulta['sql']] = [linha[3] for linha in sqlite3.Cursor(banco).execute(
+                    "EXPLAIN QUERY PLAN " + consulta['sql'], consulta['parametros'])]
+            except sqlite3.Error:
+                pass
+
+    with trava_metricas:
+        dados = metricas_rotas.setdefault(rota, {
+            'requisicoes': 0, 'segundos': 0.0, 'banco': 0.0, 'template': 0.0, 'python': 0.0,
+            'consultas': 0, 'linhas': 0, 'baldes': [0] * len(BALDES_DURACAO), 'status': {},
+        })
+        dados['requisicoes'] += 1
+        dados['segundos'] += total
+        dados['banco'] += tempo_banco
+        dados['template'] += tempo_template
+        dados['python'] += tempo_python
+        dados['consultas'] += len(consultas)
+        dados['linhas'] += sum(consulta['linhas'] for consulta in consultas)
+        dados['status'][response.status_code] = dados['status'].get(response.status_code, 0) + 1
+        for posicao, limite in enumerate(BALDES_DURACAO):
+            if total <= limite:
+                dados['baldes'][posicao] += 1
+
+        for consulta in consultas:
+            sql = consulta['sql']
+            if sql not in metricas_consultas and len(metricas_consultas) >= CONFIGURACAO_INSTRUMENTACAO['maximo_consultas']:
+                sql = '(outras consultas)'
+            registro = metricas_consultas.setdefault(sql, {
+                'id': hashlib.sha1(sql.encode('utf-8')).hexdigest()[:10], 'execucoes': 0,
+                'segundos': 0.0, 'linhas': 0, 'plano': planos.get(sql),
+            })
+            registro['execucoes'] += 1
+            registro['segundos'] += consulta['segundos']
+            registro['linhas'] += consulta['linhas']
+
+    if CONFIGURACAO_INSTRUMENTACAO['rodape'] and usuario_eh_admin():
+        colocar_rodape_debug(response, rota, total, tempo_banco, tempo_template, tempo_python, consultas)
+
+# Função para pôr o rodapé com as medições no fim de uma página HTML
+def colocar_rodape_debug(response, rota, total, tempo_banco, tempo_template, tempo_python, consultas):
+    if response.is_streamed or response.status_code != 200 or response.mimetype != 'text/html':
+        return
+    with trava_metricas:
+        planos = {consulta['sql']: (metricas_consultas.get(consulta['sql']) or {}).get('plano') for consulta in consultas}
+    rodape = app.jinja_env.get_template("rodape_debug.html").render(
+        rota=rota, total=total, banco=tempo_banco, template=tempo_template, python=tempo_python,
+        consultas=consultas, planos=planos)
+    corpo = response.get_data(as_text=True)
+    posicao = corpo.rfind('</body>')
+    if posicao == -1:
+        posicao = len(corpo)
+    response.set_data(corpo[:posicao] + rodape + corpo[posicao:])
+    # O corpo mudou: o ETag do cache de páginas não vale mais para ele
+    response.headers.pop('ETag', None)
+
+# Função para ligar a instrumentação (as conexões abertas antes são fechadas, para as novas já virem medidas)
+def ligar_instrumentacao():
+    global classe_conexao
+    CONFIGURACAO_INSTRUMENTACAO['ativa'] = True
+    classe_conexao = ConexaoInstrumentada
+    fechar_pool()
+    request_started.connect(instrumentacao_inicio_requisicao, app)
+    before_render_template.connect(instrumentacao_antes_template, app)
+    template_rendered.connect(instrumentacao_depois_template, app)
+    request_finished.connect(instrumentacao_fim_requisicao, app)
+
+# Função para desligar a instrumentação e voltar às conexões normais
+def desligar_instrumentacao():
+    global classe_conexao
+    CONFIGURACAO_INSTRUMENTACAO['ativa'] = False
+    request_started.disconnect(instrumentacao_inicio_requisicao, app)
+    before_render_template.disconnect(instrumentacao_antes_template, app)
+    template_rendered.disconnect(instrumentacao_depois_template, app)
+    request_finished.disconnect(instrumentacao_fim_requisicao, app)
+    classe_conexao = ConexaoBiblioteca
+    fechar_pool()
+
+if CONFIGURACAO_INSTRUMENTACAO['ativa']:
+    ligar_instrumentacao()
+
+# Função para escrever um valor de label no formato do Prometheus
+def label_prometheus(valor):
+    return str(valor).replace('\\', '\\\\').replace('"', '\\"').replace('\n', ' ')
+
+# Função para montar o texto do /metrics
+def montar_metricas():
+    linhas = []
+
+    def metrica(nome, tipo, ajuda, valores):
+        linhas.append(f"# HELP {nome} {ajuda}")
+        linhas.append(f"# TYPE {nome} {tipo}")
+        for labels, valor in valores:
+            texto_labels = ','.join(f'{chave}="{label_prometheus(conteudo)}"' for chave, conteudo in labels.items())
+            linhas.append(f"{nome}{{{texto_labels}}} {valor}" if texto_labels else f"{nome} {valor}")
+
+    with trava_metricas:
+        rotas = {rota: dict(dados, baldes=list(dados['baldes']), status=dict(dados['status']))
+                 for rota, dados in metricas_rotas.items()}
+        consultas = {sql: dict(dados) for sql, dados in metricas_consultas.items()}
+
+    metrica('biblioteca_requisicoes_total', 'counter', 'Requisições atendidas por rota e status',
+            [({'rota': rota, 'status': status}, quantidade)
+             for rota, dados in rotas.items() for status, quantidade in sorted(dados['status'].items())])
+
+    baldes = []
+    for rota, dados in rotas.items():
+        for limite, quantidade in zip(BALDES_DURACAO, dados['baldes']):
+            baldes.append(({'rota': rota, 'le': limite}, quantidade))
+        baldes.append(({'rota': rota, 'le': '+Inf'}, dados['requisicoes']))
+    linhas.append("# HELP biblioteca_requisicao_segundos Duração das requisições por rota")
+    linhas.append("# TYPE biblioteca_requisicao_segundos histogram")
+    for labels, valor in baldes:
+        linhas.append(f'biblioteca_requisicao_segundos_bucket{{rota="{label_prometheus(labels["rota"])}",le="{labels["le"]}"}} {valor}')
+    for rota, dados in rotas.items():
+        linhas.append(f'biblioteca_requisicao_segundos_sum{{rota="{label_prometheus(rota)}"}} {dados["segundos"]:.6f}')
+        linhas.append(f'biblioteca_requisicao_segundos_count{{rota="{label_prometheus(rota)}"}} {dados["requisicoes"]}')
+
+    metrica('biblioteca_tempo_segundos_total', 'counter', 'Tempo gasto por rota em banco, template e Python',
+            [({'rota': rota, 'parte': parte}, f"{dados[parte]:.6f}")
+             for rota, dados in rotas.items() for parte in ('banco', 'template', 'python')])
+    metrica('biblioteca_consultas_total', 'counter', 'Consultas SQL feitas por rota',
+            [({'rota': rota}, dados['consultas']) for rota, dados in rotas.items()])
+    metrica('biblioteca_linhas_lidas_total', 'counter', 'Linhas lidas do banco por rota',
+            [({'rota': rota}, dados['linhas']) for rota, dados in rotas.items()])
+    metrica('biblioteca_sql_execucoes_total', 'counter', 'Execuções de cada consulta SQL',
+            [({'id': dados['id'], 'sql': sql[:120]}, dados['execucoes']) for sql, dados in consultas.items()])
+    metrica('biblioteca_sql_segundos_total', 'counter', 'Tempo gasto em cada consulta SQL',
+            [({'id': dados['id'], 'sql': sql[:120]}, f"{dados['segundos']:.6f}") for sql, dados in consultas.items()])
+    metrica('biblioteca_sql_linhas_total', 'counter', 'Linhas lidas por cada consulta SQL',
+            [({'id': dados['id'], 'sql': sql[:120]}, dados['linhas']) for sql, dados in consultas.items()])
+
+    # Pool, cache e fila de senhas: contados sempre, mesmo com a instrumentação desligada
+    pool = obter_estatisticas_pool()
+    metrica('biblioteca_pool_conexoes', 'gauge', 'Conexões do pool', [
+        ({'estado': 'abertas'}, pool['abertas']), ({'estado': 'livres'}, pool['livres'])])
+    metrica('biblioteca_pool_pedidos_total', 'counter', 'Pedidos de conexão ao pool', [
+        ({'resultado': 'acerto'}, pool['acertos']), ({'resultado': 'falta'}, pool['faltas'])])
+    cache = obter_estatisticas_cache()
+    metrica('biblioteca_cache_pedidos_total', 'counter', 'Pedidos ao cache de páginas por rota', [
+        ({'rota': rota, 'resultado': resultado}, numeros[chave])
+        for rota, numeros in cache['rotas'].items() for chave, resultado in (('acertos', 'acerto'), ('faltas', 'falta'))])
+    metrica('biblioteca_cache_entradas', 'gauge', 'Páginas guardadas no cache', [({}, cache['entradas'])])
+    senhas = obter_estatisticas_senhas()
+    metrica('biblioteca_senhas_calculos_total', 'counter', 'Hashes de senha calculados', [({}, senhas['calculos'])])
+    metrica('biblioteca_senhas_recusados_total', 'counter', 'Logins recusados com a fila de senhas cheia',
+            [({}, senhas['recusados'])])
+    metrica('biblioteca_senhas_esperando', 'gauge', 'Pedidos esperando na fila de senhas', [({}, senhas['esperando'])])
+
+    return '\n'.join(linhas) + '\n'
+
+# Métricas no formato do Prometheus
+# Admins logados podem ver; o coletor usa "Authorization: Bearer <token>" com BIBLIOTECA_TOKEN_METRICAS
+@app.route("/metrics")
+def pagina_metricas():
+    token = CONFIGURACAO_INSTRUMENTACAO['token_metricas']
+    autorizado = usuario_eh_admin() or (
+        token and hmac.compare_digest(request.headers.get('Authorization', ''), f"Bearer {token}"))
+    if not autorizado:
+        return Response("não autorizado\n", status=401, mimetype='text/plain')
+    return Response(montar_metricas(), mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+# Consultas medidas pela instrumentação, das que mais tomaram tempo para as que menos (só admins)
+@app.route("/estatisticas/consultas")
+@precisa_ser_admin
+def pagina_estatisticas_consultas():
+    with trava_metricas:
+        consultas = [dict(dados, sql=sql) for sql, dados in metricas_consultas.items()]
+    consultas.sort(key=lambda dados: dados['segundos'], reverse=True)
+    return jsonify({'instrumentacao_ativa': CONFIGURACAO_INSTRUMENTACAO['ativa'], 'consultas': consultas})
+
+# Páginas visitadas pela verificação de índices, como admin e como aluno
+PAGINAS_VERIFICADAS = {
+    'admin': ['/', '/livros', '/livros?modo=completo', '/livros/busca?q=dom', '/usuarios', '/emprestimos',
+              '/autocompletar/usuarios?q=jo', '/autocompletar/usuarios?q=2024', '/autocompletar/livros?q=dom',
+              '/relatorios', '/relatorios/exportar/emprestados.csv', '/relatorios/exportar/atrasados.jsonl',
+              '/relatorios/exportar/historico.xlsx', '/api/v1/livros?limite=10',
+              '/api/v1/livros?cursor=WyJNIiwgMV0&disponiveis=1', '/api/v1/livros?q=dom', '/api/v1/livros/1',
+              '/api/v1/usuarios?q=Jo', '/api/v1/usuarios?cursor=WyJNIiwgMV0',
+              '/api/v1/emprestimos?campos=id,livro_titulo,usuario_nome', '/api/v1/emprestimos?status=emprestado',
+              '/api/v1/emprestimos?atrasados=1&cursor=WyIyMDk5LTAxLTAxIiwgMV0', '/api/v1/emprestimos?usuario_id=1&status=devolvido'],
+    'aluno': ['/', '/livros', '/livros/busca?q=capitaes areia', '/meus_emprestimos',
+              '/meus_emprestimos?apos_data=2099-12-31&apos_id=1&de=2020-01-01&situacao=com_atraso', '/relatorios',
+              '/relatorios/exportar/disponiveis.csv', '/api/v1/emprestimos?status=emprestado',
+              '/api/v1/emprestimos/1'],
+}
+
+# Função para conferir com EXPLAIN QUERY PLAN se as consultas das páginas usam índice
+# Visita as páginas pelo cliente de teste do Flask, guarda cada SELECT executado e
+# marca como problema qualquer leitura que percorra uma tabela inteira (SCAN sem índice).
+# Como o projeto não tem suíte de testes, o comando verificar-indices faz o papel do teste:
+# num banco novo, sai com código 1 se alguma consulta fizer SCAN.
+def verificar_uso_de_indices():
+    consultas = {}
+    rota_atual = ['']
+
+    def registrar_consulta(sql):
+        sql = sql.strip()
+        # Consultas internas do FTS5 nas tabelas auxiliares ('main'.'livros_busca_...') ficam de fora
+        if "'main'." in sql:
+            return
+        if sql.upper().startswith('SELECT') and sql not in consultas:
+            consultas[sql] = rota_atual[0]
+
+    # Deixar no pool só uma conexão, com o rastreamento ligado
+    fechar_pool()
+    banco = pegar_conexao()
+    banco.set_trace_callback(registrar_consulta)
+    devolver_conexao(banco)
+
+    try:
+        banco_aluno = conectar_banco()
+        aluno = banco_aluno.execute("SELECT id, nome, matricula FROM usuarios ORDER BY id LIMIT 1").fetchone()
+        admin = banco_aluno.execute("SELECT id, nome, usuario FROM administradores ORDER BY id LIMIT 1").fetchone()
+        banco_aluno.close()
+        consultas.clear()
+
+        # A senha do admin não é conhecida (só o hash): o login é tentado para a consulta
+        # dele entrar na verificação, e a sessão é montada direto
+        logins = {}
+        if admin:
+            logins['admin'] = ({'tipo_usuario': 'admin', 'usuario': admin['usuario'], 'senha': ''},
+                               {'tipo_usuario': 'admin', 'nome_usuario': admin['nome'], 'usuario_id': admin['id']})
+        if aluno:
+            logins['aluno'] = ({'tipo_usuario': 'aluno', 'matricula': aluno['matricula']},
+                               {'tipo_usuario': 'aluno', 'nome_usuario': aluno['nome'],
+                                'matricula_usuario': aluno['matricula'], 'usuario_id': aluno['id']})
+
+        for tipo, (dados_login, dados_sessao) in logins.items():
+            cliente = app.test_client()
+            rota_atual[0] = '/login'
+            cliente.post('/login', data=dados_login)
+            with cliente.session_transaction() as sessao:
+                sessao.update(dados_sessao)
+            for pagina in PAGINAS_VERIFICADAS[tipo]:
+                rota_atual[0] = f"{pagina} ({tipo})"
+                cliente.get(pagina, buffered=True)
+    finally:
+        banco.set_trace_callback(None)
 
-    banco.commit()
+    resultado = []
+    banco = conectar_banco()
+    for sql, rota in consultas.items():
+        plano = [linha['detail'] for linha in banco.execute("EXPLAIN QUERY PLAN " + sql)]
+        # "SCAN (subquery-N)" é a leitura do resultado de uma subconsulta, não de uma tabela
+        varreduras = [passo for passo in plano
+                      if passo.startswith('SCAN ') and not passo.startswith('SCAN (') and ' INDEX ' not in passo + ' ']
+        resultado.append({'rota': rota, 'sql': ' '.join(sql.split()), 'plano': plano, 'usa_indice': not varreduras})
     banco.close()
-    print("Dados de exemplo inseridos!")
+    return resultado
+
+# Gerador de dados sintéticos: livros, alunos e anos de empréstimos, sempre iguais para a
+# mesma semente. Serve tanto para os dados de exemplo quanto para testar com milhões de linhas.
+# - Livros populares: cada empréstimo sorteia o livro com peso 1/posição^0.8 (os primeiros
+#   livros são os mais procurados e também têm mais exemplares, pelo menos
+#   `exemplares_minimos` cada); os alunos também não leem todos o mesmo tanto (peso 1/posição^0.5).
+# - Datas espalhadas pelos últimos `anos` anos; os ids seguem a ordem das datas.
+# - Uma fração dos empréstimos volta atrasada e uma parte dos ativos já passou do prazo,
+#   sempre respeitando o limite por aluno e os exemplares de cada livro.
+# Os dados entram com executemany numa transação só, com o modo de carga em massa (sem
+# triggers e sem os índices, que são refeitos no fim) e synchronous = OFF na conexão.
+LIVROS_CLASSICOS = [
+    ("Dom Casmurro", "Machado de Assis", "978-85-359-0277-5", 1899),
+    ("O Cortiço", "Aluísio Azevedo", "978-85-260-1631-8", 1890),
+    ("Capitães da Areia", "Jorge Amado", "978-85-254-0024-7", 1937),
+    ("Python para Iniciantes", "Eric Matthes", "978-85-7522-718-3", 2019),
+    ("Algoritmos e Estruturas de Dados", "Thomas Cormen", "978-85-352-8913-9", 2012),
+    ("História do Brasil", "Boris Fausto", "978-85-314-0556-2", 2013),
+]
+INICIOS_TITULO = ("O Segredo", "A Casa", "Memórias", "O Caminho", "A Última Viagem", "Crônicas", "Histórias",
+                  "O Livro", "A Arte", "Fundamentos", "Introdução", "Manual", "Cartas", "O Mistério",
+                  "A Ilha", "Contos", "Viagem", "O Guardião", "A Cidade", "Estudos")
+FINAIS_TITULO = ("do Sertão", "do Mar", "da Serra", "de Python", "de Algoritmos", "de Química Orgânica",
+                 "da Cidade Antiga", "do Tempo", "das Estrelas", "de Banco de Dados", "da Matemática",
+                 "do Rio", "da Floresta", "de Cálculo", "da Economia", "do Norte", "de Redes",
+                 "da Física", "do Futuro", "da Língua Portuguesa", "de Zootecnia", "dos Sonhos")
+NOMES = ("Ana", "João", "Maria", "Pedro", "Letícia", "Carlos", "Beatriz", "Lucas", "Juliana", "Rafael",
+         "Fernanda", "Gabriel", "Camila", "Mateus", "Larissa", "Bruno", "Aline", "Thiago", "Patrícia",
+         "Gustavo", "Mariana", "Felipe", "Isabela", "Rodrigo", "Vitória", "Eduardo", "Sofia", "Diego")
+SOBRENOMES = ("Silva", "Santos", "Oliveira", "Souza", "Lima", "Pereira", "Costa", "Ferreira", "Rodrigues",
+              "Almeida", "Nascimento", "Carvalho", "Gomes", "Martins", "Araújo", "Ribeiro", "Barbosa",
+              "Rocha", "Dias", "Moreira", "Cardoso", "Teixeira", "Mendes", "Freitas")
+CURSOS = ("Análise e Desenvolvimento de Sistemas", "Engenharia de Software", "Sistemas de Informação",
+          "Química", "Zootecnia", "Matemática", "Letras", "Administração", "Agronomia", "Física")
+
+# Tamanho dos dados de exemplo inseridos na primeira vez que o sistema sobe (com exemplares
+# de sobra, para nenhum livro começar sem nenhum na estante)
+DADOS_EXEMPLO = {'livros': 6, 'usuarios': 5, 'emprestimos': 60, 'anos': 0.25, 'exemplares_minimos': 3}
+
+# Primeira matrícula gerada (os alunos de exemplo são 2024001 a 2024005)
+PRIMEIRA_MATRICULA = 2024001
+
+# Função para gerar ISBNs válidos (com o dígito verificador) a partir de um número sequencial
+def gerar_isbns(quantidade):
+    # Soma ponderada (pesos 1 e 3 alternados) dos 12 primeiros dígitos: 978 65 + 7 dígitos do número
+    base = sum(int(digito) * (3 if posicao % 2 else 1) for posicao, digito in enumerate("97865"))
+    pesos_altos = [sum(int(d) * (3 if (5 + i) % 2 else 1) for i, d in enumerate(f"{n:03d}")) for n in range(1000)]
+    pesos_baixos = [sum(int(d) * (3 if (8 + i) % 2 else 1) for i, d in enumerate(f"{n:04d}")) for n in range(10000)]
+    for numero in range(1, quantidade + 1):
+        alto, baixo = divmod(numero, 10000)
+        verificador = (10 - (base + pesos_altos[alto] + pesos_baixos[baixo]) % 10) % 10
+        yield f"978-65-{alto:03d}{baixo:04d}-{verificador}"
+
+# Função para montar a lista de pesos acumulados de uma distribuição de Zipf (1/posição^expoente)
+def pesos_zipf(quantidade, expoente):
+    return list(itertools.accumulate(1 / posicao ** expoente for posicao in range(1, quantidade + 1)))
+
+# Função para gerar os dados (livros, usuarios e emprestimos precisam estar vazias)
+# Devolve um resumo do que foi gerado, ou None se o banco já tinha dados
+def gerar_dados(banco, livros, usuarios, emprestimos, semente=42, anos=3, fracao_atrasados=0.1,
+                exemplares_minimos=1):
+    inicio = time.perf_counter()
+    # Durante a carga: sem fsync e com bastante cache para refazer os índices (a conexão
+    # volta ao pool depois, então os valores de antes são devolvidos no fim)
+    synchronous = banco.execute("PRAGMA synchronous").fetchone()[0]
+    cache_size = banco.execute("PRAGMA cache_size").fetchone()[0]
+    banco.execute("PRAGMA synchronous = OFF")
+    banco.execute("PRAGMA cache_size = -262144")
+    try:
+        resumo = executar_escrita(banco, gravar_dados_gerados, livros, usuarios, emprestimos,
+                                  semente, anos, fracao_atrasados, exemplares_minimos)
+    finally:
+        banco.execute(f"PRAGMA synchronous = {int(synchronous)}")
+        banco.execute(f"PRAGMA cache_size = {int(cache_size)}")
+    if resumo is not None:
+        invalidar_cache('livros', 'usuarios', 'emprestimos', 'contextos_alunos')
+        resumo['segundos'] = time.perf_counter() - inicio
+    return resumo
+
+# Função que grava os dados gerados (usada dentro de executar_escrita)
+def gravar_dados_gerados(cursor, livros, usuarios, emprestimos, semente, anos, fracao_atrasados,
+                         exemplares_minimos):
+    # Conferir dentro da transação: dois processos subindo juntos não geram duas vezes
+    for tabela in ('livros', 'usuarios', 'emprestimos'):
+        if cursor.execute(f"SELECT 1 FROM {tabela} LIMIT 1").fetchone():
+            return None
+
+    banco = cursor.connection
+    sorteio = random.Random(semente)
+    # random() é bem mais rápido que randint()/choice(), e aqui são milhões de sorteios
+    aleatorio = sorteio.random
+
+    def escolher(opcoes):
+        return opcoes[int(aleatorio() * len(opcoes))]
+    hoje = date.today()
+    prazo = PRAZO_EMPRESTIMO_DIAS
+    total_dias = max(int(anos * 365), 1)
+    # Datas em texto por "dias atrás" (negativo = no futuro), calculadas uma vez só
+    datas = [(hoje - timedelta(days=dias)).isoformat() for dias in range(-prazo, total_dias + 1)]
+
+    # Os livros mais populares (os primeiros) têm mais exemplares
+    populares = max(livros // 100, 1)
+    exemplares = [0] + [exemplares_minimos + 4 * (numero <= populares) + (aleatorio() < 0.3) for numero in range(1, livros + 1)]
+
+    def gerar_livros():
+        isbns = gerar_isbns(livros)
+        for numero in range(1, livros + 1):
+            isbn = next(isbns)
+            if numero <= len(LIVROS_CLASSICOS):
+                titulo, autor, isbn, ano = LIVROS_CLASSICOS[numero - 1]
+            else:
+                titulo = f"{escolher(INICIOS_TITULO)} {escolher(FINAIS_TITULO)}"
+                if aleatorio() < 0.2:
+                    titulo += f" - Volume {2 + int(aleatorio() * 4)}"
+                autor = f"{escolher(NOMES)} {escolher(SOBRENOMES)}"
+                ano = 1950 + int(aleatorio() * (hoje.year - 1949))
+            yield titulo, autor, isbn, ano, exemplares[numero]
+
+    def gerar_usuarios():
+        for numero in range(usuarios):
+            nome = f"{escolher(NOMES)} {escolher(SOBRENOMES)} {escolher(SOBRENOMES)}"
+            yield nome, str(PRIMEIRA_MATRICULA + numero), escolher(CURSOS)
+
+    ativos_usuario = [0] * (usuarios + 1)
+    ativos_livro = [0] * (livros + 1)
+    contagem = {'ativos': 0, 'atrasados': 0, 'devolvidos_com_atraso': 0}
+
+    def gerar_emprestimos():
+        if not (livros and usuarios):
+            return
+        # Quem pega e o quê: sorteados de uma vez, com os pesos de popularidade
+        livros_sorteados = sorteio.choices(range(1, livros + 1), cum_weights=pesos_zipf(livros, 0.8), k=emprestimos)
+        usuarios_sorteados = sorteio.choices(range(1, usuarios + 1), cum_weights=pesos_zipf(usuarios, 0.5),
+                                             k=emprestimos)
+        # Quantos dias atrás cada empréstimo foi feito, do mais antigo para o mais novo
+        dias_atras = sorted([int(aleatorio() * (total_dias + 1)) for _ in range(emprestimos)], reverse=True)
+
+        for livro_id, usuario_id, dias in zip(livros_sorteados, usuarios_sorteados, dias_atras):
+            emprestado = datas[dias + prazo]
+            prevista = datas[dias]
+            # Ainda com o aluno: os do prazo atual quase sempre; os vencidos há até 60 dias, às vezes
+            continua = ((dias <= prazo and aleatorio() < 0.7)
+                        or (prazo < dias <= prazo + 60 and aleatorio() < fracao_atrasados))
+            if (continua and ativos_usuario[usuario_id] < LIMITE_EMPRESTIMOS
+                    and ativos_livro[livro_id] < exemplares[livro_id]):
+                ativos_usuario[usuario_id] += 1
+                ativos_livro[livro_id] += 1
+                contagem['ativos'] += 1
+                contagem['atrasados'] += dias > prazo
+                yield usuario_id, livro_id, emprestado, prevista, None, 'emprestado', int(dias > prazo), max(dias - prazo, 0)
+                continue
+
+            if aleatorio() < fracao_atrasados:
+                devolvido = dias - prazo - 1 - int(aleatorio() * 30)
+                contagem['devolvidos_com_atraso'] += 1
+            else:
+                devolvido = dias - int(aleatorio() * (prazo + 1))
+            devolvido = max(devolvido, 0)
+            yield (usuario_id, livro_id, emprestado, prevista, datas[devolvido + prazo], 'devolvido',
+                   0, max(dias - prazo - devolvido, 0))
+
+    with modo_carga_em_massa(banco, ('livros', 'usuarios', 'emprestimos'), sem_indices=True):
+        banco.executemany("INSERT INTO livros (titulo, autor, isbn, ano, quantidade) VALUES (?, ?, ?, ?, ?)",
+                          gerar_livros())
+        banco.executemany("INSERT INTO usuarios (nome, matricula, curso) VALUES (?, ?, ?)", gerar_usuarios())
+        banco.executemany("""
+            INSERT INTO emprestimos (usuario_id, livro_id, data_emprestimo, data_prevista, data_devolucao, status,
+                                     atrasado, dias_atraso)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        """, gerar_emprestimos())
+        # Os exemplares que estão com alunos saem da quantidade disponível
+        banco.executemany("UPDATE livros SET quantidade = quantidade - ? WHERE id = ?",
+                          ((ativos, livro_id) for livro_id, ativos in enumerate(ativos_livro) if ativos))
+
+    return {'livros': livros, 'usuarios': usuarios, 'emprestimos': emprestimos, **contagem}
+
+# Função para inserir dados de exemplo (só quando o banco ainda está vazio)
+def inserir_dados_exemplo():
+    banco = conectar_banco()
+    resumo = gerar_dados(banco, semente=2024, **DADOS_EXEMPLO)
+    banco.close()
+    if resumo is not None:
+        print("Dados de exemplo inseridos!")
+
+# Produção: criar_app() prepara o banco e devolve a aplicação WSGI, para qualquer servidor
+# WSGI (ex: gunicorn -w 4 --threads 8 "bibli:criar_app()"); servir_producao() é um servidor
+# prefork só com a biblioteca padrão, para usar mais de um núcleo sem instalar nada.
+# O processo mestre abre o socket, prepara o banco e cria os processos filhos; cada filho
+# atende com um número fixo de threads e só aceita uma conexão quando tem thread livre,
+# assim as conexões ficam com os processos desocupados.
+# Sinais para o mestre: TERM/INT param (as requisições em andamento terminam antes) e HUP
+# recarrega: o mestre roda de novo o bibli.py (já com o código novo), com o mesmo socket,
+# cria os filhos novos e só então manda os antigos terminarem o que estavam fazendo.
+# Entre processos o SQLite se vira sozinho (WAL + BEGIN IMMEDIATE); o que é de cada processo
+# é o pool, a fila de senhas e o cache de páginas, que fica certo pela tabela versoes_cache.
+aplicacao_preparada = False
+trava_preparacao = threading.Lock()
+
+# Função para preparar banco, admin e dados de exemplo (uma vez só) e devolver a aplicação WSGI
+def criar_app(dados_exemplo=None):
+    global aplicacao_preparada
+    with trava_preparacao:
+        if not aplicacao_preparada:
+            if dados_exemplo is None:
+                dados_exemplo = os.environ.get('BIBLIOTECA_DADOS_EXEMPLO', '1') != '0'
+            criar_tabelas_banco()
+            criar_primeiro_admin()
+            if dados_exemplo:
+                inserir_dados_exemplo()
+            if os.environ.get('BIBLIOTECA_CHAVE_SECRETA'):
+                app.secret_key = os.environ['BIBLIOTECA_CHAVE_SECRETA']
+            # Quem vai criar processos depois daqui (gunicorn --preload, servir_producao)
+            # não pode passar conexões abertas para os filhos
+            fechar_pool()
+            aplicacao_preparada = True
+    return app
+
+# Conexões do SQLite não podem ser usadas nem fechadas do outro lado de um fork: o filho só
+# esquece as que herdou (elas ficam nesta lista para o coletor de lixo não fechá-las)
+conexoes_herdadas = []
+
+# Função chamada no processo filho logo depois do fork
+def reiniciar_depois_do_fork():
+    global executor_senhas, conexao_versoes, data_version_visto, agendador
+    with trava_pool:
+        conexoes_herdadas.extend(conexoes_livres)
+        conexoes_livres.clear()
+        estatisticas_pool['abertas'] = 0
+    if conexao_versoes is not None:
+        conexoes_herdadas.append(conexao_versoes)
+        conexao_versoes = None
+    data_version_visto = None
+    # As threads da fila de senhas, do agendador e dos executores do ASGI não vêm junto no fork
+    executor_senhas = None
+    agendador = None
+    executores_asgi.clear()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=reiniciar_depois_do_fork)
+
+# Verificação de saúde para o balanceador: o processo responde e consegue ler o banco
+@app.route("/saude")
+def pagina_saude():
+    try:
+        banco = conectar_banco()
+        versao = banco.execute("PRAGMA user_version").fetchone()[0]
+    except sqlite3.Error as erro:
+        return jsonify({'status': 'erro', 'erro': str(erro), 'processo': os.getpid()}), 503
+    return jsonify({
+        'status': 'ok',
+        'processo': os.getpid(),
+        'versao_banco': versao,
+        'migracoes_pendentes': sum(1 for numero, _, _ in MIGRACOES if numero > versao),
+    })
+
+# Manipulador de requisições; o log de cada acesso só sai se for pedido
+class ManipuladorWSGI(WSGIRequestHandler):
+    def log_request(self, *args):
+        if self.server.log_acessos:
+            super().log_request(*args)
+
+# Servidor WSGI de um processo filho: usa o socket aberto pelo mestre e um número fixo de threads
+class ServidorWSGI(WSGIServer):
+    def __init__(self, soquete, aplicacao, threads, log_acessos=False):
+        WSGIServer.__init__(self, soquete.getsockname()[:2], ManipuladorWSGI, bind_and_activate=False)
+        self.socket.close()
+        self.socket = soquete
+        self.server_address = soquete.getsockname()
+        self.server_name = socket.getfqdn(self.server_address[0])
+        self.server_port = self.server_address[1]
+        self.setup_environ()
+        self.set_app(aplicacao)
+        self.log_acessos = log_acessos
+        self.vagas = threading.Semaphore(threads)
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='biblioteca')
+
+    # Só aceitar uma conexão quando tiver thread livre para ela; o socket é não bloqueante,
+    # então se outro processo pegar a conexão antes o accept só falha e a vida segue
+    def get_request(self):
+        self.vagas.acquire()
+        try:
+            return self.socket.accept()
+        except OSError:
+            self.vagas.release()
+            raise
+
+    def process_request(self, pedido, endereco):
+        self.executor.submit(self.atender, pedido, endereco)
+
+    def atender(self, pedido, endereco):
+        try:
+            self.finish_request(pedido, endereco)
+        except Exception:
+            self.handle_error(pedido, endereco)
+        finally:
+            self.shutdown_request(pedido)
+            self.vagas.release()
+
+# Função que roda num processo filho até receber SIGTERM
+def rodar_processo_filho(soquete, threads, log_acessos):
+    servidor = ServidorWSGI(soquete, app, threads, log_acessos)
+
+    # O shutdown() espera o serve_forever sair, então tem que ser chamado de outra thread
+    def parar(numero, quadro):
+        threading.Thread(target=servidor.shutdown).start()
+
+    signal.signal(signal.SIGTERM, parar)
+    # Ctrl+C no terminal chega em todos os processos; quem decide a parada é o mestre
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    iniciar_agendador()
+    servidor.serve_forever()
+    # Esperar as requisições em andamento terminarem
+    servidor.executor.shutdown(wait=True)
+    parar_agendador()
+    fechar_fila_senhas()
+    fechar_pool()
+
+# Função para abrir o socket do servidor (ou pegar o que o mestre anterior deixou, na recarga)
+def abrir_soquete(host, porta):
+    herdado = os.environ.pop('BIBLIOTECA_SOQUETE', None)
+    if herdado is not None:
+        soquete = socket.socket(fileno=int(herdado))
+    else:
+        soquete = socket.create_server((host, porta), backlog=1024)
+    soquete.setblocking(False)
+    return soquete
+
+# Função para o mestre rodar de novo o bibli.py, mantendo o socket e os filhos atuais
+def recarregar_mestre(soquete, filhos):
+    # Com o arquivo novo quebrado, continuar com o código que está rodando
+    try:
+        with open(os.path.abspath(__file__), encoding='utf-8') as arquivo:
+            compile(arquivo.read(), __file__, 'exec')
+    except SyntaxError as erro:
+        print(f"Recarga cancelada, bibli.py com erro: {erro}", file=sys.stderr, flush=True)
+        return
+    print(f"Recarregando (mestre {os.getpid()})...", flush=True)
+    soquete.set_inheritable(True)
+    os.environ['BIBLIOTECA_SOQUETE'] = str(soquete.fileno())
+    os.environ['BIBLIOTECA_FILHOS_ANTIGOS'] = ','.join(str(pid) for pid in filhos)
+    sys.stderr.flush()
+    os.execv(sys.executable, [sys.executable] + sys.argv)
+
+# Função para iniciar o servidor de produção com vários processos e threads
+def servir_producao(host='0.0.0.0', porta=5000, processos=None, threads=8, log_acessos=False):
+    if not hasattr(os, 'fork'):
+        sys.exit("O servidor de produção precisa de os.fork (Linux/macOS); use um servidor WSGI com criar_app()")
+    processos = processos or os.cpu_count() or 1
+    soquete = abrir_soquete(host, porta)
+    criar_app()
+
+    filhos = {}  # pid -> quando foi criado
+    pedidos = {'parar': False, 'recarregar': False}
+
+    def ao_receber_sinal(numero, quadro):
+        pedidos['recarregar' if numero == signal.SIGHUP else 'parar'] = True
+
+    for sinal in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+        signal.signal(sinal, ao_receber_sinal)
+
+    def criar_filho():
+        pid = os.fork()
+        if pid == 0:
+            codigo = 0
+            try:
+                rodar_processo_filho(soquete, threads, log_acessos)
+            except BaseException:
+                traceback.print_exc()
+                codigo = 1
+            finally:
+                os._exit(codigo)
+        filhos[pid] = time.monotonic()
+
+    for _ in range(processos):
+        criar_filho()
+
+    # Depois de uma recarga: os filhos novos já estão aceitando, os antigos podem sair
+    antigos = os.environ.pop('BIBLIOTECA_FILHOS_ANTIGOS', '')
+    for pid in (int(valor) for valor in antigos.split(',') if valor):
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+
+    print(f"Servidor de produção em http://{host}:{porta} - {processos} processos x {threads} threads "
+          f"(mestre {os.getpid()})", flush=True)
+
+    while not pedidos['parar']:
+        time.sleep(0.5)
+        # Recolher os filhos que saíram e pôr outros no lugar
+        while True:
+            try:
+                pid, situacao = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid == 0:
+                break
+            criado = filhos.pop(pid, None)
+            if criado is None or pedidos['parar']:
+                continue
+            print(f"Processo {pid} saiu (situação {situacao}), criando outro", file=sys.stderr, flush=True)
+            # Se ele morreu logo que nasceu, esperar um pouco para não ficar num ciclo rápido
+            if time.monotonic() - criado < 1:
+                time.sleep(1)
+            criar_filho()
+        if pedidos['recarregar']:
+            pedidos['recarregar'] = False
+            recarregar_mestre(soquete, filhos)
+
+    print("Parando os processos...", flush=True)
+    for pid in filhos:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+    for pid in filhos:
+        try:
+            os.waitpid(pid, 0)
+        except ChildProcessError:
+            pass
+    soquete.close()
+
+# ASGI: criar_app_asgi() devolve a mesma aplicação no formato ASGI, para servidores como
+# uvicorn ou hypercorn (ex: uvicorn --factory "bibli:criar_app_asgi" --workers 4).
+# As views e o SQLite continuam síncronos; o laço de eventos só recebe e manda os bytes e
+# cada requisição roda numa thread de executor, então ele nunca fica parado esperando o banco.
+# As rotas pesadas (relatórios e exportações) têm um executor só delas, com poucas threads:
+# vários relatórios pedidos ao mesmo tempo esperam na fila deles, e / e /livros continuam
+# com as threads do executor de páginas. Cada executor usa no máximo uma conexão do pool por
+# thread. Passando de fila_maxima_pesadas esperando, a rota pesada responde 503 na hora.
+CONFIGURACAO_ASGI = {
+    'threads_paginas': int(os.environ.get('BIBLIOTECA_ASGI_THREADS', '8')),
+    'threads_pesadas': int(os.environ.get('BIBLIOTECA_ASGI_THREADS_PESADAS', '2')),
+    'fila_maxima_pesadas': int(os.environ.get('BIBLIOTECA_ASGI_FILA_PESADAS', '32')),
+    'prefixos_pesados': ('/relatorios',),
+    'corpo_em_memoria': 1024 * 1024,  # corpos de requisição maiores vão para um arquivo temporário
+}
+
+executores_asgi = {}
+trava_asgi = threading.Lock()
+estatisticas_asgi = {
+    'paginas': {'em_andamento': 0, 'atendidas': 0},
+    'pesadas': {'em_andamento': 0, 'atendidas': 0, 'recusadas': 0},
+}
+
+# Função para pegar o executor de um tipo de rota ('paginas' ou 'pesadas') e entrar na fila dele;
+# devolve None quando a fila das pesadas está cheia
+def entrar_no_executor_asgi(tipo):
+    with trava_asgi:
+        contadores = estatisticas_asgi[tipo]
+        threads = CONFIGURACAO_ASGI[f'threads_{tipo}']
+        if tipo == 'pesadas' and contadores['em_andamento'] >= threads + CONFIGURACAO_ASGI['fila_maxima_pesadas']:
+            contadores['recusadas'] += 1
+            return None
+        if tipo not in executores_asgi:
+            executores_asgi[tipo] = ThreadPoolExecutor(max_workers=threads, thread_name_prefix=f'asgi-{tipo}')
+        contadores['em_andamento'] += 1
+        return executores_asgi[tipo]
+
+# Função para sair da fila quando a resposta terminou de ser mandada
+def sair_do_executor_asgi(tipo):
+    with trava_asgi:
+        estatisticas_asgi[tipo]['em_andamento'] -= 1
+        estatisticas_asgi[tipo]['atendidas'] += 1
+
+# Função para parar os executores (novos são criados no próximo uso)
+def fechar_executores_asgi():
+    with trava_asgi:
+        executores = list(executores_asgi.values())
+        executores_asgi.clear()
+    for executor in executores:
+        executor.shutdown(wait=True)
+
+# Função para ver como estão os executores do ASGI
+def obter_estatisticas_asgi():
+    with trava_asgi:
+        dados = {tipo: dict(contadores) for tipo, contadores in estatisticas_asgi.items()}
+    for tipo, contadores in dados.items():
+        contadores['threads'] = CONFIGURACAO_ASGI[f'threads_{tipo}']
+    dados['pesadas']['fila_maxima'] = CONFIGURACAO_ASGI['fila_maxima_pesadas']
+    return dados
+
+# Função para ler o corpo inteiro da requisição (None se o cliente desconectou)
+async def ler_corpo_asgi(receive):
+    corpo = tempfile.SpooledTemporaryFile(max_size=CONFIGURACAO_ASGI['corpo_em_memoria'])
+    while True:
+        mensagem = await receive()
+        if mensagem['type'] == 'http.disconnect':
+            corpo.close()
+            return None
+        corpo.write(mensagem.get('body', b''))
+        if not mensagem.get('more_body'):
+            corpo.seek(0)
+            return corpo
+
+# Função para montar o environ do WSGI a partir do scope do ASGI
+def montar_environ_asgi(scope, corpo):
+    servidor = scope.get('server') or ('localhost', 80)
+    raiz = scope.get('root_path', '')
+    caminho = scope['path']
+    if raiz and caminho.startswith(raiz):
+        caminho = caminho[len(raiz):]
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': raiz.encode('utf-8').decode('latin-1'),
+        'PATH_INFO': caminho.encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': servidor[0],
+        'SERVER_PORT': str(servidor[1] or 80),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': corpo,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    if scope.get('client'):
+        environ['REMOTE_ADDR'] = scope['client'][0]
+        environ['REMOTE_PORT'] = str(scope['client'][1])
+    for nome, valor in scope.get('headers', ()):
+        nome = nome.decode('latin-1').upper().replace('-', '_')
+        valor = valor.decode('latin-1')
+        if nome in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            environ[nome] = valor
+            continue
+        chave = 'HTTP_' + nome
+        environ[chave] = f"{environ[chave]},{valor}" if chave in environ else valor
+    return environ
+
+# Função que roda numa thread: chama a aplicação WSGI e já lê o primeiro pedaço da resposta
+# (o Flask só chama o start_response quando a view terminou)
+def iniciar_resposta_wsgi(environ):
+    resposta = {}
+
+    def start_response(status, cabecalhos, exc_info=None):
+        resposta['status'] = int(status.split(' ', 1)[0])
+        resposta['cabecalhos'] = [(nome.lower().encode('latin-1'), valor.encode('latin-1'))
+                                  for nome, valor in cabecalhos]
+
+    iteravel = app(environ, start_response)
+    pedacos = iter(iteravel)
+    primeiro = next(pedacos, None)
+    return resposta, iteravel, pedacos, primeiro
+
+# Resposta curta quando a fila das rotas pesadas está cheia
+async def recusar_asgi(send):
+    await send({'type': 'http.response.start', 'status': 503,
+                'headers': [(b'content-type', b'text/plain; charset=utf-8'), (b'retry-after', b'5')]})
+    await send({'type': 'http.response.body', 'body': "Muitos relatórios ao mesmo tempo, tente de novo em instantes.".encode('utf-8')})
+
+# Início e parada do servidor ASGI: liga o agendador e, na parada, fecha executores e conexões
+async def ciclo_de_vida_asgi(receive, send):
+    laco = asyncio.get_running_loop()
+    while True:
+        mensagem = await receive()
+        if mensagem['type'] == 'lifespan.startup':
+            try:
+                await laco.run_in_executor(None, criar_app)
+                iniciar_agendador()
+            except Exception as erro:
+                await send({'type': 'lifespan.startup.failed', 'message': str(erro)})
+                return
+            await send({'type': 'lifespan.startup.complete'})
+        elif mensagem['type'] == 'lifespan.shutdown':
+            await laco.run_in_executor(None, parar_asgi)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+# Função para parar o que o servidor ASGI ligou (espera as requisições em andamento)
+def parar_asgi():
+    fechar_executores_asgi()
+    parar_agendador()
+    fechar_fila_senhas()
+    fechar_pool()
+
+# Aplicação ASGI
+async def aplicacao_asgi(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await ciclo_de_vida_asgi(receive, send)
+        return
+    if scope['type'] != 'http':
+        raise ValueError(f"Tipo de conexão não atendido: {scope['type']}")
+
+    tipo = 'pesadas' if scope['path'].startswith(CONFIGURACAO_ASGI['prefixos_pesados']) else 'paginas'
+    executor = entrar_no_executor_asgi(tipo)
+    if executor is None:
+        await recusar_asgi(send)
+        return
+    laco = asyncio.get_running_loop()
+    # Os passos da mesma requisição podem cair em threads diferentes do executor; rodando
+    # todos no mesmo contexto, o contexto do Flask aberto no primeiro passo continua valendo
+    # nos pedaços seguintes das respostas em pedaços (stream_with_context)
+    contexto = contextvars.copy_context()
+    try:
+        corpo = await ler_corpo_asgi(receive)
+        if corpo is None:
+            return
+        with corpo:
+            resposta, iteravel, pedacos, pedaco = await laco.run_in_executor(
+                executor, contexto.run, iniciar_resposta_wsgi, montar_environ_asgi(scope, corpo))
+            try:
+                await send({'type': 'http.response.start', 'status': resposta['status'],
+                            'headers': resposta['cabecalhos']})
+                # Respostas em pedaços (exportações): cada pedaço é lido do cursor numa thread
+                while pedaco is not None:
+                    if pedaco:
+                        await send({'type': 'http.response.body', 'body': pedaco, 'more_body': True})
+                    pedaco = await laco.run_in_executor(executor, contexto.run, next, pedacos, None)
+                await send({'type': 'http.response.body', 'body': b''})
+            finally:
+                # O close() do WSGI devolve a conexão do banco ao pool
+                if hasattr(iteravel, 'close'):
+                    await laco.run_in_executor(executor, contexto.run, iteravel.close)
+    finally:
+        sair_do_executor_asgi(tipo)
+
+# Função para preparar banco, admin e dados de exemplo e devolver a aplicação ASGI
+def criar_app_asgi(dados_exemplo=None):
+    criar_app(dados_exemplo)
+    return aplicacao_asgi
 
 # Executar o sistema
 if __name__ == "__main__":
-    # Configurar banco de dados
-    criar_tabelas_banco()
-    criar_primeiro_admin()
-    inserir_dados_exemplo()
-    
+    parser = argparse.ArgumentParser(description="Sistema de Biblioteca")
+    comandos = parser.add_subparsers(dest='comando')
+    comandos.add_parser('servir', help="iniciar o servidor de desenvolvimento (padrão)")
+    comando_producao = comandos.add_parser('producao', help="iniciar o servidor de produção (vários processos)")
+    comando_producao.add_argument('--host', default='0.0.0.0')
+    comando_producao.add_argument('--porta', type=int, default=5000)
+    comando_producao.add_argument('--processos', type=int, help="processos filhos (padrão: um por núcleo)")
+    comando_producao.add_argument('--threads', type=int, default=8, help="threads em cada processo")
+    comando_producao.add_argument('--log-acessos', action='store_true', help="mostrar cada requisição no terminal")
+    comandos.add_parser('verificar-indices', help="conferir se as consultas das páginas usam índice")
+    comando_gerar = comandos.add_parser('gerar-dados', help="gerar livros, alunos e empréstimos sintéticos num banco vazio")
+    comando_gerar.add_argument('--livros', type=int, default=10000)
+    comando_gerar.add_argument('--usuarios', type=int, default=2000)
+    comando_gerar.add_argument('--emprestimos', type=int, default=100000)
+    comando_gerar.add_argument('--anos', type=float, default=3, help="por quantos anos os empréstimos se espalham")
+    comando_gerar.add_argument('--atrasados', type=float, default=0.1, help="fração de devoluções atrasadas")
+    comando_gerar.add_argument('--semente', type=int, default=42)
+    comando_varrer = comandos.add_parser('varrer-atrasados', help="marcar os atrasos de hoje e enviar os avisos da fila")
+    comando_varrer.add_argument('--enviador', choices=sorted(ENVIADORES_NOTIFICACAO))
+    comandos.add_parser('encerrar-sessoes', help="encerrar as sessões de todo mundo (todos precisam entrar de novo)")
+    comando_importar = comandos.add_parser('importar', help="importar livros ou usuários de um arquivo CSV/JSONL")
+    comando_importar.add_argument('tabela', choices=sorted(IMPORTACAO))
+    comando_importar.add_argument('arquivo')
+    comando_importar.add_argument('--formato', choices=('csv', 'jsonl'))
+    comando_importar.add_argument('--conflito', choices=('atualizar', 'ignorar'), default='atualizar')
+    comando_importar.add_argument('--lote', type=int, default=10000)
+    argumentos = parser.parse_args()
+
+    if argumentos.comando == 'producao':
+        servir_producao(argumentos.host, argumentos.porta, argumentos.processos, argumentos.threads,
+                        argumentos.log_acessos)
+        sys.exit(0)
+
+    # Configurar banco de dados (uma vez só). Dados de exemplo só para o servidor de
+    # desenvolvimento: gerar-dados precisa do banco vazio e os outros comandos não os usam
+    criar_app(dados_exemplo=None if argumentos.comando in (None, 'servir') else False)
+
+    if argumentos.comando == 'verificar-indices':
+        sem_indice = 0
+        for consulta in verificar_uso_de_indices():
+            marcador = "OK  " if consulta['usa_indice'] else "SCAN"
+            print(f"[{marcador}] {consulta['rota']}: {consulta['sql']}")
+            if not consulta['usa_indice']:
+                sem_indice += 1
+                for passo in consulta['plano']:
+                    print(f"         {passo}")
+        sys.exit(1 if sem_indice else 0)
+
+    if argumentos.comando == 'gerar-dados':
+        banco = conectar_banco()
+        resumo = gerar_dados(banco, argumentos.livros, argumentos.usuarios, argumentos.emprestimos,
+                             semente=argumentos.semente, anos=argumentos.anos, fracao_atrasados=argumentos.atrasados)
+        banco.close()
+        if resumo is None:
+            sys.exit(f"O banco {CAMINHO_BANCO} já tem livros, usuários ou empréstimos; "
+                     f"gere num arquivo novo (BIBLIOTECA_DB=outro.db)")
+        print(f"Gerados em {resumo['segundos']:.1f}s: {resumo['livros']} livros, {resumo['usuarios']} alunos, "
+              f"{resumo['emprestimos']} empréstimos ({resumo['ativos']} ainda emprestados, "
+              f"{resumo['atrasados']} atrasados, {resumo['devolvidos_com_atraso']} devolvidos com atraso)")
+        sys.exit(0)
+
+    if argumentos.comando == 'varrer-atrasados':
+        if argumentos.enviador:
+            CONFIGURACAO_NOTIFICACOES['enviador'] = argumentos.enviador
+        varredura = executar_varredura(forcar=True)
+        envio = enviar_notificacoes()
+        # Sem o agendador, é aqui que as sessões vencidas e o registro de alteradas são limpos
+        sessoes_limpas = limpar_sessoes_vencidas(forcar=True)
+        print(f"{varredura['atrasados']} empréstimos atrasados em {varredura['dia']} "
+              f"({varredura['avisos']} avisos novos na fila)")
+        print(f"Avisos: {envio['enviadas']} enviados, {envio['falhas']} com falha, {envio['canceladas']} cancelados")
+        print(f"Sessões: {sessoes_limpas} vencidas ou encerradas apagadas")
+        sys.exit(0)
+
+    if argumentos.comando == 'encerrar-sessoes':
+        if not isinstance(app.session_interface, SessoesNoBanco):
+            sys.exit("Com as sessões no cookie (BIBLIOTECA_SESSOES=cookie) não dá para encerrá-las")
+        print(f"Sessões encerradas (geração {encerrar_todas_as_sessoes()})")
+        sys.exit(0)
+
+    if argumentos.comando == 'importar':
+        def mostrar_progresso(relatorio):
+            print(f"  {relatorio['lidas']:>10} linhas lidas | {relatorio['linhas_por_segundo']:>10.0f} linhas/s", flush=True)
+
+        formato = argumentos.formato or formato_do_arquivo(argumentos.arquivo)
+        banco = conectar_banco()
+        with open(argumentos.arquivo, encoding='utf-8-sig', newline='') as arquivo:
+            relatorio = importar_registros(banco, argumentos.tabela, ler_linhas_importacao(arquivo, formato),
+                                           conflito=argumentos.conflito, tamanho_lote=argumentos.lote,
+                                           progresso=mostrar_progresso)
+        banco.close()
+
+        print(f"Importação de {relatorio['tabela']} concluída em {relatorio['segundos']:.2f}s "
+              f"({relatorio['linhas_por_segundo']:.0f} linhas/s)")
+        print(f"  lidas: {relatorio['lidas']}  gravadas: {relatorio['gravadas']}  "
+              f"conflitos: {relatorio['conflitos']} ({argumentos.conflito})  inválidas: {relatorio['invalidas']}")
+        for numero, motivo in relatorio['exemplos_invalidas']:
+            print(f"  linha {numero}: {motivo}")
+        sys.exit(0)
+
     # Mensagens de inicialização
     print("=" * 50)
     print("🚀 SISTEMA DE BIBLIOTECA FUNCIONANDO!")
@@ -1508,5 +4692,10 @@ if __name__ == "__main__":
     print("👨‍🎓 Alunos: 2024001 a 2024005")
     print("=" * 50)
     
+    # Com debug o Flask roda o arquivo em dois processos (o de fora só recarrega o código);
+    # o agendador fica só no que atende
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        iniciar_agendador()
+
     # Iniciar servidor
     app.run(debug=True, host='0.0.0.0', port=5000)